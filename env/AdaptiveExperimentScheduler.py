@@ -0,0 +1,111 @@
+import argparse
+import heapq
+import math
+from pathlib import Path
+from statistics import NormalDist
+from typing import Callable, Hashable
+
+import numpy as np
+import pandas as pd
+
+from SumoEnvironmentGenerator import SumoEnvironmentGenerator
+from SumoTraceGenerator import SumoTraceGenerator
+
+# the per-episode outcomes of the summaries written by EpisodeMetricsCollector
+OUTCOMES = ('speed', 'waitingTime', 'emergencyBraking', 'rearEndCollisions', 'lateralCollisions', 'collisions')
+
+
+class AdaptiveExperimentScheduler:
+    # Sequential design for trace generation: after initial_episodes per cell (an agent or a speed/friction condition),
+    # every round gives batch_size new episodes to the cells whose confidence intervals on the outcomes are widest
+    # relative to the requested precision (half-width per outcome), until all cells reach it or max_episodes.
+    # Episode i of every cell uses the same seed sequence, so cells stay paired by common random numbers.
+
+    def __init__(self, trace_generator: SumoTraceGenerator, precision: dict[str, float], confidence: float = 0.95,
+                 initial_episodes: int = 10, batch_size: int = None, max_episodes: int = 1000, seed: int = None):
+        unknown = set(precision) - set(OUTCOMES)
+        if unknown:
+            raise ValueError(f"Unknown outcomes {sorted(unknown)}, expected some of {OUTCOMES}")
+        self.trace_generator = trace_generator
+        self.precision = precision
+        self.z = NormalDist().inv_cdf(0.5 + confidence / 2)
+        self.initial_episodes = initial_episodes
+        self.batch_size = batch_size
+        self.max_episodes = max_episodes
+        self.entropy = np.random.SeedSequence(seed).entropy
+
+    def run(self, env_generator: SumoEnvironmentGenerator, cells: list[Hashable],
+            make_episode: Callable[[Hashable, int, np.random.SeedSequence], dict]) -> pd.DataFrame:
+        # make_episode(cell, index, seed_sequence) returns the episode dict of SumoTraceGenerator.run_episodes
+        results = {cell: [] for cell in cells}
+        allocation = {cell: self.initial_episodes for cell in cells}
+        batch_size = self.batch_size or len(cells)
+
+        while allocation:
+            episodes = []
+            for cell, count in allocation.items():
+                start = len(results[cell])
+                episodes.extend((cell, make_episode(cell, i, np.random.SeedSequence(self.entropy, spawn_key=(i,))))
+                                for i in range(start, start + count))
+            self.trace_generator.run_episodes(env_generator, [episode for _cell, episode in episodes])
+            for cell, episode in episodes:
+                results[cell].append(read_summary(episode['output_prefix']))
+
+            report = self.report(results)
+            print(f"{sum(map(len, results.values()))} episodes, widest interval at "
+                  f"{report['ratio'].max():.2f}x the requested precision")
+            allocation = self.allocate(report, batch_size)
+
+        return self.report(results)
+
+    def report(self, results: dict[Hashable, list[dict]]) -> pd.DataFrame:
+        rows = []
+        for cell, cell_results in results.items():
+            data = pd.DataFrame(cell_results)
+            row = {'cell': cell, 'episodes': len(data)}
+            ratios = []
+            for outcome, precision in self.precision.items():
+                values = data[outcome].dropna().to_numpy(dtype=float) if outcome in data else np.empty(0)
+                half_width = self.z * values.std(ddof=1) / math.sqrt(len(values)) if len(values) > 1 else math.inf
+                row[f'{outcome}_mean'] = values.mean() if len(values) else math.nan
+                row[f'{outcome}_half_width'] = half_width
+                ratios.append(half_width / precision)
+            row['ratio'] = max(ratios)
+            rows.append(row)
+        return pd.DataFrame(rows).set_index('cell')
+
+    def allocate(self, report: pd.DataFrame, batch_size: int) -> dict[Hashable, int]:
+        # the half-width shrinks with 1 / sqrt(n): hand out episodes one by one to the cell with the widest projected
+        # interval, skipping cells that reached the precision or max_episodes
+        heap = [(-ratio, i, cell, episodes) for i, (cell, ratio, episodes) in
+                enumerate(zip(report.index, report['ratio'], report['episodes']))
+                if ratio > 1 and episodes < self.max_episodes]
+        heapq.heapify(heap)
+        allocation = {}
+        for _ in range(batch_size):
+            if not heap:
+                break
+            negative_ratio, i, cell, episodes = heapq.heappop(heap)
+            allocation[cell] = allocation.get(cell, 0) + 1
+            ratio = -negative_ratio * math.sqrt(episodes / (episodes + 1))
+            if ratio > 1 and episodes + 1 < self.max_episodes:
+                heapq.heappush(heap, (-ratio, i, cell, episodes + 1))
+        return allocation
+
+
+def read_summary(output_prefix: str) -> dict:
+    summary_file = Path(output_prefix + '_summary.csv')
+    return pd.read_csv(summary_file).to_dict('records')[0] if summary_file.exists() else {}
+
+
+def precision_target(value: str) -> tuple[str, float]:
+    # argparse type of 'outcome=half_width' arguments
+    outcome, separator, half_width = value.partition('=')
+    if not separator:
+        raise argparse.ArgumentTypeError(f"expected outcome=half_width, got '{value}'")
+    if outcome not in OUTCOMES:
+        raise argparse.ArgumentTypeError(f"unknown outcome '{outcome}', expected one of {', '.join(OUTCOMES)}")
+    try:
+        return outcome, float(half_width)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"half-width of '{outcome}' is not a number: '{half_width}'")
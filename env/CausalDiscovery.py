@@ -0,0 +1,269 @@
+import argparse
+import hashlib
+import itertools
+import math
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from SumoTraceAggregator import DATA_COLUMNS
+
+INDEPENDENT_VARIABLES = ('desiredSpeed', 'friction')
+OUTCOME_VARIABLES = ('waitingTime', 'collisions')
+
+
+class StablePC:
+    # PC algorithm, stable variant, with Fisher-z tests on a correlation matrix (like castle's PC(variant='stable')).
+    # Every test only needs the correlation matrix and the sample size, so a resample costs one pass over the data,
+    # and within one learn() the test of (j, i) reuses the p-value of (i, j). Forbidden edges follow castle's
+    # PrioriKnowledge: an edge forbidden in both directions is never added, one forbidden direction orients it the
+    # other way.
+    # learn() returns a CPDAG matrix: m[i, j] = 1 and m[j, i] = 0 for i -> j, both 1 for an undirected edge.
+
+    def __init__(self, alpha: float = 0.05, forbidden_edges: set[tuple[int, int]] = frozenset()):
+        self.alpha = alpha
+        self.forbidden_edges = set(forbidden_edges)
+        self.p_values = {}
+
+    def p_value(self, correlation: np.ndarray, n: int, i: int, j: int, conditioning_set: tuple) -> float:
+        i, j = min(i, j), max(i, j)
+        key = (i, j, conditioning_set)
+        if key not in self.p_values:
+            self.p_values[key] = fisher_z_p_value(correlation, n, i, j, conditioning_set)
+        return self.p_values[key]
+
+    def learn(self, correlation: np.ndarray, n: int) -> np.ndarray:
+        self.p_values = {}
+        d = len(correlation)
+        adjacency = np.ones((d, d), dtype=bool)
+        np.fill_diagonal(adjacency, False)
+        for i, j in self.forbidden_edges:
+            if (j, i) in self.forbidden_edges:
+                adjacency[i, j] = adjacency[j, i] = False
+
+        separating_sets = {}
+        level = 0
+        while True:
+            # stable: the neighbourhoods are fixed for the whole level, so the result does not depend on the order
+            neighbours = [set(np.flatnonzero(adjacency[i])) for i in range(d)]
+            testable = False
+            for i, j in itertools.permutations(range(d), 2):
+                if not adjacency[i, j] or len(neighbours[i] - {j}) < level:
+                    continue
+                testable = True
+                for conditioning_set in itertools.combinations(sorted(neighbours[i] - {j}), level):
+                    if self.p_value(correlation, n, i, j, conditioning_set) > self.alpha:
+                        adjacency[i, j] = adjacency[j, i] = False
+                        separating_sets[frozenset((i, j))] = set(conditioning_set)
+                        break
+            if not testable:
+                break
+            level += 1
+
+        return self._orient(adjacency.astype(np.int8), separating_sets)
+
+    def _orient(self, graph: np.ndarray, separating_sets: dict) -> np.ndarray:
+        d = len(graph)
+        # v-structures i -> k <- j: like castle's orient, every still undirected edge into k is oriented on its own,
+        # so an edge already oriented by another pair of parents does not block the rest
+        for k in range(d):
+            for i, j in itertools.combinations(np.flatnonzero(graph[:, k] | graph[k, :]), 2):
+                if graph[i, j] or graph[j, i] or k in separating_sets.get(frozenset((i, j)), set()):
+                    continue
+                for parent in (i, j):
+                    if graph[k, parent] and graph[parent, k] and (parent, k) not in self.forbidden_edges:
+                        graph[k, parent] = 0
+
+        # background knowledge
+        for i, j in self.forbidden_edges:
+            if graph[i, j] and graph[j, i]:
+                graph[i, j] = 0
+
+        # Meek rules until nothing changes
+        changed = True
+        while changed:
+            changed = False
+            for i, j in itertools.permutations(range(d), 2):
+                if not (graph[i, j] and graph[j, i]):
+                    continue
+                if self._meek(graph, i, j):
+                    graph[j, i] = 0
+                    changed = True
+        return graph
+
+    @staticmethod
+    def _meek(graph: np.ndarray, i: int, j: int) -> bool:
+        # True if the undirected edge i - j has to be oriented i -> j
+        directed = (graph == 1) & (graph.T == 0)
+        undirected = (graph == 1) & (graph.T == 1)
+        adjacent = (graph == 1) | (graph.T == 1)
+        # R1: k -> i - j with k, j not adjacent
+        if any(directed[k, i] and not adjacent[k, j] for k in range(len(graph)) if k != j):
+            return True
+        # R2: i -> k -> j
+        if any(directed[i, k] and directed[k, j] for k in range(len(graph))):
+            return True
+        # R3: i - k1 -> j and i - k2 -> j with k1, k2 not adjacent
+        parents = [k for k in range(len(graph)) if undirected[i, k] and directed[k, j]]
+        return any(not adjacent[k1, k2] for k1, k2 in itertools.combinations(parents, 2))
+
+
+class BootstrapCausalDiscovery:
+    # Runs StablePC on bootstrap resamples in parallel processes and reports how often every edge is found. Resamples
+    # are drawn as multiplicities per row, so each one is a weighted correlation matrix computed in one pass over the
+    # data. Correlation matrices are cached on disk by a hash of the data, the seed and the resample, so re-runs
+    # (e.g. with another alpha or more resamples) of a seeded analysis only compute the new ones.
+
+    def __init__(self, alpha: float = 0.05, bootstraps: int = 100, workers: int = 1, seed: int = None,
+                 cache_directory: Path = None):
+        self.alpha = alpha
+        self.bootstraps = bootstraps
+        self.workers = workers
+        self.entropy = np.random.SeedSequence(seed).entropy
+        # an unseeded run draws resamples no other run can reuse, so only seeded runs use the cache
+        self.cache_directory = cache_directory if seed is not None else None
+        self.graphs = None
+        self.columns = None
+
+    def fit(self, data: pd.DataFrame, forbidden_edges: list[tuple[str, str]] = ()) -> pd.DataFrame:
+        self.columns = list(data.columns)
+        index = {column: i for i, column in enumerate(self.columns)}
+        forbidden = {(index[source], index[target]) for source, target in forbidden_edges
+                     if source in index and target in index}
+        values = np.ascontiguousarray(data.to_numpy(dtype=np.float64))
+        data_hash = hashlib.sha256(values.tobytes()).hexdigest()[:16]
+
+        tasks = list(range(self.bootstraps))
+        arguments = (values, data_hash, self.entropy, self.alpha, forbidden, self.cache_directory)
+        if self.workers <= 1:
+            _initialize_worker(*arguments)
+            graphs = [_bootstrap_graph(task) for task in tasks]
+        else:
+            chunksize = max(1, len(tasks) // (4 * self.workers))
+            with ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context('spawn'),
+                                     initializer=_initialize_worker, initargs=arguments) as executor:
+                graphs = list(executor.map(_bootstrap_graph, tasks, chunksize=chunksize))
+        self.graphs = np.stack(graphs)
+        return self.edge_frequencies()
+
+    def edge_frequencies(self) -> pd.DataFrame:
+        # one row per pair of variables that is adjacent in at least one resample
+        graphs = self.graphs.astype(bool)
+        directed = (graphs & ~graphs.transpose(0, 2, 1)).mean(axis=0)
+        undirected = (graphs & graphs.transpose(0, 2, 1)).mean(axis=0)
+        rows = []
+        for i, j in itertools.combinations(range(len(self.columns)), 2):
+            adjacency = directed[i, j] + directed[j, i] + undirected[i, j]
+            if adjacency == 0:
+                continue
+            rows.append({
+                'source': self.columns[i],
+                'target': self.columns[j],
+                'source_to_target': directed[i, j],
+                'target_to_source': directed[j, i],
+                'undirected': undirected[i, j],
+                'adjacency': adjacency,
+            })
+        frequencies = pd.DataFrame(rows, columns=['source', 'target', 'source_to_target', 'target_to_source',
+                                                  'undirected', 'adjacency'])
+        return frequencies.sort_values('adjacency', ascending=False, ignore_index=True)
+
+
+def fisher_z_p_value(correlation: np.ndarray, n: int, i: int, j: int, conditioning_set: tuple) -> float:
+    variables = [i, j, *conditioning_set]
+    precision = np.linalg.pinv(correlation[np.ix_(variables, variables)])
+    partial_correlation = -precision[0, 1] / math.sqrt(precision[0, 0] * precision[1, 1])
+    partial_correlation = min(max(partial_correlation, -1 + 1e-12), 1 - 1e-12)
+    degrees_of_freedom = n - len(conditioning_set) - 3
+    if degrees_of_freedom <= 0:
+        return 1.0
+    statistic = math.sqrt(degrees_of_freedom) * abs(math.atanh(partial_correlation))
+    return math.erfc(statistic / math.sqrt(2))
+
+
+def bootstrap_weights(n: int, entropy: int, bootstrap: int) -> np.ndarray:
+    # how often every row is drawn into the resample, the same for every analysis with the same seed
+    rng = np.random.default_rng(np.random.SeedSequence(entropy, spawn_key=(bootstrap,)))
+    return np.bincount(rng.integers(0, n, n), minlength=n).astype(np.float64)
+
+
+def weighted_correlation(values: np.ndarray, weights: np.ndarray) -> np.ndarray:
+    centered = values - np.average(values, axis=0, weights=weights)
+    covariance = (centered * weights[:, None]).T @ centered / weights.sum()
+    scale = np.sqrt(np.diag(covariance))
+    scale[scale == 0] = 1.0
+    return covariance / np.outer(scale, scale)
+
+
+def default_forbidden_edges(columns: list[str], independent_variables=INDEPENDENT_VARIABLES,
+                            outcome_variables=OUTCOME_VARIABLES) -> list[tuple[str, str]]:
+    # as in the notebook: nothing causes the interventions, outcomes do not cause each other
+    return [
+        *((column, variable) for variable in independent_variables for column in columns if column != variable),
+        *itertools.permutations([variable for variable in outcome_variables if variable in columns], 2),
+    ]
+
+
+_worker = {}
+
+
+def _initialize_worker(values: np.ndarray, data_hash: str, entropy: int, alpha: float, forbidden: set,
+                       cache_directory: Path):
+    _worker.update(values=values, data_hash=data_hash, entropy=entropy, cache_directory=cache_directory,
+                   pc=StablePC(alpha, forbidden))
+
+
+def _bootstrap_graph(bootstrap: int) -> np.ndarray:
+    values = _worker['values']
+    sample_key = f"{_worker['data_hash']}_{_worker['entropy']}_{bootstrap}"
+    cache_file = None
+    if _worker['cache_directory'] is not None:
+        cache_file = Path(_worker['cache_directory'], hashlib.sha256(sample_key.encode()).hexdigest()[:24] + '.npy')
+    if cache_file is not None and cache_file.exists():
+        correlation = np.load(cache_file)
+    else:
+        correlation = weighted_correlation(values, bootstrap_weights(len(values), _worker['entropy'], bootstrap))
+        if cache_file is not None:
+            cache_file.parent.mkdir(parents=True, exist_ok=True)
+            np.save(cache_file, correlation)
+    return _worker['pc'].learn(correlation, len(values))
+
+
+def load_data(path: Path) -> pd.DataFrame:
+    if path.is_dir():
+        from SumoTraceStore import SumoTraceStore
+        data = SumoTraceStore(path).read(columns=DATA_COLUMNS)
+    else:
+        data = pd.read_csv(path)
+    # the columns of data.csv, so a store does not add the collision split whose sum collisions already is
+    data = data[[column for column in DATA_COLUMNS if column in data.columns]].select_dtypes('number')
+    # constant columns carry no information and make the correlation matrix singular
+    return data.loc[:, data.std() > 0].dropna()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('data', type=Path, help='data.csv of SumoTraceAggregator or a SumoTraceStore directory')
+    parser.add_argument('--bootstraps', type=int, default=100)
+    parser.add_argument('--alpha', type=float, default=0.05)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--cache', type=Path, default=Path('cache', 'causal_discovery'),
+                        help='directory of the resample correlation matrices, only used with --seed')
+    parser.add_argument('--output', type=Path, default=None, help='csv of the edge frequencies')
+    args = parser.parse_args()
+
+    data = load_data(args.data)
+    discovery = BootstrapCausalDiscovery(alpha=args.alpha, bootstraps=args.bootstraps, workers=args.workers,
+                                         seed=args.seed, cache_directory=args.cache)
+    frequencies = discovery.fit(data, default_forbidden_edges(list(data.columns)))
+    print(frequencies.to_string())
+    if args.output:
+        frequencies.to_csv(args.output, index=False)
+
+
+if __name__ == '__main__':
+    main()
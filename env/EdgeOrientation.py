@@ -0,0 +1,176 @@
+import argparse
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from CausalDiscovery import StablePC, bootstrap_weights, default_forbidden_edges, load_data, weighted_correlation
+
+# bootstrap index of the rows scored on the original data
+OBSERVED = -1
+
+
+def weighted_midranks(sorted_values: np.ndarray, sorted_weights: np.ndarray) -> np.ndarray:
+    # ranks of the rows of a resample in which every row appears sorted_weights times, ties get the average rank like
+    # scipy's rankdata. Rows are in ascending order along the last axis, so the ranks of every resample are cumulative
+    # sums and only need to be shifted to the middle of their tie group.
+    cumulative = np.cumsum(sorted_weights, axis=-1)
+    before = cumulative - sorted_weights
+    starts = np.ones(sorted_values.shape, dtype=bool)
+    starts[..., 1:] = sorted_values[..., 1:] != sorted_values[..., :-1]
+    ends = np.ones(sorted_values.shape, dtype=bool)
+    ends[..., :-1] = starts[..., 1:]
+    group_before = np.maximum.accumulate(np.where(starts, before, 0.0), axis=-1)
+    group_end = np.flip(np.minimum.accumulate(np.flip(np.where(ends, cumulative, np.inf), axis=-1), axis=-1), axis=-1)
+    return (group_before + group_end + 1) / 2
+
+
+def weighted_pearson(a: np.ndarray, b: np.ndarray, weights: np.ndarray) -> np.ndarray:
+    # correlation along the last axis
+    total = weights.sum(axis=-1, keepdims=True)
+    a = a - (weights * a).sum(axis=-1, keepdims=True) / total
+    b = b - (weights * b).sum(axis=-1, keepdims=True) / total
+    covariance = (weights * a * b).sum(axis=-1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return covariance / np.sqrt((weights * a * a).sum(axis=-1) * (weights * b * b).sum(axis=-1))
+
+
+class SharedRanking:
+    # sort order and weighted ranks of a variable, shared by all edges that contain it
+    def __init__(self, values: np.ndarray):
+        self.values = values
+        self.order = np.argsort(values, kind='stable')
+        self.sorted_values = values[self.order]
+
+    def ranks(self, weights: np.ndarray) -> np.ndarray:
+        # ranks of the variable in every resample (rows of weights), in the sort order of the variable
+        return weighted_midranks(self.sorted_values, weights[:, self.order])
+
+
+def residual_rank_correlation(ranking: SharedRanking, x_ranks: np.ndarray, y: np.ndarray,
+                              weights: np.ndarray) -> np.ndarray:
+    # Spearman correlation of x with the residuals of the least squares fit y = a + b * x, per resample. The fit is
+    # closed form (b = cov(x, y) / var(x)), x_ranks come from the shared ranking of x and the residuals are ranked
+    # with one batched sort.
+    x = ranking.values
+    total = weights.sum(axis=1, keepdims=True)
+    x_centered = x - (weights @ x)[:, None] / total
+    y_centered = y - (weights @ y)[:, None] / total
+    with np.errstate(invalid='ignore', divide='ignore'):
+        slope = (weights * x_centered * y_centered).sum(axis=1) / (weights * x_centered ** 2).sum(axis=1)
+    residuals = y_centered - slope[:, None] * x_centered
+    residual_order = np.argsort(residuals, axis=1, kind='stable')
+    residual_ranks = np.empty_like(residuals)
+    np.put_along_axis(residual_ranks, residual_order, weighted_midranks(
+        np.take_along_axis(residuals, residual_order, axis=1),
+        np.take_along_axis(weights, residual_order, axis=1)), axis=1)
+    # both rankings are compared row by row, so the residual ranks are brought into the sort order of x
+    return weighted_pearson(x_ranks, residual_ranks[:, ranking.order], weights[:, ranking.order])
+
+
+def orientation_scores(data: pd.DataFrame, edges: list[tuple[str, str]], bootstraps: int = 100, seed: int = None,
+                       chunk_size: int = None) -> pd.DataFrame:
+    # The residual test of the notebook for every edge X - Y: regress both ways and compare the rank correlations of
+    # every regressor with the residuals of the other direction; the direction with the smaller one is the causal one,
+    # the absolute difference is the confidence. Computed on the data (bootstrap -1) and on the same bootstrap
+    # resamples as BootstrapCausalDiscovery with the same seed. Returns one row per edge and resample.
+    entropy = np.random.SeedSequence(seed).entropy
+    n = len(data)
+    chunk_size = chunk_size or max(1, 2 ** 22 // max(n, 1))
+    rankings = {}
+    for source, target in edges:
+        for variable in (source, target):
+            if variable not in rankings:
+                rankings[variable] = SharedRanking(data[variable].to_numpy(dtype=np.float64))
+
+    resamples = [OBSERVED, *range(bootstraps)]
+    tables = []
+    for start in range(0, len(resamples), chunk_size):
+        chunk = resamples[start:start + chunk_size]
+        weights = np.stack([np.ones(n) if bootstrap == OBSERVED else bootstrap_weights(n, entropy, bootstrap)
+                            for bootstrap in chunk])
+        ranks = {variable: ranking.ranks(weights) for variable, ranking in rankings.items()}
+        for source, target in edges:
+            # corr(X, residuals of Y ~ X) and corr(Y, residuals of X ~ Y)
+            source_residual = residual_rank_correlation(rankings[source], ranks[source], rankings[target].values,
+                                                        weights)
+            target_residual = residual_rank_correlation(rankings[target], ranks[target], rankings[source].values,
+                                                        weights)
+            tables.append(pd.DataFrame({
+                'source': source,
+                'target': target,
+                'bootstrap': chunk,
+                'source_residual_correlation': source_residual,
+                'target_residual_correlation': target_residual,
+            }))
+
+    scores = pd.concat(tables, ignore_index=True) if tables else pd.DataFrame(
+        columns=['source', 'target', 'bootstrap', 'source_residual_correlation', 'target_residual_correlation'])
+    source_residual = scores['source_residual_correlation'].abs()
+    target_residual = scores['target_residual_correlation'].abs()
+    scores['source_to_target'] = source_residual < target_residual
+    scores['confidence'] = (target_residual - source_residual).abs()
+    return scores.sort_values(['source', 'target', 'bootstrap'], ignore_index=True)
+
+
+def summarize_orientations(scores: pd.DataFrame, confidence_level: float = 0.95) -> pd.DataFrame:
+    # per edge: the orientation on the data and the distribution of the confidence over the resamples
+    lower, upper = (1 - confidence_level) / 2, (1 + confidence_level) / 2
+    observed = scores[scores['bootstrap'] == OBSERVED].set_index(['source', 'target'])
+    resampled = scores[scores['bootstrap'] != OBSERVED]
+    # the confidence signed towards source -> target, so the interval also shows how stable the orientation is
+    resampled = resampled.assign(signed_confidence=np.where(resampled['source_to_target'], 1, -1)
+                                 * resampled['confidence'])
+    summary = resampled.groupby(['source', 'target']).agg(
+        bootstraps=('bootstrap', 'size'),
+        source_to_target_frequency=('source_to_target', 'mean'),
+        confidence_mean=('confidence', 'mean'),
+        confidence_std=('confidence', 'std'),
+        signed_confidence_lower=('signed_confidence', lambda values: values.quantile(lower)),
+        signed_confidence_upper=('signed_confidence', lambda values: values.quantile(upper)),
+    )
+    summary.insert(0, 'observed_source_to_target', observed['source_to_target'])
+    summary.insert(1, 'observed_confidence', observed['confidence'])
+    return summary.reset_index()
+
+
+def learned_edges(data: pd.DataFrame, alpha: float = 0.05) -> list[tuple[str, str]]:
+    # adjacencies of PC on the full data, in the direction PC found (or column order when undirected)
+    columns = list(data.columns)
+    index = {column: i for i, column in enumerate(columns)}
+    forbidden = {(index[source], index[target]) for source, target in default_forbidden_edges(columns)}
+    values = data.to_numpy(dtype=np.float64)
+    graph = StablePC(alpha, forbidden).learn(weighted_correlation(values, np.ones(len(values))), len(values))
+    return [(columns[i], columns[j]) for i in range(len(columns)) for j in range(len(columns))
+            if graph[i, j] and (not graph[j, i] or i < j)]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('data', type=Path, help='data.csv of SumoTraceAggregator or a SumoTraceStore directory')
+    parser.add_argument('--edges', type=Path, default=None,
+                        help='csv with source and target columns, e.g. the output of CausalDiscovery.py '
+                             '(default: the edges PC finds on the data)')
+    parser.add_argument('--bootstraps', type=int, default=100)
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--alpha', type=float, default=0.05)
+    parser.add_argument('--output', type=Path, default=None, help='csv of the scores per edge and resample')
+    args = parser.parse_args()
+
+    data = load_data(args.data)
+    if args.edges:
+        edges = list(pd.read_csv(args.edges)[['source', 'target']].itertuples(index=False, name=None))
+    else:
+        edges = learned_edges(data, args.alpha)
+    start = time.perf_counter()
+    scores = orientation_scores(data, edges, bootstraps=args.bootstraps, seed=args.seed)
+    print(f"Scored {len(edges)} edges on {args.bootstraps} resamples of {len(data)} rows "
+          f"in {time.perf_counter() - start:.2f}s")
+    print(summarize_orientations(scores).to_string())
+    if args.output:
+        scores.to_csv(args.output, index=False)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,188 @@
+import json
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+
+import numpy as np
+from stable_baselines3.common.callbacks import BaseCallback
+from sumo_rl import SumoEnvironment
+
+PHASES = ('simulation', 'observation', 'reward', 'inference', 'other')
+
+
+class EnvironmentProfiler:
+    # Opt-in timing of where an episode spends its time: simulationStep (including the SUMO outputs such as the ssm
+    # device), observation, reward, policy inference (wrapped by the caller with phase('inference')) and the rest of
+    # env.step. TraCI calls are counted per phase through a thin proxy in front of env.sumo. Finished episodes are
+    # written to <output_prefix>_profile.json and kept in summaries for ProfilerCallback.
+
+    def __init__(self, output_prefix: str = ''):
+        self.output_prefix = output_prefix
+        self.env = None
+        self.summaries = []
+        self.episodes = 0
+        self.reset()
+
+    def reset(self):
+        self.current_phase = 'other'
+        self.step_timings = dict.fromkeys(PHASES, 0.0)
+        self.per_step = {phase: [] for phase in PHASES}
+        self.call_counts = defaultdict(Counter)
+
+    def attach(self, env: SumoEnvironment):
+        self.env = env
+        env.profiler = self
+        reset = env.reset
+        step = env.step
+
+        def profiled_reset(*args, **kwargs):
+            self.finish_episode()
+            obs, info = reset(*args, **kwargs)
+            self._instrument()
+            return obs, info
+
+        def profiled_step(action):
+            start = time.perf_counter()
+            obs, reward, terminated, truncated, info = step(action)
+            self.step_timings['other'] += time.perf_counter() - start - sum(
+                self.step_timings[phase] for phase in ('simulation', 'observation', 'reward'))
+            for phase in PHASES:
+                self.per_step[phase].append(self.step_timings[phase])
+                self.step_timings[phase] = 0.0
+            if terminated or truncated:
+                self.finish_episode()
+            return obs, reward, terminated, truncated, info
+
+        env.reset = profiled_reset
+        env.step = profiled_step
+
+    @contextmanager
+    def phase(self, name: str):
+        previous = self.current_phase
+        self.current_phase = name
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.step_timings[name] += time.perf_counter() - start
+            self.current_phase = previous
+
+    def timed(self, name: str, function):
+        def call(*args, **kwargs):
+            with self.phase(name):
+                return function(*args, **kwargs)
+        return call
+
+    def counted(self, name: str, function):
+        def call(*args, **kwargs):
+            self.call_counts[self.current_phase][name] += 1
+            return function(*args, **kwargs)
+        return call
+
+    def _instrument(self):
+        env = self.env
+        if not isinstance(env.sumo, TraCICallCounter):
+            env.sumo = TraCICallCounter(env.sumo, self)
+        for traffic_signal in env.traffic_signals.values():
+            traffic_signal.sumo = env.sumo
+            traffic_signal.compute_observation = self.timed('observation', traffic_signal.compute_observation)
+            traffic_signal.compute_reward = self.timed('reward', traffic_signal.compute_reward)
+
+    def summary(self) -> dict:
+        steps = len(self.per_step['other'])
+        phases = {}
+        for phase, timings in self.per_step.items():
+            timings = np.asarray(timings)
+            phases[phase] = {
+                'total_s': float(timings.sum()),
+                'mean_ms': float(timings.mean() * 1e3) if steps else 0.0,
+                'max_ms': float(timings.max() * 1e3) if steps else 0.0,
+                'traci_calls': sum(self.call_counts[phase].values()),
+            }
+        return {
+            'steps': steps,
+            'phases': phases,
+            'traci_calls': {phase: dict(counts) for phase, counts in self.call_counts.items()},
+            'per_step_ms': {phase: [round(timing * 1e3, 4) for timing in timings]
+                            for phase, timings in self.per_step.items()},
+        }
+
+    def finish_episode(self):
+        if not self.per_step['other']:
+            return
+        summary = self.summary()
+        if self.output_prefix:
+            with open(self.output_prefix + '_profile.json', 'w') as file:
+                json.dump(summary, file)
+        # per-step timings stay in the json, the in-memory history only keeps the aggregates
+        del summary['per_step_ms']
+        self.summaries.append(summary)
+        self.episodes += 1
+        self.reset()
+
+    def __getstate__(self):
+        # only the collected data crosses process boundaries (e.g. SubprocVecEnv.get_attr)
+        return {'output_prefix': self.output_prefix, 'summaries': self.summaries, 'episodes': self.episodes,
+                'env': None}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.reset()
+
+
+class TraCICallCounter:
+    # stands in for env.sumo (libsumo or a TraCI connection) and counts every call of a domain method or function
+
+    def __init__(self, sumo, profiler: EnvironmentProfiler):
+        self._sumo = sumo
+        self._profiler = profiler
+        self._attributes = {}
+
+    def __getattr__(self, name):
+        if name not in self._attributes:
+            attribute = getattr(self._sumo, name)
+            if name == 'simulationStep':
+                attribute = self._profiler.timed('simulation', self._profiler.counted(name, attribute))
+            elif callable(attribute) and not isinstance(attribute, type):
+                attribute = self._profiler.counted(name, attribute)
+            else:
+                attribute = TraCIDomainCounter(attribute, name, self._profiler)
+            self._attributes[name] = attribute
+        return self._attributes[name]
+
+
+class TraCIDomainCounter:
+    def __init__(self, domain, name: str, profiler: EnvironmentProfiler):
+        self._domain = domain
+        self._name = name
+        self._profiler = profiler
+        self._methods = {}
+
+    def __getattr__(self, name):
+        if name not in self._methods:
+            attribute = getattr(self._domain, name)
+            self._methods[name] = self._profiler.counted(f'{self._name}.{name}', attribute) \
+                if callable(attribute) else attribute
+        return self._methods[name]
+
+
+class ProfilerCallback(BaseCallback):
+    # logs the phase timings of the episodes finished during the last rollout next to the training curves
+
+    def _on_training_start(self):
+        self.logged_episodes = [0] * self.training_env.num_envs
+
+    def _on_step(self) -> bool:
+        return True
+
+    def _on_rollout_end(self):
+        summaries = []
+        for i, profiler in enumerate(self.training_env.get_attr('profiler')):
+            summaries.extend(profiler.summaries[self.logged_episodes[i]:])
+            self.logged_episodes[i] = profiler.episodes
+        if not summaries:
+            return
+        for phase in PHASES:
+            self.logger.record(f'profile/{phase}_ms', np.mean([s['phases'][phase]['mean_ms'] for s in summaries]))
+            self.logger.record(f'profile/{phase}_traci_calls',
+                               np.mean([s['phases'][phase]['traci_calls'] / max(s['steps'], 1) for s in summaries]))
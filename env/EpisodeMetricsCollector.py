@@ -0,0 +1,127 @@
+import numpy as np
+import pandas as pd
+from sumo_rl import SumoEnvironment
+from traci import constants as tc
+
+# SUMO counts emergency braking once per braking manoeuvre, when a vehicle starts to decelerate harder than its decel
+# (plus NUMERICAL_EPS) and the severity, the share of the range from decel to emergency decel that is used, reaches
+# emergencydecel.warning-threshold. A braking in the step a collision removes the vehicle is not observed.
+NUMERICAL_EPS = 0.001
+# vehicles are waiting while their speed does not exceed this threshold (see tripinfo waitingTime)
+WAITING_SPEED = 0.1
+
+
+class EpisodeMetricsCollector:
+    # Gathers the per-episode aggregates of the statistics/collisions/tripinfo outputs while the episode is stepped,
+    # so no XML has to be written and parsed back. Collisions are split like in the trace summaries: the
+    # collision_route vehicle being the victim is a rear-end collision, being the collider a lateral one.
+
+    VEHICLE_VARIABLES = (tc.VAR_SPEED, tc.VAR_DISTANCE, tc.VAR_DECEL, tc.VAR_EMERGENCY_DECEL)
+
+    def __init__(self, collision_route: str = 'southEast'):
+        self.collision_route = collision_route
+        self.env = None
+        self.reset()
+
+    def reset(self):
+        self.departures = {}
+        self.distances = {}
+        self.waiting_times = {}
+        self.speeds = {}
+        self.braking = set()
+        self.trip_speeds = []
+        self.trip_waiting_times = []
+        self.emergency_braking = 0
+        self.rear_end_collisions = 0
+        self.lateral_collisions = 0
+
+    def attach(self, env: SumoEnvironment):
+        # observe every simulation step, including the ones sumo_rl runs between two actions
+        self.env = env
+        self.reset()
+        self.step_length = env.sumo.simulation.getDeltaT()
+        self.emergency_threshold = float(env.sumo.simulation.getOption('emergencydecel.warning-threshold'))
+        sumo_step = type(env)._sumo_step.__get__(env)
+
+        def observed_sumo_step():
+            sumo_step()
+            self.update()
+
+        env._sumo_step = observed_sumo_step
+        # vehicles that are already driving, e.g. after forking from a warm-up snapshot
+        self._track(env.sumo.vehicle.getIDList())
+
+    def detach(self):
+        if self.env is not None and '_sumo_step' in vars(self.env):
+            del self.env._sumo_step
+        self.env = None
+
+    def _track(self, vehicle_ids):
+        vehicle = self.env.sumo.vehicle
+        for vehicle_id in vehicle_ids:
+            vehicle.subscribe(vehicle_id, self.VEHICLE_VARIABLES)
+            self.departures[vehicle_id] = vehicle.getDeparture(vehicle_id)
+            self.distances[vehicle_id] = 0.0
+            self.waiting_times[vehicle_id] = 0.0
+
+    def update(self):
+        sumo = self.env.sumo
+        simulation = sumo.simulation
+        time = simulation.getTime()
+
+        for collision in simulation.getCollisions():
+            if self.collision_route in collision.victim:
+                self.rear_end_collisions += 1
+            if self.collision_route in collision.collider:
+                self.lateral_collisions += 1
+
+        for vehicle_id in simulation.getArrivedIDList():
+            if vehicle_id not in self.departures:
+                continue
+            duration = time - self.departures.pop(vehicle_id)
+            distance = self.distances.pop(vehicle_id)
+            if duration > 0:
+                self.trip_speeds.append(distance / duration)
+            self.trip_waiting_times.append(self.waiting_times.pop(vehicle_id))
+            self.speeds.pop(vehicle_id, None)
+            self.braking.discard(vehicle_id)
+
+        self._track(simulation.getDepartedIDList())
+
+        for vehicle_id, values in sumo.vehicle.getAllSubscriptionResults().items():
+            if values[tc.VAR_SPEED] <= WAITING_SPEED:
+                self.waiting_times[vehicle_id] += self.step_length
+            self.distances[vehicle_id] = values[tc.VAR_DISTANCE]
+            # the speed difference, as the acceleration of an emergency stop at a red light is reported as 0
+            decel = (self.speeds.get(vehicle_id, values[tc.VAR_SPEED]) - values[tc.VAR_SPEED]) / self.step_length
+            self.speeds[vehicle_id] = values[tc.VAR_SPEED]
+            if decel > values[tc.VAR_DECEL] + NUMERICAL_EPS and \
+                    self._severity(decel, values[tc.VAR_DECEL], values[tc.VAR_EMERGENCY_DECEL]) \
+                    >= self.emergency_threshold - NUMERICAL_EPS:
+                if vehicle_id not in self.braking:
+                    self.emergency_braking += 1
+                    self.braking.add(vehicle_id)
+            else:
+                self.braking.discard(vehicle_id)
+
+    @staticmethod
+    def _severity(decel: float, wished_decel: float, emergency_decel: float) -> float:
+        if emergency_decel <= wished_decel:
+            return 1.0
+        return (decel - wished_decel) / (emergency_decel - wished_decel)
+
+    def summary(self) -> dict:
+        return {
+            'count': len(self.trip_waiting_times),
+            'speed': float(np.mean(self.trip_speeds)) if self.trip_speeds else 0.0,
+            'waitingTime': float(np.mean(self.trip_waiting_times)) if self.trip_waiting_times else 0.0,
+            'emergencyBraking': self.emergency_braking,
+            'rearEndCollisions': self.rear_end_collisions,
+            'lateralCollisions': self.lateral_collisions,
+            'collisions': self.rear_end_collisions + self.lateral_collisions,
+        }
+
+    def write_summary(self, output_prefix: str, metadata: dict) -> dict:
+        row = {**metadata, **self.summary()}
+        pd.DataFrame([row]).to_csv(output_prefix + '_summary.csv', index=False)
+        return row
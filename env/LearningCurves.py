@@ -0,0 +1,125 @@
+import argparse
+import glob
+import json
+import re
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+REWARD_TAG = 'rollout/ep_rew_mean'
+WINDOW_SIZE = 10
+# tb_log_name plus the repetition index of train.py and the run counter stable-baselines3 appends
+AGENT_PATTERN = r'^(?P<agent>.*?)(?:_\d+)*$'
+
+
+def read_scalars(run_directory: str | Path, tag: str = REWARD_TAG) -> pd.DataFrame:
+    # Step/Value of one tag, streamed event by event from the event files of a run (the same columns as a csv exported
+    # from TensorBoard). A step logged more than once, e.g. after resuming, keeps the last value.
+    from tensorboard.backend.event_processing.event_file_loader import EventFileLoader
+    from tensorboard.util.tensor_util import make_ndarray
+
+    steps, values = [], []
+    for event_file in sorted(glob.glob(str(Path(run_directory, 'events.out.tfevents.*')))):
+        for event in EventFileLoader(event_file).Load():
+            for value in event.summary.value:
+                if value.tag != tag:
+                    continue
+                steps.append(event.step)
+                values.append(value.simple_value if value.WhichOneof('value') == 'simple_value'
+                              else float(make_ndarray(value.tensor)))
+    data = pd.DataFrame({'Step': np.asarray(steps, dtype=np.int64), 'Value': np.asarray(values, dtype=np.float64)})
+    return data.drop_duplicates('Step', keep='last').sort_values('Step', ignore_index=True)
+
+
+def rolling_statistics(steps: np.ndarray, values: np.ndarray, window_size: int = WINDOW_SIZE) -> pd.DataFrame:
+    # mean, variance (ddof=0), mean-to-variance ratio and slope of every full window, like compute_sliding_window_stats
+    # and compute_sliding_window_derivative of paper_calculations.ipynb, but from cumulative sums in O(n)
+    steps = np.asarray(steps, dtype=np.float64)
+    values = np.asarray(values, dtype=np.float64)
+    if len(values) < window_size:
+        return pd.DataFrame(columns=['start_step', 'end_step', 'mean', 'variance', 'mvr', 'rate'])
+    # shifting by the mean keeps the sums of squares from cancelling
+    shifted = values - values.mean()
+    sums = np.concatenate([[0.0], np.cumsum(shifted)])
+    squares = np.concatenate([[0.0], np.cumsum(shifted * shifted)])
+    window_sums = sums[window_size:] - sums[:-window_size]
+    window_squares = squares[window_size:] - squares[:-window_size]
+    mean = window_sums / window_size
+    variance = np.maximum(window_squares / window_size - mean * mean, 0.0)
+    mean += values.mean()
+    delta_value = values[window_size - 1:] - values[:len(values) - window_size + 1]
+    delta_step = steps[window_size - 1:] - steps[:len(steps) - window_size + 1]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mvr = np.where(variance != 0, mean / variance, np.inf)
+        rate = np.where(delta_step != 0, delta_value / delta_step, np.inf)
+    return pd.DataFrame({
+        'start_step': steps[:len(steps) - window_size + 1],
+        'end_step': steps[window_size - 1:],
+        'mean': mean,
+        'variance': variance,
+        'mvr': mvr,
+        'rate': rate,
+    })
+
+
+def learning_results(data: pd.DataFrame, window_size: int = WINDOW_SIZE) -> dict:
+    # the averages compute_learning_results of the notebook reports for one learning curve
+    statistics = rolling_statistics(data['Step'], data['Value'], window_size)
+    return {
+        'steps': int(data['Step'].iloc[-1]) if len(data) else 0,
+        'mean': statistics['mean'].mean(),
+        'variance': statistics['variance'].mean(),
+        'mvr': statistics['mvr'].mean(),
+        'rate': statistics['rate'].mean(),
+        'final_reward': data['Value'].iloc[-1] if len(data) else np.nan,
+    }
+
+
+def compare_runs(log_directory: str | Path = 'tensorboard_paper', pattern: str = '*', tag: str = REWARD_TAG,
+                 window_size: int = WINDOW_SIZE,
+                 agent_pattern: str = AGENT_PATTERN) -> tuple[pd.DataFrame, pd.DataFrame]:
+    # learning results of every run and, over the runs (seeds, repetitions) of the same agent, their mean and std
+    rows = []
+    for run_directory in sorted(glob.glob(str(Path(log_directory, pattern)))):
+        if not Path(run_directory).is_dir():
+            continue
+        run = Path(run_directory).name
+        data = read_scalars(run_directory, tag)
+        if data.empty:
+            continue
+        agent = re.match(agent_pattern, run).group('agent')
+        rows.append({'run': run, 'agent': agent, 'transfer': agent.startswith('trans'),
+                     **learning_results(data, window_size)})
+    runs = pd.DataFrame(rows)
+    if runs.empty:
+        return runs, runs
+    metrics = ['steps', 'mean', 'variance', 'mvr', 'rate', 'final_reward']
+    agents = runs.groupby(['agent', 'transfer'])[metrics].agg(['mean', 'std'])
+    agents.columns = [f'{metric}_{statistic}' for metric, statistic in agents.columns]
+    agents.insert(0, 'runs', runs.groupby(['agent', 'transfer']).size())
+    return runs, agents
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--logs', type=Path, default=Path('tensorboard_paper'))
+    parser.add_argument('--pattern', default='*', help="glob of the run directories, e.g. 'trans*'")
+    parser.add_argument('--tag', default=REWARD_TAG)
+    parser.add_argument('--window-size', type=int, default=WINDOW_SIZE)
+    parser.add_argument('--output', type=Path, default=None, help='json of the results per run and per agent')
+    args = parser.parse_args()
+
+    runs, agents = compare_runs(args.logs, args.pattern, args.tag, args.window_size)
+    with pd.option_context('display.max_rows', None, 'display.width', 200, 'display.float_format', '{:0.2e}'.format):
+        print(runs.to_string(index=False))
+        print(agents)
+    if args.output:
+        with open(args.output, 'w') as json_file:
+            json.dump({'runs': runs.to_dict('records'),
+                       'agents': agents.reset_index().to_dict('records') if not agents.empty else []},
+                      json_file, indent=4, default=str)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,46 @@
+from pathlib import Path
+
+import numpy as np
+
+ACTIVATIONS = {
+    'Tanh': np.tanh,
+    'ReLU': lambda x: np.maximum(x, 0),
+    'ELU': lambda x: np.where(x > 0, x, np.expm1(np.minimum(x, 0))),
+    'Identity': lambda x: x,
+}
+
+
+class NumpyPolicy:
+    # Deterministic actions of an exported A2C MlpPolicy (see export_policy.py) with plain NumPy: the policy MLP and the
+    # action net are a few matrix products, so neither torch, gymnasium nor stable-baselines3 have to be imported.
+    # load() checks the actions against the ones the original model chose for the recorded observations.
+
+    def __init__(self, weights: list[np.ndarray], biases: list[np.ndarray], activations: list[str]):
+        self.weights = weights
+        self.biases = biases
+        self.activations = [ACTIVATIONS[activation] for activation in activations]
+
+    @classmethod
+    def load(cls, path: str | Path, verify: bool = True) -> 'NumpyPolicy':
+        with np.load(path) as artifact:
+            layers = int(artifact['layers'])
+            policy = cls([artifact[f'weight_{i}'] for i in range(layers)],
+                         [artifact[f'bias_{i}'] for i in range(layers)],
+                         [str(activation) for activation in artifact['activations']])
+            if verify:
+                policy.verify(artifact['observations'], artifact['actions'])
+        return policy
+
+    def act(self, obs: np.ndarray) -> np.ndarray | int:
+        x = np.asarray(obs, dtype=np.float32)
+        single = x.ndim == 1
+        for weight, bias, activation in zip(self.weights, self.biases, self.activations):
+            x = activation(x @ weight + bias)
+        actions = x.argmax(axis=-1)
+        return int(actions) if single else actions
+
+    def verify(self, observations: np.ndarray, actions: np.ndarray):
+        mismatches = np.flatnonzero(self.act(observations) != actions)
+        if mismatches.size:
+            raise ValueError(f"Exported policy disagrees with the original model on {mismatches.size} of "
+                             f"{len(actions)} recorded observations (first at {mismatches[0]})")
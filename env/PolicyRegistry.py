@@ -0,0 +1,31 @@
+from pathlib import Path
+
+import numpy as np
+from stable_baselines3 import A2C
+
+
+class PolicyRegistry:
+    # Loads every agent zip once per process and keeps it for all later episodes. predict() accepts a single or a
+    # stacked batch of observations, so lockstep environments share one forward pass.
+
+    def __init__(self, model_class=A2C, device: str = 'cpu'):
+        self.model_class = model_class
+        self.device = device
+        self.models = {}
+
+    def get(self, model_path: str | Path) -> A2C:
+        model_path = str(model_path)
+        if model_path not in self.models:
+            self.models[model_path] = self.model_class.load(model_path, device=self.device)
+        return self.models[model_path]
+
+    def predict(self, model_path: str | Path, observations: np.ndarray, deterministic: bool = True) -> np.ndarray:
+        actions, _state = self.get(model_path).predict(observations, deterministic=deterministic)
+        return actions
+
+    def clear(self):
+        self.models.clear()
+
+
+# shared registry of the current process
+policies = PolicyRegistry()
@@ -0,0 +1,39 @@
+from pathlib import Path
+
+import numpy as np
+
+from NumpyPolicy import NumpyPolicy
+from PolicyRegistry import policies
+
+
+class SharedSignalPolicy:
+    # Controls all traffic signals of a multi-agent environment with one agent trained on a single junction. The
+    # observations of the signals that act in a step are stacked into a preallocated batch and all their actions come
+    # from one forward pass, with the agent zip (PolicyRegistry) or its NumPy export (.npz, see export_policy.py).
+
+    def __init__(self, model_path: str | Path, ts_ids: list[str], observation_size: int):
+        self.model_path = str(model_path)
+        self.numpy_policy = NumpyPolicy.load(model_path) if Path(model_path).suffix == '.npz' else None
+        if self.numpy_policy is None:
+            policies.get(model_path)
+        self.ts_ids = list(ts_ids)
+        self.batch = np.zeros((len(self.ts_ids), observation_size), dtype=np.float32)
+
+    @classmethod
+    def for_env(cls, model_path: str | Path, env) -> 'SharedSignalPolicy':
+        observation_sizes = {env.observation_spaces(ts).shape[0] for ts in env.ts_ids}
+        if len(observation_sizes) != 1:
+            raise ValueError(f"A shared policy needs one observation size for all signals, got {observation_sizes}")
+        return cls(model_path, env.ts_ids, observation_sizes.pop())
+
+    def predict(self, observations: np.ndarray) -> np.ndarray:
+        if self.numpy_policy is not None:
+            return self.numpy_policy.act(observations)
+        return policies.predict(self.model_path, observations)
+
+    def act(self, observations: dict[str, np.ndarray]) -> dict[str, int]:
+        ts_ids = [ts for ts in self.ts_ids if ts in observations]
+        batch = self.batch[:len(ts_ids)]
+        for i, ts in enumerate(ts_ids):
+            batch[i] = observations[ts]
+        return dict(zip(ts_ids, self.predict(batch).tolist()))
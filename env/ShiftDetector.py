@@ -0,0 +1,157 @@
+import math
+import time
+from typing import Callable
+
+import numpy as np
+from sumo_rl import SumoEnvironment
+
+from EpisodeMetricsCollector import EpisodeMetricsCollector
+
+# per-step signals of the monitor: lane density, queue and vehicle speed from the FrictionObservationFunction vector and
+# the emergency braking / collision counts of the step
+FEATURES = ('density', 'queue', 'vehicle_speed', 'emergency_braking', 'collisions')
+
+
+def observation_features(obs: np.ndarray, num_green_phases: int) -> np.ndarray:
+    # phase one-hot, min_green, then density, queue, friction and mean speed per lane. The friction entries are the
+    # configured lane parameter, not a measurement, so the monitor does not look at them. Empty lanes report their
+    # speed limit as mean speed, so the speed is weighted by density (NaN while no vehicle is on the lanes).
+    lanes = (len(obs) - num_green_phases - 1) // 4
+    start = num_green_phases + 1
+    density = obs[start:start + lanes]
+    speeds = obs[start + 3 * lanes:start + 4 * lanes]
+    total_density = density.sum()
+    return np.array([
+        density.mean(),
+        obs[start + lanes:start + 2 * lanes].mean(),
+        density @ speeds / total_density if total_density > 0 else np.nan,
+    ])
+
+
+class ShiftDetector:
+    # Online detection of a changed friction/speed regime from the per-step signals, in constant memory. Steps are
+    # averaged in blocks of block_size (about a signal cycle, which takes out most of the autocorrelation of queues and
+    # speeds). The first burn_in_blocks of a regime are skipped (the network fills up after a reset, traffic settles
+    # after a shift), the next warmup_blocks give its reference mean and variance (Welford), and every later block
+    # feeds a two-sided CUSUM per feature on the standardized block mean. A CUSUM above threshold emits an adaptation
+    # event to the listeners and the detector learns the new regime as its reference. A shift of delta
+    # reference standard deviations is detected after about threshold / (|delta| - drift) blocks.
+
+    def __init__(self, block_size: int = 30, burn_in_blocks: int = 10, warmup_blocks: int = 10, drift: float = 0.5,
+                 threshold: float = 12.0, min_std: float = 0.1):
+        self.block_size = block_size
+        self.burn_in_blocks = burn_in_blocks
+        self.warmup_blocks = warmup_blocks
+        self.drift = drift
+        self.threshold = threshold
+        self.min_std = min_std
+        self.listeners = []
+        self.events = []
+        self.step = 0
+        self.restart()
+
+    def restart(self):
+        d = len(FEATURES)
+        self.block_sum = np.zeros(d)
+        self.block_count = np.zeros(d)
+        self.block_steps = 0
+        self.blocks = 0
+        self.reference_mean = np.zeros(d)
+        self.reference_m2 = np.zeros(d)
+        self.reference_std = None
+        self.upper = np.zeros(d)
+        self.lower = np.zeros(d)
+
+    def subscribe(self, listener: Callable[[dict], None]):
+        self.listeners.append(listener)
+
+    def update(self, values: np.ndarray, sim_time: float = None) -> dict | None:
+        # values in the order of FEATURES (NaN where undefined), returns the adaptation event of this step if any
+        self.step += 1
+        defined = ~np.isnan(values)
+        self.block_sum[defined] += values[defined]
+        self.block_count += defined
+        self.block_steps += 1
+        if self.block_steps < self.block_size:
+            return None
+        with np.errstate(invalid='ignore'):
+            block_mean = self.block_sum / self.block_count
+        # a feature without a value in the whole block keeps the reference
+        block_mean = np.where(self.block_count > 0, block_mean, self.reference_mean)
+        self.block_sum[:] = 0.0
+        self.block_count[:] = 0.0
+        self.block_steps = 0
+        self.blocks += 1
+
+        warmup_block = self.blocks - self.burn_in_blocks
+        if warmup_block <= 0:
+            return None
+        if warmup_block <= self.warmup_blocks:
+            delta = block_mean - self.reference_mean
+            self.reference_mean += delta / warmup_block
+            self.reference_m2 += delta * (block_mean - self.reference_mean)
+            if warmup_block == self.warmup_blocks:
+                variance = self.reference_m2 / max(self.warmup_blocks - 1, 1)
+                self.reference_std = np.maximum(np.sqrt(variance), self.min_std)
+            return None
+
+        z = (block_mean - self.reference_mean) / self.reference_std
+        np.maximum(0.0, self.upper + z - self.drift, out=self.upper)
+        np.maximum(0.0, self.lower - z - self.drift, out=self.lower)
+        statistics = np.maximum(self.upper, self.lower)
+        feature = int(statistics.argmax())
+        if statistics[feature] <= self.threshold:
+            return None
+
+        event = {
+            'step': self.step,
+            'time': sim_time,
+            'feature': FEATURES[feature],
+            'direction': 'increase' if self.upper[feature] >= self.lower[feature] else 'decrease',
+            'statistic': float(statistics[feature]),
+            'reference_mean': float(self.reference_mean[feature]),
+            'block_mean': float(block_mean[feature]),
+            'features': {name: float(z[i]) for i, name in enumerate(FEATURES)},
+        }
+        self.events.append(event)
+        for listener in self.listeners:
+            listener(event)
+        self.restart()
+        return event
+
+    def detection_bound(self, shift: float) -> float:
+        # steps until a sustained shift of `shift` reference standard deviations is detected (CUSUM approximation)
+        if abs(shift) <= self.drift:
+            return math.inf
+        return self.block_size * (math.ceil(self.threshold / (abs(shift) - self.drift)) + 1)
+
+
+class ShiftMonitor:
+    # Feeds a ShiftDetector from a running SumoEnvironment: wraps env.step like the EnvironmentProfiler and reads the
+    # emergency braking of the step from an attached EpisodeMetricsCollector (if there is one).
+
+    def __init__(self, detector: ShiftDetector, metrics: EpisodeMetricsCollector = None):
+        self.detector = detector
+        self.metrics = metrics
+        self.overhead = 0.0
+        self.steps = 0
+
+    def attach(self, env: SumoEnvironment):
+        env.shift_monitor = self
+        step = env.step
+        num_green_phases = env.traffic_signals[env.ts_ids[0]].num_green_phases
+        self.last_braking = self.metrics.emergency_braking if self.metrics else 0
+
+        def monitored_step(action):
+            obs, reward, terminated, truncated, info = step(action)
+            start = time.perf_counter()
+            braking = self.metrics.emergency_braking if self.metrics else 0
+            values = np.append(observation_features(obs, num_green_phases),
+                               [braking - self.last_braking, len(env.sumo.simulation.getCollisions())])
+            self.last_braking = braking
+            self.detector.update(values, env.sim_step)
+            self.overhead += time.perf_counter() - start
+            self.steps += 1
+            return obs, reward, terminated, truncated, info
+
+        env.step = monitored_step
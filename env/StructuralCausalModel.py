@@ -0,0 +1,143 @@
+import argparse
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+
+class StructuralCausalModel:
+    # Linear SCM over a learned DAG, compiled into a weight matrix (weights[parent, node]), intercepts and the residual
+    # scales of every equation. A query is one pass over the nodes in topological order, each a matrix-vector product
+    # over the whole batch, so thousands of do()-settings cost about as much as one. Exogenous noise is zero for
+    # expected values, abducted from observations for counterfactuals or drawn for samples.
+
+    def __init__(self, nodes: list[str], order: list[int], weights: np.ndarray, intercepts: np.ndarray,
+                 scales: np.ndarray):
+        self.nodes = list(nodes)
+        self.index = {node: i for i, node in enumerate(self.nodes)}
+        self.order = list(order)
+        self.weights = weights
+        self.intercepts = intercepts
+        self.scales = scales
+
+    @classmethod
+    def fit(cls, data: pd.DataFrame, edges: list[tuple[str, str]]) -> 'StructuralCausalModel':
+        # least squares per node on its parents, nodes without parents are their mean plus noise
+        nodes = list(data.columns)
+        index = {node: i for i, node in enumerate(nodes)}
+        values = data[nodes].to_numpy(dtype=np.float64)
+        d = len(nodes)
+        weights = np.zeros((d, d))
+        intercepts = np.zeros(d)
+        scales = np.zeros(d)
+        parents = {i: [index[source] for source, target in edges if index[target] == i] for i in range(d)}
+        for i in range(d):
+            design = np.column_stack([np.ones(len(values)), values[:, parents[i]]])
+            coefficients, *_ = np.linalg.lstsq(design, values[:, i], rcond=None)
+            intercepts[i] = coefficients[0]
+            weights[parents[i], i] = coefficients[1:]
+            scales[i] = np.std(values[:, i] - design @ coefficients)
+        return cls(nodes, topological_order(d, [(index[source], index[target]) for source, target in edges]),
+                   weights, intercepts, scales)
+
+    def _propagate(self, interventions: dict, noise: np.ndarray | None, batch_size: int) -> np.ndarray:
+        values = np.empty((batch_size, len(self.nodes)))
+        values[:] = self.intercepts if noise is None else self.intercepts + noise
+        intervened = {self.index[node]: value for node, value in interventions.items()}
+        for i in self.order:
+            if i in intervened:
+                values[:, i] = intervened[i]
+            elif self.weights[:, i].any():
+                values[:, i] += values @ self.weights[:, i]
+        return values
+
+    def do(self, interventions: dict[str, float | np.ndarray] | pd.DataFrame,
+           noise: np.ndarray = None) -> pd.DataFrame:
+        # expected values of all variables under do(interventions), one row per setting, e.g.
+        # scm.do({'desiredSpeed': 22.22, 'friction': np.linspace(0.1, 1, 1000)})
+        interventions = {node: np.asarray(value, dtype=np.float64) for node, value in dict(interventions).items()}
+        sizes = [value.size for value in interventions.values()] + ([len(noise)] if noise is not None else [])
+        batch_size = max(sizes, default=1)
+        return pd.DataFrame(self._propagate(interventions, noise, batch_size), columns=self.nodes)
+
+    def abduct(self, observations: pd.DataFrame) -> np.ndarray:
+        # exogenous noise that reproduces the observations: the residual of every equation
+        values = observations[self.nodes].to_numpy(dtype=np.float64)
+        return values - self.intercepts - values @ self.weights
+
+    def counterfactual(self, observations: pd.DataFrame,
+                       interventions: dict[str, float | np.ndarray] | pd.DataFrame) -> pd.DataFrame:
+        # what every observed row would have been under do(interventions), keeping its noise
+        return self.do(interventions, noise=self.abduct(observations))
+
+    def sample(self, interventions: dict[str, float | np.ndarray] | pd.DataFrame, samples: int = 1,
+               rng: np.random.Generator = None) -> pd.DataFrame:
+        # draws of the interventional distribution with Gaussian noise of the residual scales
+        rng = rng or np.random.default_rng()
+        return self.do(interventions, noise=rng.normal(size=(samples, len(self.nodes))) * self.scales)
+
+    def save(self, path: str | Path):
+        with open(path, 'wb') as file:
+            np.savez(file, nodes=np.array(self.nodes), order=np.array(self.order), weights=self.weights,
+                     intercepts=self.intercepts, scales=self.scales)
+
+    @classmethod
+    def load(cls, path: str | Path) -> 'StructuralCausalModel':
+        with np.load(path) as artifact:
+            return cls([str(node) for node in artifact['nodes']], artifact['order'].tolist(), artifact['weights'],
+                       artifact['intercepts'], artifact['scales'])
+
+    def equations(self) -> list[str]:
+        return [f"{self.nodes[i]} = {self.intercepts[i]:.4g}" + ''.join(
+            f" + {self.weights[j, i]:.4g} * {self.nodes[j]}" for j in np.flatnonzero(self.weights[:, i]))
+            + f" + N(0, {self.scales[i]:.4g})" for i in self.order]
+
+
+def topological_order(d: int, edges: list[tuple[int, int]]) -> list[int]:
+    in_degree = np.zeros(d, dtype=int)
+    for _source, target in edges:
+        in_degree[target] += 1
+    order = [i for i in range(d) if in_degree[i] == 0]
+    for i in order:
+        for source, target in edges:
+            if source == i:
+                in_degree[target] -= 1
+                if in_degree[target] == 0:
+                    order.append(target)
+    if len(order) < d:
+        raise ValueError("The causal graph has a cycle (or an undirected edge given in both directions)")
+    return order
+
+
+def main():
+    from CausalDiscovery import load_data
+    from EdgeOrientation import learned_edges
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('data', type=Path, help='data.csv of SumoTraceAggregator or a SumoTraceStore directory')
+    parser.add_argument('--edges', type=Path, default=None,
+                        help='csv with source and target columns of the directed edges (default: PC on the data)')
+    parser.add_argument('--output', type=Path, default=Path('scm.npz'))
+    parser.add_argument('--speed', type=float, default=22.22)
+    parser.add_argument('--friction', type=float, default=0.5)
+    args = parser.parse_args()
+
+    data = load_data(args.data)
+    if args.edges:
+        edges = list(pd.read_csv(args.edges)[['source', 'target']].itertuples(index=False, name=None))
+    else:
+        edges = learned_edges(data)
+    StructuralCausalModel.fit(data, edges).save(args.output)
+    scm = StructuralCausalModel.load(args.output)
+    print('\n'.join(scm.equations()))
+    print(scm.do({'desiredSpeed': args.speed, 'friction': args.friction}).to_string(index=False))
+
+    frictions = np.random.default_rng(0).uniform(0.01, 1, 100_000)
+    start = time.perf_counter()
+    scm.do({'desiredSpeed': args.speed, 'friction': frictions})
+    print(f"100000 do()-queries in {(time.perf_counter() - start) * 1e3:.1f}ms")
+
+
+if __name__ == '__main__':
+    main()
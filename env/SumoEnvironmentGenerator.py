@@ -1,8 +1,18 @@
+import time
+from functools import partial
+
+import gymnasium
 import numpy as np
 from gymnasium import spaces
+from stable_baselines3.common.vec_env import SubprocVecEnv, VecMonitor
 from sumo_rl import SumoEnvironment, TrafficSignal, ObservationFunction
+from traci import constants as tc
 from pathlib import Path
 
+from EnvironmentProfiler import EnvironmentProfiler
+from TrajectoryRecorder import TrajectoryRecorder
+
+
 class SumoEnvironmentGenerator:
 
     def __init__(self, net_file: str, route_file: str, sumocfg_file: str, duration: int, learning_data_csv_name: str):
@@ -12,17 +22,61 @@ class SumoEnvironmentGenerator:
         self.duration = duration
         self.learning_data_csv_name = learning_data_csv_name
 
-    def get_training_env(self):
+    def get_training_env(self, out_csv_name: str = None, sumo_seed: int | str = 'random', profile: bool = False,
+                         observation_class: type = None):
+        env = self._get_environment(self.net_file, self.route_file, self.sumocfg_file, False, self.duration,
+                                    out_csv_name=out_csv_name or self.learning_data_csv_name, sumo_seed=sumo_seed,
+                                    observation_class=observation_class)
+        if profile:
+            EnvironmentProfiler().attach(env)
+        return env
+
+    def get_training_vec_env(self, n_envs: int, seed: int = None, profile: bool = False) -> VecMonitor:
+        # every environment runs its own SUMO (libsumo) in a spawned process and writes its own learning csv
+        csv_name = Path(self.learning_data_csv_name)
+        env_fns = [
+            partial(_make_training_env, self, str(csv_name.with_name(f'{csv_name.stem}_env{i}{csv_name.suffix}')),
+                    seed_sequence, profile)
+            for i, seed_sequence in enumerate(np.random.SeedSequence(seed).spawn(n_envs))
+        ]
+        return VecMonitor(SubprocVecEnv(env_fns, start_method='spawn'))
+
+    def get_generation_env(self, output_prefix: str, sumo_seed: int | str = 'random', xml_outputs: bool = False,
+                           profile: bool = False, record_trajectory: bool = False):
+        # the statistics/collisions/tripinfo/ssm XML outputs are opt-in, EpisodeMetricsCollector covers the summaries
+        env = self._get_environment(self.net_file, self.route_file, self.sumocfg_file, False, self.duration,
+                                    output_prefix=output_prefix if xml_outputs else '', sumo_seed=sumo_seed)
+        if profile:
+            # writes <output_prefix>_profile.json next to the other episode outputs
+            EnvironmentProfiler(output_prefix).attach(env)
+        if record_trajectory:
+            # <output_prefix>_trajectory.npy holds the reward function inputs for offline rescoring
+            TrajectoryRecorder(output_prefix + '_trajectory.npy').attach(env)
+        return env
+
+    def get_pooled_generation_env(self):
         return self._get_environment(self.net_file, self.route_file, self.sumocfg_file, False, self.duration,
-                                     out_csv_name=self.learning_data_csv_name)
+                                     environment_class=PooledSumoEnvironment)
 
-    def get_generation_env(self, output_prefix: str):
+    def get_multi_agent_env(self, out_csv_name: str = None, sumo_seed: int | str = 'random'):
+        # every traffic signal of the network is an agent, observations, rewards and actions are dicts by signal id
         return self._get_environment(self.net_file, self.route_file, self.sumocfg_file, False, self.duration,
-                                     output_prefix=output_prefix)
+                                     out_csv_name=out_csv_name, sumo_seed=sumo_seed, single_agent=False)
 
     def get_demonstration_env(self):
         return self._get_environment(self.net_file, self.route_file, self.sumocfg_file, True, self.duration)
 
+    def create_warmup_snapshot(self, snapshot_file: str, warmup: int, sumo_seed: int | str = 'random') -> str:
+        # Simulates the shared prefix of all interventions once under the default signal program. The random number
+        # generator state is saved as well, so every fork continues with the same random traffic history.
+        env = self._get_environment(self.net_file, self.route_file, self.sumocfg_file, False, self.duration,
+                                    sumo_seed=sumo_seed, additional_options='--save-state.rng true')
+        env.reset()
+        env.sumo.simulationStep(warmup)
+        env.sumo.simulation.saveState(snapshot_file)
+        env.close()
+        return snapshot_file
+
     @staticmethod
     def _reward_fn(traffic_signal: TrafficSignal) -> float:
         ts_wait = sum(traffic_signal.get_accumulated_waiting_time_per_lane()) / 100.0
@@ -72,9 +126,43 @@ class SumoEnvironmentGenerator:
         return reward
 
     @staticmethod
-    def _get_environment(net_file: str, route_file: str, sumocfg_file: str, use_gui: bool, num_seconds: int,
-                         out_csv_name: str = None, output_prefix: str = ''):
-        sumo_cmd_options = {'--configuration-file': sumocfg_file}
+    def apply_intervention(env: SumoEnvironment, speed: float = None, friction_coefficient: float = None):
+        # Revisit Friction calculation
+        vehicletype = env.sumo.vehicletype
+        if speed is not None:
+            vehicletype.setMaxSpeed('carCustom', speed)
+        if friction_coefficient is not None:
+            vehicletype.setDecel('carCustom', vehicletype.getDecel('carCustom') * friction_coefficient)
+            vehicletype.setEmergencyDecel('carCustom',
+                                          vehicletype.getEmergencyDecel('carCustom') * friction_coefficient)
+            for traffic_signal in env.traffic_signals.values():
+                for lane in traffic_signal.lanes:
+                    traffic_signal.sumo.lane.setParameter(lane, 'frictionCoefficient', str(friction_coefficient))
+                if isinstance(traffic_signal.observation_fn, BatchedFrictionObservationFunction):
+                    traffic_signal.observation_fn.refresh_static_values()
+
+    @staticmethod
+    def fork_from_snapshot(env: SumoEnvironment, snapshot_file: str) -> np.ndarray:
+        env.sumo.simulation.loadState(snapshot_file)
+        # the traffic signals were built at t=0, realign them with the restored simulation time and phase
+        for traffic_signal in env.traffic_signals.values():
+            traffic_signal.next_action_time = env.sim_step
+            traffic_signal.time_since_last_phase_change = 0
+            traffic_signal.is_yellow = False
+            traffic_signal.sumo.trafficlight.setRedYellowGreenState(
+                traffic_signal.id, traffic_signal.green_phases[traffic_signal.green_phase].state)
+        # subscription results only refresh with the next simulation step and still hold the values before the load,
+        # so the first observation queries the lanes directly
+        return FrictionObservationFunction.__call__(env.traffic_signals[env.ts_ids[0]].observation_fn)
+
+    @staticmethod
+    def _get_sumo_cmd(sumocfg_file: str, output_prefix: str = '') -> str:
+        return ' '.join(filter(None, ['--configuration-file ' + sumocfg_file,
+                                      SumoEnvironmentGenerator._get_output_cmd(output_prefix)]))
+
+    @staticmethod
+    def _get_output_cmd(output_prefix: str = '') -> str:
+        sumo_cmd_options = {}
         if output_prefix:
             # sumo_cmd_options['--output-prefix'] = output_prefix + '_'
             sumo_cmd_options['--statistic-output'] = output_prefix + '_statistics.xml'
@@ -84,14 +172,20 @@ class SumoEnvironmentGenerator:
             sumo_cmd_options['--device.ssm.file'] = str(Path(output_prefix + '_ssm.xml').absolute())
             sumo_cmd_options['--device.ssm.measures'] = "BR"
 
+        return ' '.join(key + " " + value for key, value in sumo_cmd_options.items())
+
+    @staticmethod
+    def _get_environment(net_file: str, route_file: str, sumocfg_file: str, use_gui: bool, num_seconds: int,
+                         out_csv_name: str = None, output_prefix: str = '', sumo_seed: int | str = 'random',
+                         environment_class: type = SumoEnvironment, additional_options: str = '',
+                         single_agent: bool = True, observation_class: type = None):
         if use_gui:
             sumo_seed = '42'
-        else:
-            sumo_seed = 'random'
 
-        sumo_cmd = ' '.join(key + " " + value for key, value in sumo_cmd_options.items())
+        sumo_cmd = ' '.join(filter(None, [SumoEnvironmentGenerator._get_sumo_cmd(sumocfg_file, output_prefix),
+                                          additional_options]))
 
-        env: SumoEnvironment = SumoEnvironment(
+        env: SumoEnvironment = environment_class(
             net_file=net_file,
             route_file=route_file,
             out_csv_name=out_csv_name,
@@ -101,11 +195,12 @@ class SumoEnvironmentGenerator:
             delta_time=1,  # seconds between actions
             yellow_time=0,  # duration of the yellow phase
             min_green=5,  # minimum green time per phase
-            single_agent=True,
+            single_agent=single_agent,
             reward_fn=SumoEnvironmentGenerator._penalty_reward_minute_static_fn,  # define reward function
-            observation_class=FrictionObservationFunction,  # subject to change
+            observation_class=observation_class or BatchedFrictionObservationFunction,  # subject to change
             add_system_info=True,
-            add_per_agent_info=True,
+            # three entries per signal and step would dominate the info of large networks
+            add_per_agent_info=single_agent,
             sumo_seed=sumo_seed,
             sumo_warnings=use_gui,  # show warnings when gui is active
             additional_sumo_cmd=sumo_cmd,
@@ -114,6 +209,92 @@ class SumoEnvironmentGenerator:
         return env
 
 
+class EpisodeSeedWrapper(gymnasium.Wrapper):
+    # draws a new SUMO seed for every episode from the environment's own seed sequence
+
+    def __init__(self, env: SumoEnvironment, seed_sequence: np.random.SeedSequence):
+        super().__init__(env)
+        self.rng = np.random.default_rng(seed_sequence)
+
+    def reset(self, seed=None, options=None):
+        return self.env.reset(seed=int(self.rng.integers(2 ** 31)), options=options)
+
+
+def _make_training_env(env_generator: SumoEnvironmentGenerator, out_csv_name: str,
+                       seed_sequence: np.random.SeedSequence, profile: bool = False) -> EpisodeSeedWrapper:
+    return EpisodeSeedWrapper(env_generator.get_training_env(out_csv_name=out_csv_name, profile=profile),
+                              seed_sequence)
+
+
+class PooledSumoEnvironment(SumoEnvironment):
+    # Keeps its SUMO instance warm across episodes: reset() reloads the simulation in place instead of paying
+    # process startup and TraCI connection setup again. Per-episode knobs are passed as reset options, e.g.
+    # env.reset(seed=42, options={'output_prefix': ..., 'desiredSpeed': ..., 'friction': ..., 'snapshot': ...})
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.base_sumo_cmd = self.additional_sumo_cmd
+        self.cold_start_time = None
+        self.warm_start_times = []
+
+    def reset(self, seed=None, options: dict = None, **kwargs):
+        options = options or {}
+        self.additional_sumo_cmd = ' '.join(filter(None, [
+            self.base_sumo_cmd, SumoEnvironmentGenerator._get_output_cmd(options.get('output_prefix', ''))]))
+        obs, info = super().reset(seed=seed, **kwargs)
+        if options.get('snapshot'):
+            obs = SumoEnvironmentGenerator.fork_from_snapshot(self, options['snapshot'])
+        SumoEnvironmentGenerator.apply_intervention(self, options.get('desiredSpeed'), options.get('friction'))
+        return obs, info
+
+    def _start_simulation(self):
+        start = time.perf_counter()
+        if getattr(self, 'sumo', None) is None:
+            super()._start_simulation()
+            self.cold_start_time = time.perf_counter() - start
+        else:
+            # loading closes the previous simulation, which flushes its statistics/tripinfo/collision outputs
+            self.sumo.load(self._get_sumo_args())
+            self.warm_start_times.append(time.perf_counter() - start)
+
+    def _get_sumo_args(self) -> list[str]:
+        # mirrors SumoEnvironment._start_simulation without the binary
+        sumo_args = [
+            "-n", self._net,
+            "-r", self._route,
+            "--max-depart-delay", str(self.max_depart_delay),
+            "--waiting-time-memory", str(self.waiting_time_memory),
+            "--time-to-teleport", str(self.time_to_teleport),
+        ]
+        if self.begin_time > 0:
+            sumo_args.append(f"-b {self.begin_time}")
+        if self.sumo_seed == "random":
+            sumo_args.append("--random")
+        else:
+            sumo_args.extend(["--seed", str(self.sumo_seed)])
+        if not self.sumo_warnings:
+            sumo_args.append("--no-warnings")
+        if self.additional_sumo_cmd is not None:
+            sumo_args.extend(self.additional_sumo_cmd.split())
+        return sumo_args
+
+    def startup_savings(self) -> float:
+        # seconds of simulator startup saved per reloaded episode
+        if self.cold_start_time is None or not self.warm_start_times:
+            return 0.0
+        return self.cold_start_time - float(np.mean(self.warm_start_times))
+
+    def close(self):
+        # the simulator stays alive between episodes, shutdown() terminates it
+        pass
+
+    def shutdown(self):
+        super().close()
+
+    def __del__(self):
+        self.shutdown()
+
+
 class FrictionObservationFunction(ObservationFunction):
 
     def __call__(self) -> np.ndarray:
@@ -135,3 +316,72 @@ class FrictionObservationFunction(ObservationFunction):
             low=np.zeros(self.ts.num_green_phases + 1 + 4 * len(self.ts.lanes), dtype=np.float32),
             high=np.ones(self.ts.num_green_phases + 1 + 4 * len(self.ts.lanes), dtype=np.float32),
         )
+
+
+class BatchedFrictionObservationFunction(FrictionObservationFunction):
+    # Same vector as FrictionObservationFunction, but all lane values arrive in one subscription batch per step,
+    # the per-episode lane friction is cached and the observation is written into a preallocated float32 buffer. The
+    # subscription results are fetched once per simulation step and shared by all traffic signals of the network.
+
+    LANE_VARIABLES = (tc.LAST_STEP_VEHICLE_NUMBER, tc.LAST_STEP_VEHICLE_HALTING_NUMBER, tc.LAST_STEP_LENGTH,
+                      tc.LAST_STEP_MEAN_SPEED)
+
+    def __init__(self, ts: TrafficSignal):
+        super().__init__(ts)
+        # the traffic signal builds its lanes after the observation function, so the buffers are set up lazily
+        self.observation = None
+
+    def _setup(self):
+        num_phases = self.ts.num_green_phases
+        num_lanes = len(self.ts.lanes)
+        self.observation = np.zeros(num_phases + 1 + 4 * num_lanes, dtype=np.float32)
+        self.phase_id = self.observation[:num_phases]
+        self.density = self.observation[num_phases + 1:num_phases + 1 + num_lanes]
+        self.queue = self.observation[num_phases + 1 + num_lanes:num_phases + 1 + 2 * num_lanes]
+        self.lane_friction = self.observation[num_phases + 1 + 2 * num_lanes:num_phases + 1 + 3 * num_lanes]
+        self.lane_mean_speeds = self.observation[num_phases + 1 + 3 * num_lanes:]
+        self.lane_values = np.zeros((len(self.LANE_VARIABLES), num_lanes), dtype=np.float64)
+        self.lanes_length = np.array([self.ts.lanes_length[lane] for lane in self.ts.lanes], dtype=np.float64)
+        self._subscribe()
+        self.refresh_static_values()
+
+    def _subscribe(self):
+        for lane in self.ts.lanes:
+            self.ts.sumo.lane.subscribe(lane, self.LANE_VARIABLES)
+
+    def refresh_static_values(self):
+        # friction only changes through interventions, which call this after setting the lane parameter
+        if self.observation is None:
+            return
+        self.lane_friction[:] = [float(self.ts.sumo.lane.getParameter(lane, 'frictionCoefficient'))
+                                 for lane in self.ts.lanes]
+
+    def __call__(self) -> np.ndarray:
+        if self.observation is None:
+            self._setup()
+
+        env = self.ts.env
+        step, results = getattr(env, 'lane_subscription_results', (None, None))
+        if step != env.sim_step or self.ts.lanes[0] not in results:
+            results = self.ts.sumo.lane.getAllSubscriptionResults()
+            if self.ts.lanes[0] not in results:
+                # a reloaded simulation drops all subscriptions
+                self._subscribe()
+                results = self.ts.sumo.lane.getAllSubscriptionResults()
+            env.lane_subscription_results = (env.sim_step, results)
+        for i, lane in enumerate(self.ts.lanes):
+            lane_results = results[lane]
+            for j, variable in enumerate(self.LANE_VARIABLES):
+                self.lane_values[j, i] = lane_results[variable]
+        vehicle_numbers, halting_numbers, vehicle_lengths, mean_speeds = self.lane_values
+
+        self.phase_id[:] = 0
+        self.phase_id[self.ts.green_phase] = 1
+        self.observation[self.ts.num_green_phases] = \
+            0 if self.ts.time_since_last_phase_change < self.ts.min_green + self.ts.yellow_time else 1
+        lane_capacity = self.lanes_length / (self.ts.MIN_GAP + vehicle_lengths)
+        np.minimum(1, vehicle_numbers / lane_capacity, out=self.density)
+        np.minimum(1, halting_numbers / lane_capacity, out=self.queue)
+        self.lane_mean_speeds[:] = mean_speeds
+        # sumo_rl hands out copies of the observation, so the buffer can be reused for the next step
+        return self.observation
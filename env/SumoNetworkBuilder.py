@@ -0,0 +1,369 @@
+import copy
+import hashlib
+import json
+import math
+import os
+import shutil
+import subprocess
+import sys
+import uuid
+import xml.etree.ElementTree as ET
+from pathlib import Path
+
+CONFIG_SUFFIXES = ('.netccfg', '.duarcfg', '.sumocfg')
+# part of the cache key, increased whenever _build changes what it writes
+BUILD_VERSION = 2
+# the edges findAllRoutes starts and ends the routes of the template junction at
+ROUTE_SOURCES = ('southJunction', 'westJunction')
+ROUTE_TARGETS = ('junctionEast', 'junctionNorth')
+# grid offsets (row, column) of the neighbour on each side of a junction
+SIDES = {'west': (0, -1), 'east': (0, 1), 'south': (-1, 0), 'north': (1, 0)}
+OPPOSITE = {'west': 'east', 'east': 'west', 'south': 'north', 'north': 'south'}
+
+
+class SumoNetworkBuilder:
+    # Builds the SUMO network and route files of a net config directory (netconvert, findAllRoutes, duarouter,
+    # vehicle2flow and the friction / vehicle type / flow updates) into a cache directory keyed by a hash of the
+    # input configs and the parameters. Cache hits do no work and the source tree is never modified, so sweeps with
+    # different parameters can build and run in parallel.
+
+    def __init__(self, config_directory: Path, net_name: str, cache_directory: Path = Path('cache', 'networks'),
+                 sumo_home: str = None):
+        self.config_directory = Path(config_directory)
+        self.net_name = net_name
+        self.cache_directory = Path(cache_directory)
+        self.sumo_home = sumo_home or os.environ.get('SUMO_HOME')
+        if not self.sumo_home:
+            raise EnvironmentError(
+                "SUMO_HOME environment variable is not set. Please set it to your SUMO installation directory.")
+
+    def build(self, insert_probability: float, duration: int, repeat_period: int, friction: float = 1.0,
+              speed: float = None, default_decel: float = 4.5, default_emergency_decel: float = 9.0,
+              bottom_insert_factor: float = 1.0) -> dict[str, Path]:
+        # without a speed the vehicle types of the vconfig are kept as they are
+        parameters = {
+            'friction': friction,
+            'speed': speed,
+            'insert_probability': insert_probability,
+            'duration': duration,
+            'repeat_period': repeat_period,
+            'default_decel': default_decel,
+            'default_emergency_decel': default_emergency_decel,
+            'bottom_insert_factor': bottom_insert_factor,
+        }
+        build_directory = self.cache_directory.joinpath(self.cache_key(parameters))
+        if build_directory.exists():
+            return self.network_files(build_directory)
+
+        temporary_directory = self.cache_directory.joinpath(f'.{build_directory.name}.{uuid.uuid4().hex}.tmp')
+        try:
+            for input_file in self.input_files():
+                target = temporary_directory.joinpath(input_file.relative_to(self.config_directory))
+                target.parent.mkdir(parents=True, exist_ok=True)
+                shutil.copy2(input_file, target)
+            self._build(temporary_directory, parameters)
+            temporary_directory.joinpath('parameters.json').write_text(json.dumps(parameters, indent=4))
+            try:
+                temporary_directory.rename(build_directory)
+            except OSError:
+                # a concurrent job finished the same build first
+                if not build_directory.exists():
+                    raise
+        finally:
+            shutil.rmtree(temporary_directory, ignore_errors=True)
+
+        return self.network_files(build_directory)
+
+    def input_files(self) -> list[Path]:
+        # the config subdirectories and the tool configurations, not the generated network/route files
+        return sorted(path for path in self.config_directory.rglob('*') if path.is_file() and (
+                path.parent != self.config_directory or path.suffix in CONFIG_SUFFIXES))
+
+    def cache_key(self, parameters: dict) -> str:
+        digest = hashlib.sha256()
+        for input_file in self.input_files():
+            digest.update(str(input_file.relative_to(self.config_directory)).encode())
+            digest.update(input_file.read_bytes())
+        digest.update(json.dumps(parameters, sort_keys=True).encode())
+        digest.update(str(self.sumo_home).encode())
+        digest.update(str(BUILD_VERSION).encode())
+        return digest.hexdigest()[:16]
+
+    def network_files(self, build_directory: Path) -> dict[str, Path]:
+        return {
+            'directory': build_directory,
+            'net.xml': build_directory.joinpath(f'{self.net_name}.net.xml'),
+            'rou.xml': build_directory.joinpath(f'{self.net_name}.rou.xml'),
+            'sumocfg': build_directory.joinpath(f'{self.net_name}.sumocfg'),
+        }
+
+    def _build(self, directory: Path, parameters: dict):
+        vehicle2flow = Path(self.sumo_home, 'tools', 'route', 'vehicle2flow.py')
+        net_name = self.net_name
+
+        update_friction_coefficients(directory.joinpath('netconfig', 'edges.edg.xml'), parameters['friction'])
+        remove_random_seeding(directory.joinpath(f'{net_name}.sumocfg'))
+        run_command(f"netconvert --configuration-file {net_name}.netccfg", directory)
+        self._build_routes(directory)
+        run_command(f"duarouter --configuration-file {net_name}.duarcfg", directory)
+        run_command(f"{sys.executable} {vehicle2flow} config.rou.xml -o {net_name}.rou.xml "
+                    f"-e {parameters['duration']} -r {parameters['repeat_period']}", directory)
+        if parameters['speed'] is not None:
+            update_vehicle_type_parameters(directory.joinpath(f'{net_name}.rou.xml'), parameters['speed'],
+                                           parameters['default_decel'], parameters['default_emergency_decel'],
+                                           parameters['friction'])
+        update_flows(directory.joinpath(f'{net_name}.rou.xml'), parameters['insert_probability'],
+                     parameters['bottom_insert_factor'])
+
+    def _build_routes(self, directory: Path):
+        findAllRoutes = Path(self.sumo_home, 'tools', 'findAllRoutes.py')
+        run_command(f"{sys.executable} {findAllRoutes} -n {self.net_name}.net.xml -o routes.rou.xml "
+                    f"-s {','.join(ROUTE_SOURCES)} -t {','.join(ROUTE_TARGETS)}", directory)
+
+
+class SumoGridNetworkBuilder(SumoNetworkBuilder):
+    # Tiles the junction of a net config into a grid of rows x columns signalized junctions (a corridor for one row)
+    # before the usual build. Every junction gets its own traffic light program and the lanes of the template, so an
+    # agent trained on the template observes every junction of the grid the same way. Through traffic (west-east,
+    # south-north) enters once per row/column at the fringe and crosses the whole grid, turning traffic is generated
+    # at every junction on its incoming edge and leaves the grid straight after the turn.
+
+    def __init__(self, config_directory: Path, net_name: str, rows: int, columns: int,
+                 cache_directory: Path = Path('cache', 'networks'), sumo_home: str = None):
+        super().__init__(config_directory, net_name, cache_directory, sumo_home)
+        if rows < 1 or columns < 1:
+            raise ValueError(f"A grid needs at least one row and column, got {rows} x {columns}")
+        self.rows = rows
+        self.columns = columns
+
+    def cache_key(self, parameters: dict) -> str:
+        return super().cache_key({**parameters, 'grid': [self.rows, self.columns]})
+
+    def _build(self, directory: Path, parameters: dict):
+        self.template = tile_network(directory.joinpath('netconfig'), self.rows, self.columns)
+        super()._build(directory, parameters)
+
+    def _build_routes(self, directory: Path):
+        # findAllRoutes would enumerate every path through the grid, the tiled routes are written directly instead
+        tile_vehicles(directory.joinpath('vconfig', 'vehicles.rou.xml'), directory.joinpath('routes.rou.xml'),
+                      self.template, self.rows, self.columns)
+
+
+# Execute SUMO Tools using subprocess
+def run_command(command, cwd: Path = None):
+    result = subprocess.run(command, shell=True, text=True, capture_output=True, cwd=cwd)
+    if result.returncode != 0:
+        raise RuntimeError(f"Command failed: {command}\n{result.stderr}")
+    print(result.stdout)
+
+
+# Drop <random value="true"/> from the SUMO Configuration: it seeds SUMO from the system time and overrides --seed,
+# sumo_rl passes --random itself when no seed is given
+def remove_random_seeding(file_path):
+    tree = ET.parse(file_path)
+    root = tree.getroot()
+    for random_number in root.findall('random_number'):
+        for random in random_number.findall('random'):
+            random_number.remove(random)
+        if len(random_number) == 0:
+            root.remove(random_number)
+    tree.write(file_path, xml_declaration=True, encoding='UTF-8')
+
+
+# Update Friction Coefficients in Edge Configuration
+def update_friction_coefficients(file_path, friction):
+    tree = ET.parse(file_path)
+    root = tree.getroot()
+    for param in root.findall(".//lane/param[@key='frictionCoefficient']"):
+        param.set('value', str(friction))
+    tree.write(file_path)
+
+
+# Update Vehicle Configuration for Friction Adjusted Braking Distance
+def update_vehicle_type_parameters(file_path, speed, default_decel, default_emergency_decel, friction):
+    tree = ET.parse(file_path)
+    root = tree.getroot()
+    for vType in root.findall('vType'):
+        vClass = vType.attrib.get('vClass')
+        if vClass and vClass != 'passenger':
+            raise NotImplementedError("Check for non-passenger vehicle classes not implemented")
+        vType.attrib.update({
+            'maxSpeed': str(speed),
+            'decel': str(default_decel * friction),
+            'emergencyDecel': str(default_emergency_decel * friction),
+        })
+    tree.write(file_path, xml_declaration=True, encoding='UTF-8')
+
+
+# Update Vehicle Flows for Forcing Unprotected Right Action
+def update_flows(file_path, insert_probability, bottom_insert_factor=1.0):
+    tree = ET.parse(file_path)
+    root = tree.getroot()
+    for flow in root.findall('flow'):
+        # flows of tiled networks carry the template id with a grid suffix
+        match flow.attrib.get('id').split('_')[0]:
+            case 'southEast':
+                flow.set('period', f"exp({insert_probability})")
+            case 'southNorth':
+                flow.set('period', f"exp({insert_probability})")
+            case 'westEastTop':
+                flow.set('period', f"exp({2 * insert_probability})")
+            case id if 'westEastBottom' in id:
+                flow.set('end', str(float(flow.get('begin')) + 600))
+                if float(flow.get('begin')) % 1200 == 0:
+                    flow.set('period', f"exp({bottom_insert_factor * insert_probability})")
+                else:
+                    flow.set('period', f"exp({0.0001 * insert_probability})")
+    tree.write(file_path, xml_declaration=True, encoding='UTF-8')
+
+
+def grid_suffix(row: int, column: int) -> str:
+    return f'_r{row}c{column}'
+
+
+def tile_network(netconfig_directory: Path, rows: int, columns: int) -> dict:
+    # Replaces the nodes, edges, connections and traffic light programs of a single junction net config with a grid of
+    # copies. The incoming edge of a junction is also the outgoing edge of its neighbour, outgoing template edges are
+    # only kept at the fringe. Returns the template layout the vehicles are tiled with.
+    nodes_tree = ET.parse(netconfig_directory.joinpath('nodes.nod.xml'))
+    edges_tree = ET.parse(netconfig_directory.joinpath('edges.edg.xml'))
+    connections_tree = ET.parse(netconfig_directory.joinpath('connections.con.xml'))
+    tllogics_tree = ET.parse(netconfig_directory.joinpath('tllogics.tll.xml'))
+
+    nodes = nodes_tree.getroot().findall('node')
+    signalized = [node for node in nodes if node.get('tl')]
+    if len(signalized) != 1:
+        raise ValueError(f"Only nets with one signalized junction can be tiled, found {len(signalized)}")
+    center = signalized[0]
+    center_x, center_y = float(center.get('x')), float(center.get('y'))
+    fringe_sides, legs = {}, {}
+    for node in nodes:
+        if node is center:
+            continue
+        dx, dy = float(node.get('x')) - center_x, float(node.get('y')) - center_y
+        side = ('east' if dx > 0 else 'west') if abs(dx) >= abs(dy) else ('north' if dy > 0 else 'south')
+        fringe_sides[node.get('id')] = side
+        legs[side] = math.hypot(dx, dy)
+
+    template = {'center': center.get('id'), 'incoming': {}, 'outgoing': {}, 'sides': {}}
+    edges = edges_tree.getroot().findall('edge')
+    for edge in edges:
+        incoming = edge.get('to') == template['center']
+        side = fringe_sides[edge.get('from') if incoming else edge.get('to')]
+        template['incoming' if incoming else 'outgoing'][side] = edge.get('id')
+        template['sides'][edge.get('id')] = side
+    for side in template['outgoing']:
+        if OPPOSITE[side] not in template['incoming'] or side in template['incoming']:
+            raise ValueError(f"The {side} edges of {netconfig_directory} do not continue into a neighbour junction")
+    connections = connections_tree.getroot().findall('connection')
+    template['routes'] = {}
+    # the route ids findAllRoutes assigns to the template junction, which its vehicles refer to
+    for source in ROUTE_SOURCES:
+        for target in ROUTE_TARGETS:
+            if any(c.get('from') == source and c.get('to') == target for c in connections):
+                template['routes'][str(len(template['routes']))] = (source, target)
+
+    # junctions are spaced by the incoming legs, so every incoming lane is as long as in the template
+    spacing_x = legs.get('west', legs.get('east', 0.0))
+    spacing_y = legs.get('south', legs.get('north', 0.0))
+    positions = {node.get('id'): (float(node.get('x')), float(node.get('y'))) for node in nodes}
+    tllogics = tllogics_tree.getroot().findall('tlLogic')
+
+    for root, children in ((nodes_tree.getroot(), nodes), (edges_tree.getroot(), edges),
+                           (connections_tree.getroot(), connections), (tllogics_tree.getroot(), tllogics)):
+        for child in children:
+            root.remove(child)
+    for row in range(rows):
+        for column in range(columns):
+            suffix = grid_suffix(row, column)
+            junction = copy.deepcopy(center)
+            junction.attrib.update({'id': center.get('id') + suffix, 'x': str(center_x + column * spacing_x),
+                                    'y': str(center_y + row * spacing_y), 'tl': center.get('tl') + suffix})
+            nodes_tree.getroot().append(junction)
+
+            for edge in edges:
+                side = template['sides'][edge.get('id')]
+                incoming = edge.get('id') in template['incoming'].values()
+                neighbour = grid_neighbour(row, column, side, rows, columns)
+                if not incoming and neighbour:
+                    continue
+                fringe = edge.get('from') if incoming else edge.get('to')
+                if neighbour:
+                    outer_end = template['center'] + grid_suffix(*neighbour)
+                else:
+                    outer_end = fringe + suffix
+                    node = copy.deepcopy(next(node for node in nodes if node.get('id') == fringe))
+                    node.attrib.update({'id': outer_end, 'x': str(positions[fringe][0] + column * spacing_x),
+                                        'y': str(positions[fringe][1] + row * spacing_y)})
+                    nodes_tree.getroot().append(node)
+                tiled_edge = copy.deepcopy(edge)
+                tiled_edge.attrib.update({'id': edge.get('id') + suffix,
+                                          'from': outer_end if incoming else junction.get('id'),
+                                          'to': junction.get('id') if incoming else outer_end})
+                edges_tree.getroot().append(tiled_edge)
+
+            for connection in connections:
+                tiled_connection = copy.deepcopy(connection)
+                tiled_connection.attrib.update({
+                    'from': grid_edge(template, connection.get('from'), row, column, rows, columns),
+                    'to': grid_edge(template, connection.get('to'), row, column, rows, columns),
+                })
+                connections_tree.getroot().append(tiled_connection)
+            for tllogic in tllogics:
+                tiled_tllogic = copy.deepcopy(tllogic)
+                tiled_tllogic.set('id', tllogic.get('id') + suffix)
+                tllogics_tree.getroot().append(tiled_tllogic)
+
+    for tree, file_name in ((nodes_tree, 'nodes.nod.xml'), (edges_tree, 'edges.edg.xml'),
+                            (connections_tree, 'connections.con.xml'), (tllogics_tree, 'tllogics.tll.xml')):
+        ET.indent(tree)
+        tree.write(netconfig_directory.joinpath(file_name), xml_declaration=True, encoding='UTF-8')
+    return template
+
+
+def tile_vehicles(vehicles_file: Path, routes_file: Path, template: dict, rows: int, columns: int):
+    # Every template vehicle becomes one vehicle per junction it starts at, with an explicit route that continues
+    # straight towards its target side until it leaves the grid. Through vehicles only start at the fringe.
+    tree = ET.parse(vehicles_file)
+    root = tree.getroot()
+    routes = ET.Element('routes')
+    vehicles = root.findall('vehicle')
+    for vehicle in vehicles:
+        root.remove(vehicle)
+    for vehicle in vehicles:
+        source, target = template['routes'][vehicle.get('route')]
+        source_side, target_side = template['sides'][source], template['sides'][target]
+        straight = template['incoming'][OPPOSITE[target_side]]
+        for row in range(rows):
+            for column in range(columns):
+                if target_side == OPPOSITE[source_side] and grid_neighbour(row, column, source_side, rows, columns):
+                    continue
+                edges = [source + grid_suffix(row, column)]
+                position = (row, column)
+                while neighbour := grid_neighbour(*position, target_side, rows, columns):
+                    edges.append(straight + grid_suffix(*neighbour))
+                    position = neighbour
+                edges.append(target + grid_suffix(*position))
+                route_id = vehicle.get('id') + grid_suffix(row, column)
+                ET.SubElement(routes, 'route', id=route_id, edges=' '.join(edges))
+                tiled_vehicle = copy.deepcopy(vehicle)
+                tiled_vehicle.attrib.update({'id': route_id, 'route': route_id})
+                root.append(tiled_vehicle)
+    ET.indent(routes)
+    ET.ElementTree(routes).write(routes_file, xml_declaration=True, encoding='UTF-8')
+    tree.write(vehicles_file, xml_declaration=True, encoding='UTF-8')
+
+
+def grid_neighbour(row: int, column: int, side: str, rows: int, columns: int) -> tuple[int, int] | None:
+    row, column = row + SIDES[side][0], column + SIDES[side][1]
+    return (row, column) if 0 <= row < rows and 0 <= column < columns else None
+
+
+def grid_edge(template: dict, edge: str, row: int, column: int, rows: int, columns: int) -> str:
+    # an outgoing edge inside the grid is the incoming edge of the neighbour junction
+    if edge in template['outgoing'].values():
+        side = template['sides'][edge]
+        neighbour = grid_neighbour(row, column, side, rows, columns)
+        if neighbour:
+            return template['incoming'][OPPOSITE[side]] + grid_suffix(*neighbour)
+    return edge + grid_suffix(row, column)
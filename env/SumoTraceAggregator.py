@@ -0,0 +1,178 @@
+import argparse
+import json
+import multiprocessing
+import xml.etree.ElementTree as ElementTree
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import pandas as pd
+
+EPISODE_FILES = ('metadata.xml', 'summary.csv', 'statistics.xml', 'collisions.xml', 'tripinfo.xml', 'ssm.xml')
+DATA_COLUMNS = ['agent', 'desiredSpeed', 'friction', 'speed', 'waitingTime', 'emergencyBraking', 'collisions']
+MANIFEST_FILE = '.manifest.json'
+SUMMARY_FILE = '.summary.csv'
+
+
+class SumoTraceAggregator:
+    # Summarises generated traces (one directory per agent) into .summary.csv files and one data.csv. XML outputs are
+    # streamed with iterparse, the ssm file is only read on request, episodes are parsed in parallel and a manifest
+    # per directory remembers parsed episodes, so a re-run only processes new or changed ones.
+
+    def __init__(self, workers: int = 1, include_ssm: bool = False, collision_route: str = 'southEast'):
+        self.workers = workers
+        self.include_ssm = include_ssm
+        self.collision_route = collision_route
+
+    def aggregate(self, data_folder: Path) -> pd.DataFrame:
+        summaries = []
+        for experiment_path in sorted(path for path in Path(data_folder).iterdir() if path.is_dir()):
+            summary = self.aggregate_experiment(experiment_path)
+            if summary.empty:
+                continue
+            summary['agent'] = experiment_path.name.removesuffix('_random')
+            summaries.append(summary)
+
+        data = pd.concat(summaries)[DATA_COLUMNS] if summaries else pd.DataFrame(columns=DATA_COLUMNS)
+        data.to_csv(Path(data_folder).joinpath('data.csv'), index=False)
+        return data
+
+    def aggregate_experiment(self, experiment_path: Path) -> pd.DataFrame:
+        manifest_file = experiment_path.joinpath(MANIFEST_FILE)
+        manifest = json.loads(manifest_file.read_text()) if manifest_file.exists() else {}
+        options = {'include_ssm': self.include_ssm, 'collision_route': self.collision_route}
+
+        episodes = {}
+        finished = set()
+        for metadata_file in experiment_path.glob('*_metadata.xml'):
+            episode_id = metadata_file.name.split('_')[0]
+            signature = episode_signature(experiment_path, episode_id)
+            if not ({'summary.csv', 'statistics.xml'} & {name for name, _size, _mtime in signature}):
+                # the episode has not finished yet
+                continue
+            finished.add(episode_id)
+            entry = manifest.get(episode_id)
+            if entry is None or entry['signature'] != signature or entry['options'] != options:
+                episodes[episode_id] = signature
+
+        tasks = [(str(experiment_path), episode_id, self.include_ssm, self.collision_route) for episode_id in episodes]
+        if self.workers <= 1:
+            rows = [parse_episode(*task) for task in tasks]
+        else:
+            with ProcessPoolExecutor(max_workers=self.workers,
+                                     mp_context=multiprocessing.get_context('spawn')) as executor:
+                rows = list(executor.map(parse_episode, *zip(*tasks), chunksize=16)) if tasks else []
+
+        changed = episodes or manifest.keys() - finished
+        manifest = {episode_id: entry for episode_id, entry in manifest.items() if episode_id in finished}
+        for (episode_id, signature), row in zip(episodes.items(), rows):
+            manifest[episode_id] = {'signature': signature, 'options': options, 'row': row}
+        if changed:
+            manifest_file.write_text(json.dumps(manifest))
+
+        summary = pd.DataFrame([manifest[episode_id]['row'] for episode_id in sorted(manifest)])
+        summary.to_csv(experiment_path.joinpath(SUMMARY_FILE), index=False)
+        return summary
+
+
+def episode_signature(experiment_path: Path, episode_id: str) -> list:
+    signature = []
+    for name in EPISODE_FILES:
+        path = experiment_path.joinpath(f'{episode_id}_{name}')
+        if path.exists():
+            stat = path.stat()
+            signature.append([name, stat.st_size, stat.st_mtime_ns])
+    return signature
+
+
+def parse_metadata(metadata_file: Path) -> dict:
+    metadata = {}
+    for _event, element in ElementTree.iterparse(metadata_file):
+        if element.tag in ('desiredSpeed', 'friction'):
+            metadata[element.tag] = float(element.text)
+    return metadata
+
+
+def parse_statistics(statistics_file: Path) -> dict:
+    row = {}
+    for _event, element in ElementTree.iterparse(statistics_file):
+        if element.tag in ('vehicleTripStatistics', 'safety'):
+            for key, value in element.attrib.items():
+                match key:
+                    case 'count' | 'emergencyStops' | 'emergencyBraking' | 'collisions':
+                        row[key] = int(value)
+                    case _:
+                        row[key] = float(value)
+        element.clear()
+    return row
+
+
+def parse_collisions(collisions_file: Path, collision_route: str) -> dict:
+    rear_end_collisions = 0
+    lateral_collisions = 0
+    for _event, element in ElementTree.iterparse(collisions_file):
+        if element.tag == 'collision':
+            rear_end_collisions += collision_route in element.get('victim', '')
+            lateral_collisions += collision_route in element.get('collider', '')
+            element.clear()
+    return {
+        'rearEndCollisions': rear_end_collisions,
+        'lateralCollisions': lateral_collisions,
+        'collisions': rear_end_collisions + lateral_collisions,
+    }
+
+
+def parse_tripinfo(tripinfo_file: Path) -> dict:
+    waiting_time = 0.0
+    trips = 0
+    for _event, element in ElementTree.iterparse(tripinfo_file):
+        if element.tag == 'tripinfo':
+            waiting_time += float(element.get('waitingTime'))
+            trips += 1
+            element.clear()
+    return {'waitingTime': waiting_time / trips if trips else 0.0}
+
+
+def parse_ssm(ssm_file: Path) -> dict:
+    conflicts = 0
+    for _event, element in ElementTree.iterparse(ssm_file):
+        if element.tag == 'conflict':
+            conflicts += 1
+            element.clear()
+    return {'ssmConflicts': conflicts}
+
+
+def parse_episode(experiment_path: str, episode_id: str, include_ssm: bool = False,
+                  collision_route: str = 'southEast') -> dict:
+    experiment_path = Path(experiment_path)
+    prefix = str(experiment_path.joinpath(episode_id))
+    row = {'experiment': str(experiment_path), 'index': int(episode_id)}
+
+    summary_file = Path(prefix + '_summary.csv')
+    if summary_file.exists():
+        # written by EpisodeMetricsCollector during generation
+        row.update(pd.read_csv(summary_file).to_dict('records')[0])
+    else:
+        row.update(parse_metadata(Path(prefix + '_metadata.xml')))
+        row.update(parse_statistics(Path(prefix + '_statistics.xml')))
+        row.update(parse_collisions(Path(prefix + '_collisions.xml'), collision_route))
+        row.update(parse_tripinfo(Path(prefix + '_tripinfo.xml')))
+
+    ssm_file = Path(prefix + '_ssm.xml')
+    if include_ssm and ssm_file.exists():
+        row.update(parse_ssm(ssm_file))
+    return row
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('data_folder', nargs='?', default='traces_paper', type=Path)
+    parser.add_argument('--workers', type=int, default=1, help='number of parallel parser processes')
+    parser.add_argument('--ssm', action='store_true', help='also parse the (large) ssm outputs')
+    args = parser.parse_args()
+
+    data = SumoTraceAggregator(workers=args.workers, include_ssm=args.ssm).aggregate(args.data_folder)
+    print(f"Aggregated {len(data)} episodes into {args.data_folder.joinpath('data.csv')}")
+
+
+if __name__ == '__main__':
+    main()
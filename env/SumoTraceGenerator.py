@@ -1,90 +1,361 @@
+import hashlib
+import json
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import nullcontext
+from functools import partial
+from itertools import groupby
 from pathlib import Path
 
+import gymnasium
 import numpy as np
 import pandas as pd
 from stable_baselines3 import A2C
+from stable_baselines3.common.vec_env import SubprocVecEnv
 
+from EpisodeMetricsCollector import EpisodeMetricsCollector
+from PolicyRegistry import policies
+from ShiftDetector import ShiftDetector, ShiftMonitor
 from SumoEnvironmentGenerator import SumoEnvironmentGenerator
 
+DEFAULT_MODEL_PATH = Path().joinpath('env', 'training_data_2lane', 'a2c_alternating_server')
+
 
 class SumoTraceGenerator:
+    def __init__(self, workers: int = 1, seed: int = None, pooled: bool = False, chunk_size: int = 10,
+                 warmup: int = 0, snapshot_directory: Path = Path('snapshots'), xml_outputs: bool = False,
+                 trace_store: Path = None, batch_size: int = 1, profile: bool = False,
+                 trajectories: bool = False, detect_shifts: bool = False):
+        self.workers = workers
+        # one entropy for the whole sweep, also without a seed, so episode i of every cell shares its seed sequence
+        self.entropy = np.random.SeedSequence(seed).entropy
+        # pooled workers keep one warm SUMO instance per chunk of episodes instead of relaunching it per episode
+        self.pooled = pooled
+        self.chunk_size = chunk_size
+        # episodes sharing a SUMO seed fork from one simulated warm-up (common random numbers across interventions)
+        self.warmup = warmup
+        self.snapshot_directory = snapshot_directory
+        # summaries are collected while stepping, the heavy SUMO XML outputs are only written on request
+        self.xml_outputs = xml_outputs
+        # episode summaries are additionally appended to this columnar SumoTraceStore
+        self.trace_store = trace_store
+        # with batch_size > 1 that many pooled SUMO processes are stepped in lockstep and share one predict per step
+        self.batch_size = batch_size
+        # episodes run by run_episode write <output_prefix>_profile.json with phase timings and TraCI call counts
+        self.profile = profile
+        # episodes run by run_episode record <output_prefix>_trajectory.npy for rescoring with other reward functions
+        self.trajectories = trajectories
+        # episodes run by run_episode write the events of an online ShiftDetector to <output_prefix>_shifts.json
+        self.detect_shifts = detect_shifts
+
     def generate_traces(self, env_generator: SumoEnvironmentGenerator, path: Path, size: int, speed_loc: float,
                  friction_log: float,
-                 speed_scale: float = 0.0, friction_scale: float = 0.0):
-        rng = np.random.default_rng()
-        speeds = rng.normal(speed_loc, speed_scale, size=size)
-        frictions = rng.normal(friction_log, friction_scale, size=size)
-
-        for experiment, values in enumerate(zip(speeds, frictions)):
-            speed, friction_coefficient = values
-            friction_coefficient = max(0.01, min(1, friction_coefficient))
-            experiment_string = str(experiment).zfill(4)
-            env = env_generator.get_generation_env(output_prefix=str(path.joinpath(experiment_string)))
-            model = A2C(env=env, policy='MlpPolicy').load(Path().joinpath('env', 'training_data_2lane', 'a2c_alternating_server'))
-
-            metadata = {'desiredSpeed': speed, 'friction': friction_coefficient}
-            pd.DataFrame(metadata, index=['metadata']).to_xml(Path(path).joinpath(experiment_string + '_metadata.xml'))
-
-            obs, info = env.reset()
-            # Revisit Friction calculation
-            vehicletype = env.sumo.vehicletype
-            vehicletype.setMaxSpeed('carCustom', speed)
-            vehicletype.setDecel('carCustom', vehicletype.getDecel('carCustom') * friction_coefficient)
-            vehicletype.setEmergencyDecel('carCustom',
-                                          vehicletype.getEmergencyDecel('carCustom') * friction_coefficient)
-            for traffic_signal in env.traffic_signals.values():
-                for lane in traffic_signal.lanes:
-                    traffic_signal.sumo.lane.setParameter(lane, 'frictionCoefficient', friction_coefficient)
+                 speed_scale: float = 0.0, friction_scale: float = 0.0, model_path: Path = DEFAULT_MODEL_PATH):
+        episodes = [trace_episode(path, experiment, seed_sequence, speed_loc, friction_log, speed_scale, friction_scale,
+                                  model_path)
+                    for experiment, seed_sequence in enumerate(np.random.SeedSequence(self.entropy).spawn(size))]
+
+        self.run_episodes(env_generator, episodes)
+        return 1
+
+    def run_episodes(self, env_generator: SumoEnvironmentGenerator, episodes: list[dict]) -> int:
+        # resume a partly finished sweep by skipping episodes that already produced their outputs
+        episodes = [episode for episode in episodes if not episode_exists(episode['output_prefix'])]
+        for episode in episodes:
+            episode.setdefault('xml_outputs', self.xml_outputs)
+            episode.setdefault('profile', self.profile)
+            episode.setdefault('trajectory', self.trajectories)
+            episode.setdefault('detect_shifts', self.detect_shifts)
+            episode.setdefault('agent', Path(episode['output_prefix']).parent.name)
+            if self.trace_store is not None:
+                episode.setdefault('trace_store', str(self.trace_store))
+
+        if self.warmup:
+            self.snapshot_directory.mkdir(parents=True, exist_ok=True)
+            snapshots = {}
+            network = network_key(env_generator)
+            for episode in episodes:
+                snapshot_file = self.snapshot_directory.joinpath(
+                    f"{network}_warmup{self.warmup}_seed{episode['sumo_seed']}.sbx")
+                snapshots[episode['sumo_seed']] = str(snapshot_file)
+                episode['snapshot'] = str(snapshot_file)
+            self._run_tasks(env_generator, [
+                (create_snapshot, {'snapshot_file': snapshot_file, 'warmup': self.warmup, 'sumo_seed': sumo_seed})
+                for sumo_seed, snapshot_file in snapshots.items() if not Path(snapshot_file).exists()])
+
+        if self.batch_size > 1:
+            start = time.perf_counter()
+            transitions = run_episodes_batched(env_generator, episodes, self.batch_size)
+            print(f"Stepped {self.batch_size} environments in lockstep at "
+                  f"{transitions / (time.perf_counter() - start):.1f} transitions/s")
+            return len(episodes)
+
+        if self.pooled:
+            results = self._run_tasks(env_generator, [(run_episodes_pooled, episodes[i:i + self.chunk_size])
+                                                      for i in range(0, len(episodes), self.chunk_size)])
+        else:
+            results = self._run_tasks(env_generator, [(run_episode, episode) for episode in episodes])
+
+        if self.pooled:
+            savings = [saving for chunk_savings in results for saving in chunk_savings]
+            if savings:
+                print(f"Pooled SUMO instances saved {np.mean(savings):.3f}s startup per episode "
+                      f"({np.sum(savings):.1f}s over {len(savings)} reloaded episodes)")
+        return len(episodes)
+
+    def _run_tasks(self, env_generator: SumoEnvironmentGenerator, tasks: list[tuple]) -> list:
+        if self.workers <= 1:
+            return [task(env_generator, argument) for task, argument in tasks]
+
+        # libsumo keeps a single simulation per process, so every worker is a separate (spawned) process
+        with ProcessPoolExecutor(max_workers=self.workers,
+                                 mp_context=multiprocessing.get_context('spawn')) as executor:
+            futures = [executor.submit(task, env_generator, argument) for task, argument in tasks]
+            return [future.result() for future in as_completed(futures)]
+
+
+def trace_episode(path: Path, experiment: int, seed_sequence: np.random.SeedSequence, speed_loc: float,
+                  friction_log: float, speed_scale: float = 0.0, friction_scale: float = 0.0,
+                  model_path: Path = DEFAULT_MODEL_PATH) -> dict:
+    # every episode draws from its own seed sequence, so results do not depend on the worker count
+    rng = np.random.default_rng(seed_sequence)
+    speed = rng.normal(speed_loc, speed_scale)
+    friction_coefficient = rng.normal(friction_log, friction_scale)
+    friction_coefficient = max(0.01, min(1, friction_coefficient))
+    return {
+        'output_prefix': str(path.joinpath(str(experiment).zfill(4))),
+        'model_path': str(model_path),
+        'sumo_seed': episode_sumo_seed(seed_sequence),
+        'desiredSpeed': speed,
+        'friction': friction_coefficient,
+    }
+
+
+def episode_sumo_seed(seed_sequence: np.random.SeedSequence) -> int:
+    return int(seed_sequence.generate_state(1)[0] % 2 ** 31)
+
+
+def network_key(env_generator: SumoEnvironmentGenerator) -> str:
+    # Snapshots are simulated before the interventions are applied, so they only depend on the network, routes and
+    # SUMO configuration, which the network build (speed, friction, flows) wrote into these files
+    digest = hashlib.sha256()
+    for file_name in (env_generator.net_file, env_generator.route_file, env_generator.sumocfg_file):
+        digest.update(Path(file_name).read_bytes())
+    return digest.hexdigest()[:16]
+
+
+def episode_exists(output_prefix: str) -> bool:
+    finished = Path(output_prefix + '_summary.csv').exists() or Path(output_prefix + '_statistics.xml').exists()
+    return finished and Path(output_prefix + '_metadata.xml').exists()
+
+
+def load_model(model_path: str) -> A2C:
+    # models are loaded once per worker process and reused for all of its episodes
+    return policies.get(model_path)
+
+
+def create_snapshot(env_generator: SumoEnvironmentGenerator, snapshot: dict) -> str:
+    return env_generator.create_warmup_snapshot(**snapshot)
+
+
+def store_summary(episode: dict, row: dict):
+    if episode.get('trace_store'):
+        # pyarrow is only needed with a trace store
+        from SumoTraceStore import SumoTraceStore
+        SumoTraceStore(episode['trace_store']).append([{**row, 'agent': episode['agent'],
+                                                         'episode': episode['output_prefix']}])
+
+
+def write_metadata(episode: dict) -> dict:
+    metadata = {'desiredSpeed': episode['desiredSpeed'], 'friction': episode['friction']}
+    pd.DataFrame(metadata, index=['metadata']).to_xml(episode['output_prefix'] + '_metadata.xml')
+    return metadata
+
+
+def pooled_reset_options(episode: dict) -> dict:
+    return {
+        'output_prefix': episode['output_prefix'] if episode.get('xml_outputs', False) else '',
+        'desiredSpeed': episode['desiredSpeed'] if episode.get('apply_speed', True) else None,
+        'friction': episode['friction'] if episode.get('apply_friction', True) else None,
+        'snapshot': episode.get('snapshot'),
+    }
+
+
+def run_episode(env_generator: SumoEnvironmentGenerator, episode: dict):
+    output_prefix = episode['output_prefix']
+    env = env_generator.get_generation_env(output_prefix=output_prefix, sumo_seed=episode['sumo_seed'],
+                                           xml_outputs=episode.get('xml_outputs', False),
+                                           profile=episode.get('profile', False),
+                                           record_trajectory=episode.get('trajectory', False))
+    profiler = getattr(env, 'profiler', None)
+    model = load_model(episode['model_path'])
+    metrics = EpisodeMetricsCollector()
+    metadata = write_metadata(episode)
+
+    obs, info = env.reset()
+    if episode.get('snapshot'):
+        obs = SumoEnvironmentGenerator.fork_from_snapshot(env, episode['snapshot'])
+    SumoEnvironmentGenerator.apply_intervention(
+        env,
+        speed=episode['desiredSpeed'] if episode.get('apply_speed', True) else None,
+        friction_coefficient=episode['friction'] if episode.get('apply_friction', True) else None,
+    )
+    metrics.attach(env)
+    monitor = None
+    if episode.get('detect_shifts'):
+        monitor = ShiftMonitor(ShiftDetector(), metrics)
+        monitor.attach(env)
+
+    done = False
+    while not done:
+        with profiler.phase('inference') if profiler else nullcontext():
+            action, _state = model.predict(obs, deterministic=True)
+        obs, _reward, terminated, truncated, info = env.step(action)
+        done = terminated or truncated
+    store_summary(episode, metrics.write_summary(output_prefix, metadata))
+    if monitor is not None:
+        Path(output_prefix + '_shifts.json').write_text(json.dumps(monitor.detector.events))
+    env.close()
+
+
+def run_episodes_pooled(env_generator: SumoEnvironmentGenerator, episodes: list[dict]) -> list[float]:
+    env = env_generator.get_pooled_generation_env()
+    metrics = EpisodeMetricsCollector()
+    try:
+        for episode in episodes:
+            model = load_model(episode['model_path'])
+            metadata = write_metadata(episode)
+
+            obs, info = env.reset(seed=episode['sumo_seed'], options=pooled_reset_options(episode))
+            metrics.attach(env)
 
             done = False
             while not done:
                 action, _state = model.predict(obs, deterministic=True)
                 obs, _reward, terminated, truncated, info = env.step(action)
                 done = terminated or truncated
-            env.close()
+            store_summary(episode, metrics.write_summary(episode['output_prefix'], metadata))
+    finally:
+        # the XML outputs of the last episode are only written once the simulator shuts down
+        env.shutdown()
+
+    return [env.cold_start_time - warm_start_time for warm_start_time in env.warm_start_times]
+
+
+class LockstepEpisodeEnv(gymnasium.Env):
+    # One worker of run_episodes_batched: runs the episode dict passed as reset option on the pooled SUMO instance of
+    # its process and writes the episode outputs on termination. A reset without options (the automatic reset of the
+    # vectorized environment) leaves the worker idle until the next episode is sent.
+
+    def __init__(self, env_generator: SumoEnvironmentGenerator):
+        self.env = env_generator.get_pooled_generation_env()
+        self.observation_space = self.env.observation_space
+        self.action_space = self.env.action_space
+        self.metrics = EpisodeMetricsCollector()
+        self.episode = None
+        self.metadata = None
+
+    def reset(self, seed=None, options: dict = None):
+        self.episode = options
+        if options is None:
+            return self._idle_observation(), {}
+        self.metadata = write_metadata(options)
+        obs, info = self.env.reset(seed=options['sumo_seed'], options=pooled_reset_options(options))
+        self.metrics.attach(self.env)
+        return obs, info
+
+    def step(self, action):
+        if self.episode is None:
+            return self._idle_observation(), 0.0, True, False, {}
+        obs, reward, terminated, truncated, info = self.env.step(action)
+        if terminated or truncated:
+            store_summary(self.episode, self.metrics.write_summary(self.episode['output_prefix'], self.metadata))
+            self.episode = None
+        return obs, reward, terminated, truncated, info
+
+    def close(self):
+        self.env.shutdown()
+
+    def _idle_observation(self) -> np.ndarray:
+        return np.zeros(self.observation_space.shape, dtype=self.observation_space.dtype)
+
+
+def run_episodes_batched(env_generator: SumoEnvironmentGenerator, episodes: list[dict], batch_size: int) -> int:
+    # Advances batch_size episodes of the same agent in lockstep, one spawned SUMO process each, and computes all of
+    # their actions with a single predict on the stacked observations. Returns the number of transitions.
+    vec_env = SubprocVecEnv([partial(LockstepEpisodeEnv, env_generator)] * batch_size, start_method='spawn')
+    transitions = 0
+    try:
+        for model_path, agent_episodes in groupby(sorted(episodes, key=lambda e: e['model_path']),
+                                                  key=lambda e: e['model_path']):
+            agent_episodes = list(agent_episodes)
+            for i in range(0, len(agent_episodes), batch_size):
+                batch = agent_episodes[i:i + batch_size]
+                # workers without an episode in a partial batch stay idle
+                vec_env.set_options(batch + [None] * (batch_size - len(batch)))
+                obs = vec_env.reset()
+                active = np.arange(batch_size) < len(batch)
+                while active.any():
+                    actions = policies.predict(model_path, obs)
+                    obs, _rewards, dones, _infos = vec_env.step(actions)
+                    transitions += int(active.sum())
+                    active &= ~dones
+    finally:
+        vec_env.close()
+    return transitions
 
-        return 1
 
 def main():
     from SumoEnvironmentGenerator import SumoEnvironmentGenerator
+    from SumoNetworkBuilder import SumoNetworkBuilder
+    from AdaptiveExperimentScheduler import AdaptiveExperimentScheduler, precision_target
     from pathlib import Path
     from tqdm import tqdm
+    import argparse
     import itertools
 
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, default=1, help='number of parallel SUMO worker processes')
+    parser.add_argument('--seed', type=int, default=None, help='base seed for per-episode seeding')
+    parser.add_argument('--pooled', action='store_true', help='reuse warm SUMO instances across episodes')
+    parser.add_argument('--precision', type=precision_target, action='append', default=[],
+                        help='adaptively add episodes (up to 100 per cell) until the confidence interval half-width '
+                             'of an outcome is reached, e.g. --precision waitingTime=1 --precision collisions=0.05')
+    parser.add_argument('--batch-size', type=int, default=1,
+                        help='episodes stepped in lockstep with one batched predict (replaces --workers/--pooled)')
+    parser.add_argument('--warmup', type=int, default=0,
+                        help='seconds of shared warm-up that interventions fork from (0 simulates every episode fully)')
+    parser.add_argument('--xml-outputs', action='store_true',
+                        help='also write the SUMO statistics/collisions/tripinfo/ssm XML outputs')
+    parser.add_argument('--profile', action='store_true',
+                        help='write per-episode phase timings and TraCI call counts (<episode>_profile.json)')
+    parser.add_argument('--trajectories', action='store_true',
+                        help='record the reward function inputs per step (<episode>_trajectory.npy)')
+    parser.add_argument('--detect-shifts', action='store_true',
+                        help='run the online shift detector and write its adaptation events (<episode>_shifts.json)')
+    parser.add_argument('--trace-store', type=Path, default=None,
+                        help='append every episode summary to this columnar trace store')
+    args = parser.parse_args()
+    # pooled and lockstep episodes do not run through run_episode, which writes the profiles, trajectories and shifts
+    for flag, enabled in (('--profile', args.profile), ('--trajectories', args.trajectories),
+                          ('--detect-shifts', args.detect_shifts)):
+        if enabled and (args.pooled or args.batch_size > 1):
+            parser.error(f'{flag} cannot be combined with --pooled or --batch-size > 1')
+
     print("Begin training configuration")
-    import xml.etree.ElementTree as ET
-
-    INSERT_PROBABILITY = 0.1
-
-    config_directory = Path().joinpath('nets', '2lane_unprotected_right')
-    route_file = config_directory.joinpath('2lane_unprotected_right.rou.xml')
-    tree = ET.parse(route_file)
-    root = tree.getroot()
-
-    for flow in root.findall('flow'):
-        match flow.attrib.get('id'):
-            case 'southEast':
-                flow.set('period', f"exp({INSERT_PROBABILITY})")
-            case 'southNorth':
-                flow.set('period', f"exp({INSERT_PROBABILITY})")
-            case 'westEastTop':
-                flow.set('period', f"exp({2 * INSERT_PROBABILITY})")
-            case id if 'westEastBottom' in id:
-                flow.set('end', str(float(flow.get('begin')) + 600))
-                if float(flow.get('begin')) % 1200 == 0:
-                    flow.set('period', f"exp({2 * INSERT_PROBABILITY})")
-                else:
-                    flow.set('period', f"exp({0.0001 * INSERT_PROBABILITY})")
-
-    tree.write(route_file, xml_declaration=True, encoding='UTF-8')
+    network = SumoNetworkBuilder(Path('nets', '2lane_unprotected_right'), '2lane_unprotected_right').build(
+        insert_probability=0.1,
+        duration=3600,
+        repeat_period=10,
+        bottom_insert_factor=2,
+    )
     print("Finished training configuration")
 
-    net_name = '2lane_unprotected_right'
-
     environments = SumoEnvironmentGenerator(
-        net_file=str(Path().joinpath('nets', net_name, f'{net_name}.net.xml')),
-        route_file=str(Path().joinpath('nets', net_name, f'{net_name}.rou.xml')),
-        sumocfg_file=str(Path().joinpath('nets', net_name, f'{net_name}.sumocfg')),
+        net_file=str(network['net.xml']),
+        route_file=str(network['rou.xml']),
+        sumocfg_file=str(network['sumocfg']),
         duration=3600,
         learning_data_csv_name=str(Path().joinpath('env', 'training_data_2lane', 'output.csv')),
     )
@@ -94,18 +365,36 @@ def main():
 
     experiments = list(itertools.product(speeds, frictions))
 
-    for speed, friction in tqdm(experiments):
+    trace_generator = SumoTraceGenerator(workers=args.workers, seed=args.seed, pooled=args.pooled,
+                                         warmup=args.warmup, xml_outputs=args.xml_outputs,
+                                         trace_store=args.trace_store, batch_size=args.batch_size,
+                                         profile=args.profile, trajectories=args.trajectories,
+                                         detect_shifts=args.detect_shifts)
+
+    def experiment_path(speed, friction) -> Path:
         simulation_output_path = Path().joinpath('data_agent', f'a2c_{int(speed)}_f{friction}')
         Path.mkdir(simulation_output_path, parents=True, exist_ok=True)
+        return simulation_output_path
+
+    if args.precision:
+        scheduler = AdaptiveExperimentScheduler(trace_generator, dict(args.precision), max_episodes=100,
+                                                seed=args.seed)
+        report = scheduler.run(environments, experiments, lambda cell, i, seed_sequence: trace_episode(
+            experiment_path(*cell), i, seed_sequence, speed_loc=float(cell[0]) / 3.6, friction_log=cell[1],
+            friction_scale=0.1))
+        print(report)
+        return
 
-        trace_generator = SumoTraceGenerator()
+    for speed, friction in tqdm(experiments):
         trace_generator.generate_traces(
             env_generator=environments,
-            path=simulation_output_path,
+            path=experiment_path(speed, friction),
             size=100,
             speed_loc=float(speed) / 3.6,
             friction_log=friction,
             friction_scale=0.1
         )
+
+
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,145 @@
+import argparse
+import os
+import uuid
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+SCHEMA = pa.schema([
+    ('agent', pa.string()),
+    ('desiredSpeed', pa.float64()),
+    ('friction', pa.float64()),
+    ('speed', pa.float64()),
+    ('waitingTime', pa.float64()),
+    ('emergencyBraking', pa.int64()),
+    ('rearEndCollisions', pa.int64()),
+    ('lateralCollisions', pa.int64()),
+    ('collisions', pa.int64()),
+    ('episode', pa.string()),
+    ('speed_bin', pa.float64()),
+    ('friction_bin', pa.float64()),
+])
+PARTITIONING = ds.partitioning(pa.schema([SCHEMA.field('agent'), SCHEMA.field('speed_bin'),
+                                          SCHEMA.field('friction_bin')]), flavor='hive')
+
+
+class SumoTraceStore:
+    # Columnar store of episode summaries, partitioned by agent / desiredSpeed bin / friction bin (hive layout).
+    # Every append writes new parquet files under a unique name and renames them into place, so concurrent writers
+    # never conflict and readers never see partially written files. compact() merges the small files of a partition.
+
+    def __init__(self, path: Path, speed_bin_width: float = 1.0, friction_bin_width: float = 0.25):
+        self.path = Path(path)
+        self.speed_bin_width = speed_bin_width
+        self.friction_bin_width = friction_bin_width
+
+    def append(self, rows: list[dict] | pd.DataFrame):
+        data = pd.DataFrame(rows)
+        if data.empty:
+            return
+        if 'episode' not in data:
+            data['episode'] = [uuid.uuid4().hex for _ in range(len(data))]
+        for column in ('rearEndCollisions', 'lateralCollisions'):
+            if column not in data:
+                data[column] = pd.NA
+        data['speed_bin'] = self._bin(data['desiredSpeed'], self.speed_bin_width)
+        data['friction_bin'] = self._bin(data['friction'], self.friction_bin_width)
+
+        table = pa.Table.from_pandas(data[SCHEMA.names], schema=SCHEMA, preserve_index=False)
+        for partition, partition_table in self._split(table):
+            self._write(partition, partition_table)
+
+    def read(self, columns: list[str] = None, agent: str | list[str] = None, desiredSpeed: tuple = None,
+             friction: tuple = None, filter: ds.Expression = None) -> pd.DataFrame:
+        # value ranges are (low, high) inclusive and are also applied to the partition bins, so whole partitions are
+        # pruned before any file is opened and row groups are skipped by their statistics
+        expression = filter
+        if agent is not None:
+            agents = [agent] if isinstance(agent, str) else agent
+            expression = self._and(expression, ds.field('agent').isin(agents))
+        for column, bin_column, width, bounds in (('desiredSpeed', 'speed_bin', self.speed_bin_width, desiredSpeed),
+                                                  ('friction', 'friction_bin', self.friction_bin_width, friction)):
+            if bounds is None:
+                continue
+            low, high = bounds
+            expression = self._and(expression, (ds.field(column) >= low) & (ds.field(column) <= high))
+            expression = self._and(expression, (ds.field(bin_column) >= float(self._bin(low, width))) &
+                                   (ds.field(bin_column) <= float(self._bin(high, width))))
+
+        if not self.path.exists():
+            return pd.DataFrame(columns=columns or SCHEMA.names)
+        dataset = ds.dataset(self.path, schema=SCHEMA, format='parquet', partitioning=PARTITIONING)
+        read_columns = None if columns is None else list(dict.fromkeys(columns + ['episode']))
+        data = dataset.to_table(columns=read_columns, filter=expression).to_pandas()
+        # a concurrent compaction can briefly expose an episode twice
+        data = data.drop_duplicates('episode', ignore_index=True)
+        return data if columns is None else data[columns]
+
+    def compact(self):
+        for partition_path in {path.parent for path in self.path.rglob('*.parquet')}:
+            files = sorted(partition_path.glob('*.parquet'))
+            if len(files) < 2:
+                continue
+            table = pa.concat_tables([pq.read_table(file, schema=self._file_schema()) for file in files])
+            self._write_file(partition_path, table)
+            for file in files:
+                file.unlink(missing_ok=True)
+
+    def _split(self, table: pa.Table):
+        keys = table.select(['agent', 'speed_bin', 'friction_bin']).to_pandas()
+        for partition, indices in keys.groupby(['agent', 'speed_bin', 'friction_bin']).indices.items():
+            yield partition, table.take(pa.array(indices)).drop_columns(['agent', 'speed_bin', 'friction_bin'])
+
+    def _write(self, partition: tuple, table: pa.Table):
+        agent, speed_bin, friction_bin = partition
+        partition_path = self.path.joinpath(f'agent={agent}', f'speed_bin={float(speed_bin)!r}',
+                                            f'friction_bin={float(friction_bin)!r}')
+        partition_path.mkdir(parents=True, exist_ok=True)
+        self._write_file(partition_path, table)
+
+    @staticmethod
+    def _write_file(partition_path: Path, table: pa.Table):
+        name = uuid.uuid4().hex
+        temporary_file = partition_path.joinpath(f'.{name}.parquet.tmp')
+        pq.write_table(table, temporary_file)
+        os.replace(temporary_file, partition_path.joinpath(f'{name}.parquet'))
+
+    @staticmethod
+    def _file_schema() -> pa.Schema:
+        return pa.schema([field for field in SCHEMA if field.name not in ('agent', 'speed_bin', 'friction_bin')])
+
+    @staticmethod
+    def _bin(values, width: float):
+        return np.round(np.floor(np.asarray(values, dtype=np.float64) / width) * width, 6)
+
+    @staticmethod
+    def _and(expression: ds.Expression, other: ds.Expression) -> ds.Expression:
+        return other if expression is None else expression & other
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('command', choices=['import', 'compact'])
+    parser.add_argument('csv_files', nargs='*', type=Path,
+                        help='summary CSVs with an agent column, e.g. interventions/data/traces_all_agents.csv')
+    parser.add_argument('--store', type=Path, default=Path('traces_store'))
+    args = parser.parse_args()
+
+    store = SumoTraceStore(args.store)
+    match args.command:
+        case 'import':
+            for csv_file in args.csv_files:
+                data = pd.read_csv(csv_file)
+                data['episode'] = [f'{csv_file.stem}:{i}' for i in range(len(data))]
+                store.append(data)
+                print(f"Imported {len(data)} episodes from {csv_file}")
+        case 'compact':
+            store.compact()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,229 @@
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import re
+import time
+from multiprocessing.connection import wait
+from pathlib import Path
+
+from stable_baselines3.a2c import A2C
+from stable_baselines3.common.callbacks import BaseCallback
+
+from SumoEnvironmentGenerator import SumoEnvironmentGenerator
+from SumoNetworkBuilder import SumoNetworkBuilder
+
+# Constants / Parameters
+INSERT_PROBABILITY = 0.1
+DURATION = 3600
+REPEAT_PERIOD = 10
+DEFAULT_DECEL = 4.5
+DEFAULT_EMERGENCY_DECEL = 9.0
+TIMESTEPS = 1_000_000
+
+# File Paths
+config_directory = Path('nets', '2lane_unprotected_right')
+agents_path = Path('env', 'agents_paper')
+checkpoints_path = Path('checkpoints')
+tensorboard_path = 'tensorboard_paper'
+
+
+class TrainingOrchestrator:
+    # Trains a matrix of source agents x target (speed, friction) x seeds. Every job is a spawned process (libsumo runs
+    # one simulation per process) with envs SUMO environments of its own, and jobs start as long as their environments
+    # fit into the cpus budget. Jobs checkpoint every checkpoint_steps and resume from their last checkpoint when run
+    # again, so an interrupted sweep only loses the steps since the last checkpoint. Finished agents are saved to
+    # agents_paper and recorded in agents_paper/manifest.json.
+
+    def __init__(self, cpus: int = None, envs: int = 1, timesteps: int = TIMESTEPS, checkpoint_steps: int = 50_000,
+                 retries: int = 1):
+        self.cpus = cpus or os.cpu_count()
+        self.envs = envs
+        self.timesteps = timesteps
+        self.checkpoint_steps = checkpoint_steps
+        self.retries = retries
+        self.manifest_file = agents_path.joinpath('manifest.json')
+        self.manifest = json.loads(self.manifest_file.read_text()) if self.manifest_file.exists() else {}
+
+    def jobs(self, sources: list[str | None], targets: list[tuple[float, float]], seeds: list[int]) -> list[dict]:
+        # a source of None trains from scratch
+        return [{
+            'name': job_name(source, speed, friction, seed),
+            'source': source,
+            'speed': speed,
+            'friction': friction,
+            'seed': seed,
+            'timesteps': self.timesteps,
+            'envs': self.envs,
+            'checkpoint_steps': self.checkpoint_steps,
+        } for source, (speed, friction), seed in itertools.product(sources, targets, seeds)]
+
+    def run(self, jobs: list[dict]) -> dict:
+        pending = [job for job in jobs if not self.finished(job)]
+        print(f"{len(jobs) - len(pending)} of {len(jobs)} jobs already finished")
+        attempts = dict.fromkeys((job['name'] for job in pending), 0)
+        running = {}
+        context = multiprocessing.get_context('spawn')
+
+        while pending or running:
+            # start the jobs that fit into the free cpus, at least one when nothing runs
+            while pending and (not running or sum(job['envs'] for job, _ in running.values()) + pending[0]['envs']
+                               <= self.cpus):
+                job = pending.pop(0)
+                attempts[job['name']] += 1
+                process = context.Process(target=run_job, args=(job,), name=job['name'])
+                process.start()
+                running[process.sentinel] = (job, process)
+                self.record(job, status='running', attempts=attempts[job['name']])
+
+            for sentinel in wait(list(running)):
+                job, process = running.pop(sentinel)
+                process.join()
+                if process.exitcode == 0:
+                    result = json.loads(checkpoints_path.joinpath(job['name'], 'result.json').read_text())
+                    self.record(job, status='finished', **result)
+                    print(f"Finished {job['name']} at {result['steps_per_second']:.1f} steps/s")
+                elif attempts[job['name']] <= self.retries:
+                    # the retry resumes from the last checkpoint
+                    print(f"{job['name']} failed with exit code {process.exitcode}, retrying")
+                    self.record(job, status='retrying')
+                    pending.append(job)
+                else:
+                    print(f"{job['name']} failed with exit code {process.exitcode}")
+                    self.record(job, status='failed', exitcode=process.exitcode)
+        return self.manifest
+
+    def finished(self, job: dict) -> bool:
+        entry = self.manifest.get(job['name'], {})
+        return entry.get('status') == 'finished' and entry.get('timesteps') == job['timesteps'] \
+            and Path(entry.get('model', '')).exists()
+
+    def record(self, job: dict, **entry):
+        # only the orchestrator process writes the manifest, replaced atomically after every change
+        self.manifest[job['name']] = {**self.manifest.get(job['name'], {}), **job, **entry, 'updated': time.time()}
+        agents_path.mkdir(parents=True, exist_ok=True)
+        temporary_file = self.manifest_file.with_name(self.manifest_file.name + '.tmp')
+        temporary_file.write_text(json.dumps(self.manifest, indent=4))
+        os.replace(temporary_file, self.manifest_file)
+
+
+class AtomicCheckpointCallback(BaseCallback):
+    # saves the model every checkpoint_steps into one file that is only replaced once the new checkpoint is complete
+
+    def __init__(self, checkpoint_file: Path, checkpoint_steps: int):
+        super().__init__()
+        self.checkpoint_file = checkpoint_file
+        self.checkpoint_steps = checkpoint_steps
+        self.last_checkpoint = 0
+
+    def _on_training_start(self):
+        self.last_checkpoint = self.num_timesteps
+
+    def _on_step(self) -> bool:
+        if self.num_timesteps - self.last_checkpoint >= self.checkpoint_steps:
+            save_atomically(self.model, self.checkpoint_file)
+            self.last_checkpoint = self.num_timesteps
+        return True
+
+
+def job_name(source: str | None, speed: float, friction: float, seed: int) -> str:
+    # the naming of train.py, e.g. transs50f0.5_s80_f0.5_0 (speed in km/h)
+    target = f's{round(speed * 3.6)}_f{friction:g}'
+    if source is None:
+        return f'scratch_{target}_{seed}'
+    source = re.sub(r'^scratch_s(\d+)_f([\d.]+)', r's\1f\2', source)
+    return f'trans{source}_{target}_{seed}'
+
+
+def save_atomically(model: A2C, model_file: Path):
+    temporary_file = model_file.with_name(model_file.stem + '.tmp.zip')
+    model.save(temporary_file)
+    os.replace(temporary_file, model_file)
+
+
+def run_job(job: dict):
+    job_directory = checkpoints_path.joinpath(job['name'])
+    job_directory.mkdir(parents=True, exist_ok=True)
+    checkpoint_file = job_directory.joinpath('checkpoint.zip')
+
+    network = SumoNetworkBuilder(config_directory, '2lane_unprotected_right').build(
+        insert_probability=INSERT_PROBABILITY,
+        duration=DURATION,
+        repeat_period=REPEAT_PERIOD,
+        friction=job['friction'],
+        speed=job['speed'],
+        default_decel=DEFAULT_DECEL,
+        default_emergency_decel=DEFAULT_EMERGENCY_DECEL,
+    )
+    environments = SumoEnvironmentGenerator(
+        net_file=str(network['net.xml']),
+        route_file=str(network['rou.xml']),
+        sumocfg_file=str(network['sumocfg']),
+        duration=DURATION,
+        learning_data_csv_name=str(job_directory.joinpath('output.csv')),
+    )
+    env = environments.get_training_vec_env(job['envs'], seed=job['seed'])
+
+    resumed = checkpoint_file.exists()
+    if resumed:
+        model = A2C.load(checkpoint_file, env=env, tensorboard_log=tensorboard_path)
+        print(f"Resuming {job['name']} at {model.num_timesteps} steps")
+    elif job['source'] is not None:
+        model = A2C.load(agents_path.joinpath(job['source'] + '.zip'), env=env, tensorboard_log=tensorboard_path)
+    else:
+        model = A2C(env=env, policy='MlpPolicy', n_steps=100, verbose=0, tensorboard_log=tensorboard_path)
+    model.set_random_seed(job['seed'])
+
+    start = time.perf_counter()
+    start_steps = model.num_timesteps if resumed else 0
+    # resuming continues the step count and the tensorboard run of the interrupted attempt
+    model.learn(max(job['timesteps'] - start_steps, 0), tb_log_name=job['name'], reset_num_timesteps=not resumed,
+                callback=AtomicCheckpointCallback(checkpoint_file, job['checkpoint_steps']))
+    steps_per_second = (model.num_timesteps - start_steps) / (time.perf_counter() - start)
+    model_file = agents_path.joinpath(job['name'] + '.zip')
+    save_atomically(model, model_file)
+    env.close()
+
+    job_directory.joinpath('result.json').write_text(json.dumps({
+        'model': str(model_file),
+        'num_timesteps': model.num_timesteps,
+        'steps_per_second': steps_per_second,
+        'resumed': resumed,
+    }, indent=4))
+    checkpoint_file.unlink(missing_ok=True)
+
+
+def target(value: str) -> tuple[float, float]:
+    # argparse type of 'speed,friction' arguments
+    speed, friction = value.split(',')
+    return float(speed), float(friction)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sources', nargs='+', default=['scratch_s50_f0.5'],
+                        help="agents in agents_paper to transfer from, 'scratch' trains from scratch")
+    parser.add_argument('--targets', type=target, nargs='+', default=[(22.22, 0.5)],
+                        help='speed,friction pairs to train on, e.g. 22.22,0.5 13.89,1')
+    parser.add_argument('--seeds', type=int, nargs='+', default=[0, 1])
+    parser.add_argument('--timesteps', type=int, default=TIMESTEPS)
+    parser.add_argument('--envs', type=int, default=1, help='SUMO environments per job')
+    parser.add_argument('--cpus', type=int, default=None, help='environments running at the same time')
+    parser.add_argument('--checkpoint-steps', type=int, default=50_000)
+    parser.add_argument('--retries', type=int, default=1, help='restarts of a failed job from its last checkpoint')
+    args = parser.parse_args()
+
+    orchestrator = TrainingOrchestrator(cpus=args.cpus, envs=args.envs, timesteps=args.timesteps,
+                                        checkpoint_steps=args.checkpoint_steps, retries=args.retries)
+    sources = [None if source == 'scratch' else source for source in args.sources]
+    jobs = orchestrator.jobs(sources, args.targets, args.seeds)
+    print(f"Training {len(jobs)} jobs on {orchestrator.cpus} cpus")
+    manifest = orchestrator.run(jobs)
+    failed = [job['name'] for job in jobs if manifest[job['name']]['status'] != 'finished']
+    if failed:
+        print(f"Failed jobs: {', '.join(failed)}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,213 @@
+import argparse
+import glob
+import os
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from sumo_rl import SumoEnvironment
+
+# rescoring functions by the name of the SumoEnvironmentGenerator reward function they reproduce
+REWARD_FUNCTIONS = {}
+
+
+class TrajectoryRecorder:
+    # Records per step the lane-level accumulated waiting times, the number of collisions, the observation, the action
+    # and the reward into one memory-mapped structured .npy per episode. These are all inputs of the reward functions,
+    # so rescore() can evaluate any of them on the recorded episodes without simulating again.
+
+    def __init__(self, trajectory_file: str):
+        # may contain {episode} for environments that run several episodes
+        self.trajectory_file = trajectory_file
+        self.env = None
+        self.episode = -1
+        self.rows = None
+        self.length = 0
+        self.waiting_time = None
+
+    def attach(self, env: SumoEnvironment):
+        self.env = env
+        env.trajectory_recorder = self
+        reset = env.reset
+        step = env.step
+
+        def recorded_reset(*args, **kwargs):
+            self.finish_episode()
+            obs, info = reset(*args, **kwargs)
+            self._start_episode(obs)
+            return obs, info
+
+        def recorded_step(action):
+            self.waiting_time = None
+            obs, reward, terminated, truncated, info = step(action)
+            self._record(obs, action, reward)
+            if terminated or truncated:
+                self.finish_episode()
+            return obs, reward, terminated, truncated, info
+
+        env.reset = recorded_reset
+        env.step = recorded_step
+
+    def _start_episode(self, obs):
+        env = self.env
+        self.episode += 1
+        self.traffic_signal = env.traffic_signals[env.ts_ids[0]]
+        get_waiting_time = self.traffic_signal.get_accumulated_waiting_time_per_lane
+
+        def recorded_waiting_time():
+            # the reward function asks for the same values, so they are only queried once per step
+            self.waiting_time = get_waiting_time()
+            return self.waiting_time
+
+        self.traffic_signal.get_accumulated_waiting_time_per_lane = recorded_waiting_time
+        dtype = np.dtype([
+            ('time', np.float32),
+            ('waiting_time', np.float32, (len(self.traffic_signal.lanes),)),
+            ('collisions', np.int16),
+            ('observation', np.float32, np.shape(obs)),
+            ('action', np.int16),
+            ('reward', np.float32),
+        ])
+        capacity = int(np.ceil((env.sim_max_time - env.sim_step) / env.delta_time)) + 1
+        self.file = Path(self.trajectory_file.format(episode=self.episode))
+        self.rows = np.lib.format.open_memmap(self._temporary_file(), mode='w+', dtype=dtype, shape=(capacity,))
+        self.length = 0
+
+    def _record(self, obs, action, reward):
+        if self.rows is None:
+            return
+        if self.length == len(self.rows):
+            # episodes longer than the expected capacity (e.g. a changed sim_max_time) grow the file
+            self._resize(2 * len(self.rows))
+        waiting_time = self.waiting_time
+        if waiting_time is None:
+            waiting_time = self.traffic_signal.get_accumulated_waiting_time_per_lane()
+        row = self.rows[self.length]
+        row['time'] = self.env.sim_step
+        row['waiting_time'] = waiting_time
+        row['collisions'] = len(self.env.sumo.simulation.getCollisions())
+        row['observation'] = obs
+        row['action'] = action
+        row['reward'] = reward
+        self.length += 1
+
+    def finish_episode(self):
+        if self.rows is None:
+            return
+        if not self.length:
+            self.rows = None
+            os.remove(self._temporary_file())
+            return
+        self._resize(self.length)
+        self.rows.flush()
+        self.rows = None
+        os.replace(self._temporary_file(), self.file)
+
+    def _resize(self, length: int):
+        if length == len(self.rows):
+            return
+        rows = self.rows[:min(length, len(self.rows))].copy()
+        self.rows.flush()
+        del self.rows
+        self.rows = np.lib.format.open_memmap(self._temporary_file(), mode='w+', dtype=rows.dtype, shape=(length,))
+        self.rows[:len(rows)] = rows
+
+    def _temporary_file(self) -> str:
+        return str(self.file.with_name(f'.{self.file.name}.tmp'))
+
+
+def reward_function(name: str):
+    def register(function):
+        REWARD_FUNCTIONS[name] = function
+        return function
+    return register
+
+
+def lagged(values: np.ndarray, starts: np.ndarray) -> np.ndarray:
+    # the traffic signal's last_measure: the previous step's value, 0 at the beginning of every episode
+    previous = np.empty_like(values)
+    previous[0] = 0.0
+    previous[1:] = values[:-1]
+    previous[starts] = 0.0
+    return previous
+
+
+@reward_function('_reward_fn')
+def _reward(waiting_time, collisions, starts):
+    measure = waiting_time / 100.0
+    return lagged(measure, starts) - measure
+
+
+@reward_function('_penalty_reward_minute_fn')
+def _penalty_reward_minute(waiting_time, collisions, starts):
+    return lagged(waiting_time, starts) - waiting_time - 60.0 * (collisions > 0)
+
+
+@reward_function('_penalty_reward_minute_static_fn')
+def _penalty_reward_minute_static(waiting_time, collisions, starts):
+    return -waiting_time - 60.0 * (collisions > 0)
+
+
+@reward_function('_penalty_reward_fn')
+def _penalty_reward(waiting_time, collisions, starts):
+    measure = waiting_time / 100.0
+    return np.where(collisions > 0, -0.1, lagged(measure, starts) - measure)
+
+
+@reward_function('_penalty_cutoff_reward_fn')
+def _penalty_cutoff_reward(waiting_time, collisions, starts):
+    measure = waiting_time / 100.0
+    reward = lagged(measure, starts) - measure
+    return np.where(collisions > 0, np.minimum(reward, 0.0), reward)
+
+
+def load_trajectories(trajectory_files: list[str | Path]) -> tuple[np.ndarray, np.ndarray]:
+    # concatenated steps of all files and the episode index of every step
+    trajectories = [np.load(trajectory_file, mmap_mode='r') for trajectory_file in trajectory_files]
+    episodes = np.repeat(np.arange(len(trajectories)), [len(trajectory) for trajectory in trajectories])
+    return np.concatenate(trajectories) if trajectories else np.empty(0), episodes
+
+
+def rescore(trajectories: np.ndarray, episodes: np.ndarray, names: list[str] = None) -> pd.DataFrame:
+    waiting_time = trajectories['waiting_time'].astype(np.float64).sum(axis=1)
+    collisions = trajectories['collisions']
+    starts = np.ones(len(episodes), dtype=bool)
+    starts[1:] = episodes[1:] != episodes[:-1]
+    return pd.DataFrame({name: REWARD_FUNCTIONS[name](waiting_time, collisions, starts)
+                         for name in names or REWARD_FUNCTIONS})
+
+
+def episode_returns(trajectory_files: list[str | Path], names: list[str] = None) -> pd.DataFrame:
+    trajectories, episodes = load_trajectories(trajectory_files)
+    returns = rescore(trajectories, episodes, names).groupby(episodes).sum()
+    returns.index = [str(trajectory_file) for trajectory_file in trajectory_files]
+    return returns
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('patterns', nargs='+', help="trajectory files, e.g. 'traces_paper/*/*_trajectory.npy'")
+    parser.add_argument('--output', type=Path, default=None, help='csv of the episode returns')
+    args = parser.parse_args()
+
+    trajectory_files = sorted(file for pattern in args.patterns for file in glob.glob(pattern, recursive=True))
+    start = time.perf_counter()
+    trajectories, episodes = load_trajectories(trajectory_files)
+    rewards = rescore(trajectories, episodes)
+    returns = rewards.groupby(episodes).sum()
+    returns.index = trajectory_files
+    print(f"Rescored {len(trajectories)} steps of {len(trajectory_files)} episodes with {len(REWARD_FUNCTIONS)} "
+          f"reward functions in {time.perf_counter() - start:.2f}s")
+
+    # the environments are trained and generated with _penalty_reward_minute_static_fn
+    deviation = np.abs(rewards['_penalty_reward_minute_static_fn'] - trajectories['reward']).max() \
+        if len(trajectories) else 0.0
+    print(f"Maximum deviation from the recorded rewards: {deviation:.4f}")
+    print(returns.describe().T)
+    if args.output:
+        returns.to_csv(args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,163 @@
+import argparse
+import datetime
+import json
+import os
+import subprocess
+import time
+from pathlib import Path
+
+import numpy as np
+
+from PolicyRegistry import policies
+from SumoEnvironmentGenerator import SumoEnvironmentGenerator
+from SumoNetworkBuilder import SumoNetworkBuilder
+from benchmark_observation import benchmark_observation
+
+REWARD_FUNCTIONS = ('_reward_fn', '_penalty_reward_minute_fn', '_penalty_reward_minute_static_fn',
+                    '_penalty_reward_fn', '_penalty_cutoff_reward_fn')
+
+
+# Step-level benchmarks of the SUMO RL loop on 2lane_unprotected_right. Every run is appended as one JSON line to the
+# history file together with the commit, SUMO version and libsumo setting, and compared with the previous run.
+def benchmark_construction(environments: SumoEnvironmentGenerator, repeats: int) -> dict:
+    timings = {'construction_s': [], 'reset_s': [], 'close_s': []}
+    for _ in range(repeats):
+        start = time.perf_counter()
+        env = environments.get_training_env()
+        timings['construction_s'].append(time.perf_counter() - start)
+        start = time.perf_counter()
+        env.reset()
+        timings['reset_s'].append(time.perf_counter() - start)
+        start = time.perf_counter()
+        env.close()
+        timings['close_s'].append(time.perf_counter() - start)
+    return {name: float(np.median(values)) for name, values in timings.items()}
+
+
+def benchmark_steps(env, steps: int) -> dict:
+    env.reset()
+    actions = [env.action_space.sample() for _ in range(steps)]
+    start = time.perf_counter()
+    for action in actions:
+        _obs, _reward, terminated, truncated, _info = env.step(action)
+        if terminated or truncated:
+            env.reset()
+    return {'steps_per_s': steps / (time.perf_counter() - start)}
+
+
+def benchmark_rewards(env, steps: int, repeats: int) -> dict:
+    env.reset()
+    traffic_signal = env.traffic_signals[env.ts_ids[0]]
+    timings = {name: 0.0 for name in REWARD_FUNCTIONS}
+    for _ in range(steps):
+        env.step(env.action_space.sample())
+        last_measure = traffic_signal.last_measure
+        for name in REWARD_FUNCTIONS:
+            reward_fn = getattr(SumoEnvironmentGenerator, name)
+            start = time.perf_counter()
+            for _ in range(repeats):
+                reward_fn(traffic_signal)
+                traffic_signal.last_measure = last_measure
+            timings[name] += time.perf_counter() - start
+    return {f'reward{name}_us': timing / (steps * repeats) * 1e6 for name, timing in timings.items()}
+
+
+def benchmark_predict(model_path: str, observation_space, repeats: int) -> dict:
+    observations = [observation_space.sample() for _ in range(repeats)]
+    model = policies.get(model_path)
+    model.predict(observations[0], deterministic=True)
+    start = time.perf_counter()
+    for obs in observations:
+        model.predict(obs, deterministic=True)
+    results = {'predict_us': (time.perf_counter() - start) / repeats * 1e6}
+
+    exported = Path(model_path).with_suffix('.npz')
+    if exported.exists():
+        from NumpyPolicy import NumpyPolicy
+        policy = NumpyPolicy.load(exported)
+        start = time.perf_counter()
+        for obs in observations:
+            policy.act(obs)
+        results['numpy_act_us'] = (time.perf_counter() - start) / repeats * 1e6
+    return results
+
+
+def benchmark_episode(env, model_path: str = None) -> dict:
+    model = policies.get(model_path) if model_path else None
+    start = time.perf_counter()
+    obs, _info = env.reset()
+    done = False
+    steps = 0
+    while not done:
+        action = model.predict(obs, deterministic=True)[0] if model else env.action_space.sample()
+        obs, _reward, terminated, truncated, _info = env.step(action)
+        done = terminated or truncated
+        steps += 1
+    return {'episode_s': time.perf_counter() - start, 'episode_steps': steps}
+
+
+def run_info(env) -> dict:
+    commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True).stdout.strip()
+    env.reset()
+    sumo_version = env.sumo.getVersion()[1]
+    env.close()
+    return {
+        'time': datetime.datetime.now().isoformat(timespec='seconds'),
+        'commit': commit,
+        'sumo': sumo_version,
+        'libsumo': os.environ.get('LIBSUMO_AS_TRACI', '0') == '1',
+    }
+
+
+def compare(previous: dict, current: dict):
+    for name, value in current['results'].items():
+        before = previous['results'].get(name)
+        change = f"{(value - before) / before:+8.1%}" if before else ''
+        print(f"{name:>42}: {value:12.3f} {change}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model', default=None, help='agent zip for the predict and episode benchmarks')
+    parser.add_argument('--steps', type=int, default=500)
+    parser.add_argument('--repeats', type=int, default=10)
+    parser.add_argument('--duration', type=int, default=3600, help='simulated seconds of the episode benchmark')
+    parser.add_argument('--history', type=Path, default=Path('benchmarks', 'history.jsonl'))
+    args = parser.parse_args()
+
+    network = SumoNetworkBuilder(Path('nets', '2lane_unprotected_right'), '2lane_unprotected_right').build(
+        insert_probability=0.1, duration=3600, repeat_period=10)
+    environments = SumoEnvironmentGenerator(
+        net_file=str(network['net.xml']),
+        route_file=str(network['rou.xml']),
+        sumocfg_file=str(network['sumocfg']),
+        duration=args.duration,
+        learning_data_csv_name=None,
+    )
+
+    env = environments.get_training_env()
+    run = run_info(env)
+    results = benchmark_construction(environments, args.repeats)
+    results.update(benchmark_steps(env, args.steps))
+    results.update({f'observation_{name}_us': timing * 1e6 for name, timing in
+                    benchmark_observation(env, args.steps, args.repeats).items()})
+    results.update(benchmark_rewards(env, args.steps, args.repeats))
+    if args.model:
+        results.update(benchmark_predict(args.model, env.observation_space, args.steps))
+    results.update(benchmark_episode(env, args.model))
+    env.close()
+    run['results'] = results
+
+    history = args.history.read_text().splitlines() if args.history.exists() else []
+    if history:
+        print(f"Compared with {json.loads(history[-1])['commit']}:")
+        compare(json.loads(history[-1]), run)
+    else:
+        compare({'results': {}}, run)
+    args.history.parent.mkdir(parents=True, exist_ok=True)
+    with open(args.history, 'a') as file:
+        file.write(json.dumps(run) + '\n')
+
+
+if __name__ == '__main__':
+    main()
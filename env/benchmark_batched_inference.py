@@ -0,0 +1,71 @@
+import argparse
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+
+from PolicyRegistry import policies
+from SumoEnvironmentGenerator import SumoEnvironmentGenerator
+from SumoNetworkBuilder import SumoNetworkBuilder
+from SumoTraceGenerator import run_episodes_batched
+
+
+# Throughput of lockstep generation: transitions per second of one predict per observation (K=1) against one predict
+# per stacked batch of K observations, for the policy alone and for whole episodes including SUMO.
+def benchmark_predict(model_path: str, batch_size: int, steps: int) -> float:
+    model = policies.get(model_path)
+    observations = np.stack([model.observation_space.sample() for _ in range(batch_size)])
+    policies.predict(model_path, observations)
+    start = time.perf_counter()
+    for _ in range(steps):
+        policies.predict(model_path, observations)
+    return steps * batch_size / (time.perf_counter() - start)
+
+
+def benchmark_episodes(environments: SumoEnvironmentGenerator, model_path: str, batch_size: int,
+                       episodes: int) -> float:
+    with tempfile.TemporaryDirectory() as output_directory:
+        batch = [{
+            'output_prefix': str(Path(output_directory, str(i).zfill(4))),
+            'agent': 'benchmark',
+            'model_path': model_path,
+            'sumo_seed': i,
+            'desiredSpeed': 13.89,
+            'friction': 1.0,
+        } for i in range(episodes)]
+        start = time.perf_counter()
+        transitions = run_episodes_batched(environments, batch, batch_size)
+        return transitions / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model', default=str(Path('env', 'agents_paper', 'scratch_s50_f0.5.zip')))
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 16])
+    parser.add_argument('--steps', type=int, default=2000, help='predict calls per batch size')
+    parser.add_argument('--episodes', type=int, default=32, help='episodes per batch size (0 skips SUMO)')
+    parser.add_argument('--duration', type=int, default=600, help='simulated seconds per episode')
+    args = parser.parse_args()
+
+    for batch_size in args.batch_sizes:
+        transitions_per_second = benchmark_predict(args.model, batch_size, args.steps)
+        print(f"predict  K={batch_size:>3}: {transitions_per_second:10.1f} transitions/s")
+
+    if args.episodes:
+        network = SumoNetworkBuilder(Path('nets', '2lane_unprotected_right'), '2lane_unprotected_right').build(
+            insert_probability=0.1, duration=3600, repeat_period=10)
+        environments = SumoEnvironmentGenerator(
+            net_file=str(network['net.xml']),
+            route_file=str(network['rou.xml']),
+            sumocfg_file=str(network['sumocfg']),
+            duration=args.duration,
+            learning_data_csv_name=str(Path().joinpath('env', 'training_data', 'output.csv')),
+        )
+        for batch_size in args.batch_sizes:
+            throughput = benchmark_episodes(environments, args.model, batch_size, args.episodes)
+            print(f"episodes K={batch_size:>3}: {throughput:10.1f} transitions/s")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+import argparse
+import time
+from pathlib import Path
+
+import numpy as np
+
+from SumoEnvironmentGenerator import SumoEnvironmentGenerator, FrictionObservationFunction, \
+    BatchedFrictionObservationFunction
+from SumoNetworkBuilder import SumoNetworkBuilder
+
+
+# Micro-benchmark of the per-step observation cost: both observation functions are evaluated on the same
+# traffic signal state of a running 2lane_unprotected_right episode. The caller owns the environment.
+def benchmark_observation(env, steps: int, repeats: int) -> dict:
+    env.reset()
+    traffic_signal = env.traffic_signals[env.ts_ids[0]]
+    observation_functions = {
+        'traci': FrictionObservationFunction(traffic_signal),
+        'batched': BatchedFrictionObservationFunction(traffic_signal),
+    }
+    timings = {name: 0.0 for name in observation_functions}
+
+    for _ in range(steps):
+        env.step(env.action_space.sample())
+        expected = observation_functions['traci']()
+        for name, observation_function in observation_functions.items():
+            start = time.perf_counter()
+            for _ in range(repeats):
+                # drop the subscription results cached by the step or the previous call, so every call fetches them
+                env.lane_subscription_results = (None, None)
+                observation = observation_function()
+            timings[name] += time.perf_counter() - start
+            if not np.allclose(observation, expected):
+                raise AssertionError(f"{name} observation differs: {observation} != {expected}")
+
+    return {name: timing / (steps * repeats) for name, timing in timings.items()}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--steps', type=int, default=500)
+    parser.add_argument('--repeats', type=int, default=10)
+    args = parser.parse_args()
+
+    network = SumoNetworkBuilder(Path('nets', '2lane_unprotected_right'), '2lane_unprotected_right').build(
+        insert_probability=0.1, duration=3600, repeat_period=10)
+    environments = SumoEnvironmentGenerator(
+        net_file=str(network['net.xml']),
+        route_file=str(network['rou.xml']),
+        sumocfg_file=str(network['sumocfg']),
+        duration=3600,
+        learning_data_csv_name=str(Path().joinpath('env', 'training_data', 'output.csv')),
+    )
+
+    # the plain observation function for the environment itself, so its steps do not fetch subscription results
+    env = environments.get_training_env(observation_class=FrictionObservationFunction)
+    timings = benchmark_observation(env, args.steps, args.repeats)
+    env.close()
+    for name, timing in timings.items():
+        print(f"{name:>8}: {timing * 1e6:8.1f} us per observation")
+    print(f"speedup: {timings['traci'] / timings['batched']:.2f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,136 @@
+import argparse
+import json
+import math
+import multiprocessing
+import os
+import resource
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+config_directory = Path('nets', '2lane_unprotected_right')
+
+
+# Steps per second and memory of the multi-agent environment as the number N of signalized junctions grows, on
+# corridors (1 x N) or square-ish grids of the 2lane_unprotected_right junction. All signals are controlled by one
+# shared policy with a single batched predict per step (rotating phases without a model). Every size runs in a fresh
+# spawned process, so the peak resident memory of one size is not inflated by the ones before.
+def grid_shape(signals: int, layout: str) -> tuple[int, int]:
+    if layout == 'corridor':
+        return 1, signals
+    rows = max(int(math.sqrt(signals)), 1)
+    return rows, math.ceil(signals / rows)
+
+
+def benchmark_size(rows: int, columns: int, model_path: str | None, steps: int, unbatched_steps: int) -> dict:
+    # SUMO has to run inside this process for ru_maxrss to include the simulation, so libsumo is selected before
+    # sumo_rl is imported and required
+    os.environ['LIBSUMO_AS_TRACI'] = '1'
+    import traci
+    from SharedSignalPolicy import SharedSignalPolicy
+    from SumoEnvironmentGenerator import SumoEnvironmentGenerator
+    from SumoNetworkBuilder import SumoGridNetworkBuilder
+    if not traci.isLibsumo():
+        raise RuntimeError("libsumo is not available, the memory of a SUMO child process would not be measured")
+
+    baseline_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    network = SumoGridNetworkBuilder(config_directory, '2lane_unprotected_right', rows, columns).build(
+        insert_probability=0.1, duration=steps, repeat_period=10)
+    build_time = time.perf_counter() - start
+    environments = SumoEnvironmentGenerator(
+        net_file=str(network['net.xml']),
+        route_file=str(network['rou.xml']),
+        sumocfg_file=str(network['sumocfg']),
+        duration=steps,
+        learning_data_csv_name=str(Path().joinpath('env', 'training_data', 'output.csv')),
+    )
+
+    start = time.perf_counter()
+    env = environments.get_multi_agent_env(sumo_seed=0)
+    observations = env.reset()
+    reset_time = time.perf_counter() - start
+    policy = SharedSignalPolicy.for_env(model_path, env) if model_path else None
+    num_green_phases = env.traffic_signals[env.ts_ids[0]].num_green_phases
+
+    policy_time = simulation_time = unbatched_time = 0.0
+    decisions = executed_steps = 0
+    for step in range(steps):
+        start = time.perf_counter()
+        if policy:
+            actions = policy.act(observations)
+        else:
+            actions = {ts: (step // 30) % num_green_phases for ts in observations}
+        policy_time += time.perf_counter() - start
+        if policy and step < unbatched_steps:
+            # the same decisions with one predict per signal, for comparison only
+            start = time.perf_counter()
+            for ts in observations:
+                policy.predict(observations[ts][np.newaxis])
+            unbatched_time += time.perf_counter() - start
+
+        start = time.perf_counter()
+        observations, _rewards, dones, _info = env.step(actions)
+        simulation_time += time.perf_counter() - start
+        decisions += len(actions)
+        executed_steps += 1
+        if dones['__all__']:
+            break
+    vehicles = env.sumo.vehicle.getIDCount()
+    env.close()
+
+    signals = rows * columns
+    total_time = policy_time + simulation_time
+    return {
+        'signals': signals,
+        'rows': rows,
+        'columns': columns,
+        'build_s': build_time,
+        'reset_s': reset_time,
+        'steps_per_s': executed_steps / total_time,
+        'decisions_per_s': decisions / total_time,
+        'simulation_ms': simulation_time / executed_steps * 1e3,
+        'policy_ms': policy_time / executed_steps * 1e3,
+        'unbatched_policy_ms': unbatched_time / min(unbatched_steps, executed_steps) * 1e3
+        if policy and unbatched_steps else np.nan,
+        'vehicles': vehicles,
+        # ru_maxrss is in KiB on Linux
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'environment_rss_mb': (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - baseline_rss) / 1024,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--signals', type=int, nargs='+', default=[1, 2, 4, 9, 16, 25, 49, 100, 144])
+    parser.add_argument('--layout', choices=['grid', 'corridor'], default='grid')
+    parser.add_argument('--model', default=None, help='shared agent (zip or exported npz), default: rotating phases')
+    parser.add_argument('--steps', type=int, default=600, help='simulated seconds per size')
+    parser.add_argument('--unbatched-steps', type=int, default=20,
+                        help='steps that also time one predict per signal for comparison')
+    parser.add_argument('--output', type=Path, default=None, help='json of the results')
+    args = parser.parse_args()
+
+    rows = []
+    context = multiprocessing.get_context('spawn')
+    for signals in args.signals:
+        shape = grid_shape(signals, args.layout)
+        # libsumo runs one simulation per process, and a fresh process per size keeps the memory peaks apart
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+            result = executor.submit(benchmark_size, *shape, args.model, args.steps, args.unbatched_steps).result()
+        print(f"N={result['signals']:>4} ({shape[0]}x{shape[1]}): {result['steps_per_s']:8.1f} steps/s, "
+              f"{result['decisions_per_s']:9.1f} decisions/s, {result['peak_rss_mb']:7.1f} MB")
+        rows.append(result)
+
+    results = pd.DataFrame(rows)
+    with pd.option_context('display.width', 200, 'display.max_columns', None):
+        print(results.round(3).to_string(index=False))
+    if args.output:
+        args.output.write_text(json.dumps(rows, indent=4))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+import argparse
+import hashlib
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from EpisodeMetricsCollector import EpisodeMetricsCollector
+from PolicyRegistry import policies
+from ShiftDetector import FEATURES, ShiftDetector, observation_features
+from SumoEnvironmentGenerator import SumoEnvironmentGenerator
+from SumoNetworkBuilder import SumoNetworkBuilder
+from SumoTraceGenerator import network_key
+
+SPEED = 13.89
+FRICTION = 1.0
+# interventions applied in the middle of an episode, none measures the false alarms
+SCENARIOS = {
+    'none': {},
+    'speed_22.22': {'speed': 22.22},
+    'friction_0.5': {'friction_coefficient': 0.5},
+    'friction_0.25': {'friction_coefficient': 0.25},
+}
+
+
+# Detection delay and per-step overhead of the ShiftDetector. Every scenario is simulated once per seed with the
+# intervention applied at shift_step and the monitor signals of every step are stored, so detector settings can be
+# compared on the same replayed episodes without simulating again.
+def record_episode(environments: SumoEnvironmentGenerator, intervention: dict, shift_step: int, steps: int,
+                   sumo_seed: int, model_path: str = None) -> np.ndarray:
+    env = environments.get_generation_env(output_prefix='', sumo_seed=sumo_seed)
+    obs, info = env.reset()
+    metrics = EpisodeMetricsCollector()
+    metrics.attach(env)
+    traffic_signal = env.traffic_signals[env.ts_ids[0]]
+
+    values = np.zeros((steps, len(FEATURES)))
+    last_braking = 0
+    for step in range(steps):
+        if step == shift_step:
+            SumoEnvironmentGenerator.apply_intervention(env, **intervention)
+        if model_path:
+            action = policies.predict(model_path, obs)
+        else:
+            # without an agent the phases simply rotate
+            action = (step // 30) % traffic_signal.num_green_phases
+        obs, _reward, terminated, truncated, info = env.step(action)
+        values[step, :3] = observation_features(obs, traffic_signal.num_green_phases)
+        values[step, 3] = metrics.emergency_braking - last_braking
+        values[step, 4] = len(env.sumo.simulation.getCollisions())
+        last_braking = metrics.emergency_braking
+        if terminated or truncated:
+            values = values[:step + 1]
+            break
+    env.close()
+    return values
+
+
+def replay(values: np.ndarray, shift_step: int, detector: ShiftDetector) -> dict:
+    start = time.perf_counter()
+    for step_values in values:
+        detector.update(step_values)
+    overhead = (time.perf_counter() - start) / len(values)
+    detections = [event for event in detector.events if event['step'] > shift_step]
+    return {
+        'false_alarms': len(detector.events) - len(detections),
+        'delay': detections[0]['step'] - shift_step if detections else np.nan,
+        'feature': detections[0]['feature'] if detections else None,
+        'overhead_us': overhead * 1e6,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--seeds', type=int, default=5)
+    parser.add_argument('--steps', type=int, default=3600)
+    parser.add_argument('--shift-step', type=int, default=1800)
+    parser.add_argument('--model', default=None, help='agent to control the signal (default: rotating phases)')
+    parser.add_argument('--replays', type=Path, default=Path('cache', 'shift_replays'))
+    parser.add_argument('--block-size', type=int, default=30)
+    parser.add_argument('--burn-in-blocks', type=int, default=10)
+    parser.add_argument('--warmup-blocks', type=int, default=10)
+    parser.add_argument('--drift', type=float, default=0.5)
+    parser.add_argument('--threshold', type=float, default=12.0)
+    args = parser.parse_args()
+
+    network = SumoNetworkBuilder(Path('nets', '2lane_unprotected_right'), '2lane_unprotected_right').build(
+        insert_probability=0.1, duration=args.steps, repeat_period=10, friction=FRICTION, speed=SPEED)
+    environments = SumoEnvironmentGenerator(
+        net_file=str(network['net.xml']),
+        route_file=str(network['rou.xml']),
+        sumocfg_file=str(network['sumocfg']),
+        duration=args.steps,
+        learning_data_csv_name=str(Path().joinpath('env', 'training_data', 'output.csv')),
+    )
+
+    args.replays.mkdir(parents=True, exist_ok=True)
+    agent = Path(args.model).stem if args.model else 'rotating'
+    # replays depend on the network build and the exact agent, not only on its name
+    model = str(Path(args.model).resolve()) if args.model else ''
+    replay_key = hashlib.sha256((network_key(environments) + model).encode()).hexdigest()[:16]
+    rows = []
+    for scenario, intervention in SCENARIOS.items():
+        for seed in range(args.seeds):
+            replay_file = args.replays.joinpath(
+                f'{agent}_{replay_key}_{scenario}_{args.steps}_{args.shift_step}_{seed}.npy')
+            if not replay_file.exists():
+                np.save(replay_file, record_episode(environments, intervention, args.shift_step, args.steps, seed,
+                                                    args.model))
+            detector = ShiftDetector(block_size=args.block_size, burn_in_blocks=args.burn_in_blocks,
+                                     warmup_blocks=args.warmup_blocks, drift=args.drift, threshold=args.threshold)
+            # every detection without an intervention is a false alarm
+            shift_step = args.shift_step if intervention else args.steps
+            rows.append({'scenario': scenario, 'seed': seed, **replay(np.load(replay_file), shift_step, detector)})
+
+    results = pd.DataFrame(rows)
+    summary = results.groupby('scenario', sort=False).agg(
+        detected=('delay', lambda delays: delays.notna().mean()),
+        mean_delay=('delay', 'mean'),
+        max_delay=('delay', 'max'),
+        false_alarms=('false_alarms', 'sum'),
+        overhead_us=('overhead_us', 'mean'),
+    )
+    print(results.to_string(index=False))
+    print(summary.to_string())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+import argparse
+import time
+from pathlib import Path
+
+import numpy as np
+import torch
+from stable_baselines3 import A2C
+
+from NumpyPolicy import NumpyPolicy
+
+
+# Exports the deterministic part of an A2C MlpPolicy (policy MLP + action net, argmax of the logits) into a NumPy
+# artifact for NumpyPolicy. The artifact also holds recorded observations and the actions the original model chose
+# for them, which NumpyPolicy.load checks for parity.
+def export_policy(model: A2C, output_file: Path, observations: np.ndarray) -> NumpyPolicy:
+    layers = [module for module in model.policy.mlp_extractor.policy_net if isinstance(module, torch.nn.Linear)]
+    activation = model.policy.activation_fn.__name__
+    layers.append(model.policy.action_net)
+    activations = [activation] * (len(layers) - 1) + ['Identity']
+
+    observations = np.asarray(observations, dtype=np.float32).reshape(-1, *model.observation_space.shape)
+    actions, _state = model.predict(observations, deterministic=True)
+
+    artifact = {'layers': len(layers), 'activations': np.array(activations),
+                'observations': observations, 'actions': actions}
+    for i, layer in enumerate(layers):
+        artifact[f'weight_{i}'] = layer.weight.detach().cpu().numpy().T.copy()
+        artifact[f'bias_{i}'] = layer.bias.detach().cpu().numpy()
+    with open(output_file, 'wb') as file:
+        np.savez(file, **artifact)
+    return NumpyPolicy.load(output_file)
+
+
+def record_observations(model: A2C, steps: int) -> np.ndarray:
+    # observations of FrictionObservationFunction along an episode of the exported agent
+    from SumoEnvironmentGenerator import SumoEnvironmentGenerator, FrictionObservationFunction
+    from SumoNetworkBuilder import SumoNetworkBuilder
+
+    network = SumoNetworkBuilder(Path('nets', '2lane_unprotected_right'), '2lane_unprotected_right').build(
+        insert_probability=0.1, duration=3600, repeat_period=10)
+    env = SumoEnvironmentGenerator(
+        net_file=str(network['net.xml']),
+        route_file=str(network['rou.xml']),
+        sumocfg_file=str(network['sumocfg']),
+        duration=3600,
+        learning_data_csv_name=str(Path().joinpath('env', 'training_data', 'output.csv')),
+    ).get_training_env()
+
+    env.reset()
+    observation_function = FrictionObservationFunction(env.traffic_signals[env.ts_ids[0]])
+    observations = []
+    for _ in range(steps):
+        obs = observation_function()
+        observations.append(obs)
+        action, _state = model.predict(obs, deterministic=True)
+        _obs, _reward, terminated, truncated, _info = env.step(action)
+        if terminated or truncated:
+            env.reset()
+            observation_function = FrictionObservationFunction(env.traffic_signals[env.ts_ids[0]])
+    env.close()
+    return np.array(observations)
+
+
+def benchmark_act(policy: NumpyPolicy, observations: np.ndarray, repeats: int = 10) -> float:
+    start = time.perf_counter()
+    for _ in range(repeats):
+        for obs in observations:
+            policy.act(obs)
+    return (time.perf_counter() - start) / (repeats * len(observations))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('model', type=Path, help='saved agent, e.g. env/agents_paper/scratch_s50_f0.5.zip')
+    parser.add_argument('--output', type=Path, default=None, help='defaults to the model path with .npz suffix')
+    parser.add_argument('--observations', type=Path, default=None,
+                        help='recorded observations (.npy) to check parity on instead of recording new ones')
+    parser.add_argument('--steps', type=int, default=720, help='observations to record')
+    args = parser.parse_args()
+
+    model = A2C.load(args.model, device='cpu')
+    observations = np.load(args.observations) if args.observations else record_observations(model, args.steps)
+    output = args.output or args.model.with_suffix('.npz')
+    policy = export_policy(model, output, observations)
+    print(f"Exported {args.model} to {output}, parity checked on {len(observations)} observations")
+    print(f"act: {benchmark_act(policy, observations) * 1e6:.1f} us per observation (batch size 1)")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,23 +1,25 @@
-import numpy as np
-import pandas as pd
-
-print("Begin training configuration")
+import argparse
 from pathlib import Path
-import xml.etree.ElementTree as ET
-import os
-import subprocess
 
-# Ensure SUMO_HOME is set
-sumo_home = os.environ.get('SUMO_HOME')
-if not sumo_home:
-    raise EnvironmentError(
-        "SUMO_HOME environment variable is not set. Please set it to your SUMO installation directory.")
+import numpy as np
+
+from AdaptiveExperimentScheduler import AdaptiveExperimentScheduler, precision_target
+from SumoEnvironmentGenerator import SumoEnvironmentGenerator
+from SumoNetworkBuilder import SumoNetworkBuilder
+from SumoTraceGenerator import SumoTraceGenerator, episode_sumo_seed
 
 # Generation Parameters
 agents_path = Path().joinpath('env', 'agents_paper')
 RANDOM_FRICTION = True
 RANDOM_SPEED = True
-rng = np.random.default_rng()
+agents = {
+    'scratch_s50_f0.5': agents_path.joinpath('scratch_s50_f0.5.zip'),
+    'scratch_s50_f1': agents_path.joinpath('scratch_s50_f1.zip'),
+    'scratch_s80_f0.5': agents_path.joinpath('scratch_s80_f0.5.zip'),
+    'scratch_s80_f1': agents_path.joinpath('scratch_s80_f1.zip'),
+    'transs50f1_s80_f1': agents_path.joinpath('transs50f1_s80_f1_1.zip'),
+    'transs80f1_s80_f0.5': agents_path.joinpath('transs80f1_s80_f0.5_0.zip'),
+}
 
 # Constants / Parameters
 SPEED = 13.89
@@ -27,124 +29,15 @@ DURATION = 3600
 REPEAT_PERIOD = 10
 DEFAULT_DECEL = 4.5
 DEFAULT_EMERGENCY_DECEL = 9.0
+EPISODES = 1000
 
 # File Paths
 config_directory = Path('nets', '2lane_unprotected_right')
-config_files = {
-    'netccfg_edges': config_directory.joinpath('netconfig', 'edges.edg.xml'),
-    'netccfg': config_directory.joinpath('2lane_unprotected_right.netccfg'),
-    'duarcfg': config_directory.joinpath('2lane_unprotected_right.duarcfg'),
-    'net.xml': config_directory.joinpath('2lane_unprotected_right.net.xml'),
-    'rou.xml': config_directory.joinpath('2lane_unprotected_right.rou.xml'),
-    'routes.rou.xml': config_directory.joinpath('routes.rou.xml'),
-    'config.rou.xml': config_directory.joinpath('config.rou.xml'),
-    'experimental.rou.xml': config_directory.joinpath('experimental.rou.xml'),
-}
-findAllRoutes = Path(sumo_home, 'tools', 'findAllRoutes.py')
-vehicle2flow = Path(sumo_home, 'tools', 'route', 'vehicle2flow.py')
-
-
-# Update Friction Coefficients in Edge Configuration
-def update_friction_coefficients(file_path, friction):
-    tree = ET.parse(file_path)
-    root = tree.getroot()
-    for param in root.findall(".//lane/param[@key='frictionCoefficient']"):
-        param.set('value', str(friction))
-    tree.write(file_path)
-
-
-update_friction_coefficients(config_files['netccfg_edges'], FRICTION)
-
-
-# Execute SUMO Tools using subprocess
-def run_command(command):
-    result = subprocess.run(command, shell=True, text=True, capture_output=True)
-    if result.returncode != 0:
-        raise RuntimeError(f"Command failed: {command}\n{result.stderr}")
-    print(result.stdout)
-
-
-run_command(f"netconvert --configuration-file {config_files['netccfg']}")
-run_command(f"python {findAllRoutes} -n {config_files['net.xml']} -o {config_files['routes.rou.xml']} "
-            f"-s southJunction,westJunction -t junctionEast,junctionNorth")
-run_command(f"duarouter --configuration-file {config_files['duarcfg']}")
-run_command(f"python {vehicle2flow} {config_files['config.rou.xml']} -o {config_files['rou.xml']} "
-            f"-e {DURATION} -r {REPEAT_PERIOD}")
-
-
-# Update Vehicle Configuration for Friction Adjusted Braking Distance
-def update_vehicle_type_parameters(file_path, speed, default_decel, default_emergency_decel, friction):
-    tree = ET.parse(file_path)
-    root = tree.getroot()
-    for vType in root.findall('vType'):
-        vClass = vType.attrib.get('vClass')
-        if vClass and vClass != 'passenger':
-            raise NotImplementedError("Check for non-passenger vehicle classes not implemented")
-        vType.attrib.update({
-            'maxSpeed': str(speed),
-            'decel': str(default_decel * friction),
-            'emergencyDecel': str(default_emergency_decel * friction),
-        })
-    tree.write(file_path, xml_declaration=True, encoding='UTF-8')
-
-
-update_vehicle_type_parameters(config_files['rou.xml'], SPEED, DEFAULT_DECEL, DEFAULT_EMERGENCY_DECEL, FRICTION)
-
-
-# Update Vehicle Flows for Forcing Unprotected Right Action
-def update_flows(file_path, insert_probability):
-    tree = ET.parse(file_path)
-    root = tree.getroot()
-    for flow in root.findall('flow'):
-        match flow.attrib.get('id'):
-            case 'southEast':
-                flow.set('period', f"exp({insert_probability})")
-            case 'southNorth':
-                flow.set('period', f"exp({insert_probability})")
-            case 'westEastTop':
-                flow.set('period', f"exp({2 * insert_probability})")
-            case id if 'westEastBottom' in id:
-                flow.set('end', str(float(flow.get('begin')) + 600))
-                if float(flow.get('begin')) % 1200 == 0:
-                    flow.set('period', f"exp({1 * insert_probability})")
-                else:
-                    flow.set('period', f"exp({0.0001 * insert_probability})")
-    tree.write(file_path, xml_declaration=True, encoding='UTF-8')
-
-
-update_flows(config_files['rou.xml'], INSERT_PROBABILITY)
-print("Finished training configuration")
-
-print("Begin initiating environment")
-from SumoEnvironmentGenerator import SumoEnvironmentGenerator
-from pathlib import Path
-
-net_name = '2lane_unprotected_right'
-
-environments = SumoEnvironmentGenerator(
-    net_file=str(Path().joinpath('nets', net_name, f'{net_name}.net.xml')),
-    route_file=str(Path().joinpath('nets', net_name, f'{net_name}.rou.xml')),
-    sumocfg_file=str(Path().joinpath('nets', net_name, f'{net_name}.sumocfg')),
-    duration=3600,
-    learning_data_csv_name=str(Path().joinpath('env', 'training_data', 'output.csv')),
-)
-print("Finished initiating environment")
-from stable_baselines3.a2c import A2C
-
-models = {
-    'scratch_s50_f0.5':     A2C.load(agents_path.joinpath('scratch_s50_f0.5.zip')),
-    'scratch_s50_f1': A2C.load(agents_path.joinpath('scratch_s50_f1.zip')),
-    'scratch_s80_f0.5': A2C.load(agents_path.joinpath('scratch_s80_f0.5.zip')),
-    'scratch_s80_f1': A2C.load(agents_path.joinpath('scratch_s80_f1.zip')),
-    'transs50f1_s80_f1': A2C.load(agents_path.joinpath('transs50f1_s80_f1_1.zip')),
-    'transs80f1_s80_f0.5': A2C.load(agents_path.joinpath('transs80f1_s80_f0.5_0.zip'))
-}
-
-
-print(f"Begin generating with Speed {SPEED} and friction {FRICTION}")
 
 
-for i in range(1000):
+def make_episode(model_name: str, i: int, seed_sequence: np.random.SeedSequence) -> dict:
+    # all agents of one iteration share the drawn conditions and the SUMO seed
+    rng = np.random.default_rng(seed_sequence)
 
     current_friction = FRICTION
     current_speed = SPEED
@@ -156,35 +49,87 @@ for i in range(1000):
         possible_speeds = [8.33, 13.89, 22.22, 27.78]
         current_speed = rng.choice(possible_speeds)
 
-    for model_name, model in models.items():
-
-        simulation_output_path = Path().joinpath('traces_paper', model_name + "_random")
-        Path.mkdir(simulation_output_path, parents=True, exist_ok=True)
-        experiment_string = str(i).zfill(4)
-        env = environments.get_generation_env(output_prefix=str(simulation_output_path.joinpath(experiment_string)))
-        model.set_env(env)
-
-        metadata = {'desiredSpeed': current_speed, 'friction': current_friction}
-        pd.DataFrame(metadata, index=['metadata']).to_xml(
-            Path(simulation_output_path).joinpath(experiment_string + '_metadata.xml'))
-
-        obs, info = env.reset()
-        vehicletype = env.sumo.vehicletype
-
-        if RANDOM_SPEED:
-            vehicletype.setMaxSpeed('carCustom', current_speed)
-
-        if RANDOM_FRICTION:
-            vehicletype.setDecel('carCustom', vehicletype.getDecel('carCustom') * current_friction)
-            vehicletype.setEmergencyDecel('carCustom',
-                                          vehicletype.getEmergencyDecel('carCustom') * current_friction)
-            for traffic_signal in env.traffic_signals.values():
-                for lane in traffic_signal.lanes:
-                    traffic_signal.sumo.lane.setParameter(lane, 'frictionCoefficient', current_friction)
-
-        done = False
-        while not done:
-            action, _state = model.predict(obs, deterministic=True)
-            obs, _reward, terminated, truncated, info = env.step(action)
-            done = terminated or truncated
-        env.close()
+    simulation_output_path = Path().joinpath('traces_paper', model_name + "_random")
+    Path.mkdir(simulation_output_path, parents=True, exist_ok=True)
+    experiment_string = str(i).zfill(4)
+    return {
+        'output_prefix': str(simulation_output_path.joinpath(experiment_string)),
+        'agent': model_name,
+        'model_path': str(agents[model_name]),
+        'sumo_seed': episode_sumo_seed(seed_sequence),
+        'desiredSpeed': float(current_speed),
+        'friction': float(current_friction),
+        'apply_speed': RANDOM_SPEED,
+        'apply_friction': RANDOM_FRICTION,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, default=1, help='number of parallel SUMO worker processes')
+    parser.add_argument('--seed', type=int, default=None, help='base seed for per-episode seeding')
+    parser.add_argument('--episodes', type=int, default=EPISODES,
+                        help='episodes per agent (the maximum per agent with --precision)')
+    parser.add_argument('--precision', type=precision_target, action='append', default=[],
+                        help='adaptively add episodes until the confidence interval half-width of an outcome is '
+                             'reached, e.g. --precision waitingTime=1 --precision collisions=0.05')
+    parser.add_argument('--pooled', action='store_true', help='reuse warm SUMO instances across episodes')
+    parser.add_argument('--batch-size', type=int, default=1,
+                        help='episodes stepped in lockstep with one batched predict (replaces --workers/--pooled)')
+    parser.add_argument('--warmup', type=int, default=0,
+                        help='seconds of shared warm-up that interventions fork from (0 simulates every episode fully)')
+    parser.add_argument('--xml-outputs', action='store_true',
+                        help='also write the SUMO statistics/collisions/tripinfo/ssm XML outputs')
+    parser.add_argument('--profile', action='store_true',
+                        help='write per-episode phase timings and TraCI call counts (<episode>_profile.json)')
+    parser.add_argument('--trajectories', action='store_true',
+                        help='record the reward function inputs per step (<episode>_trajectory.npy)')
+    parser.add_argument('--trace-store', type=Path, default=None,
+                        help='also append every episode summary to this columnar trace store (needs pyarrow)')
+    args = parser.parse_args()
+
+    print("Begin training configuration")
+    network = SumoNetworkBuilder(config_directory, '2lane_unprotected_right').build(
+        insert_probability=INSERT_PROBABILITY,
+        duration=DURATION,
+        repeat_period=REPEAT_PERIOD,
+        friction=FRICTION,
+        speed=SPEED,
+        default_decel=DEFAULT_DECEL,
+        default_emergency_decel=DEFAULT_EMERGENCY_DECEL,
+    )
+    print(f"Finished training configuration in {network['directory']}")
+
+    print("Begin initiating environment")
+    environments = SumoEnvironmentGenerator(
+        net_file=str(network['net.xml']),
+        route_file=str(network['rou.xml']),
+        sumocfg_file=str(network['sumocfg']),
+        duration=3600,
+        learning_data_csv_name=str(Path().joinpath('env', 'training_data', 'output.csv')),
+    )
+    print("Finished initiating environment")
+
+    print(f"Begin generating with Speed {SPEED} and friction {FRICTION}")
+
+    trace_generator = SumoTraceGenerator(workers=args.workers, seed=args.seed, pooled=args.pooled,
+                                         warmup=args.warmup, xml_outputs=args.xml_outputs,
+                                         trace_store=args.trace_store, batch_size=args.batch_size,
+                                         profile=args.profile, trajectories=args.trajectories)
+    if args.precision:
+        scheduler = AdaptiveExperimentScheduler(trace_generator, dict(args.precision), max_episodes=args.episodes,
+                                                seed=args.seed)
+        report = scheduler.run(environments, list(agents), make_episode)
+        print(report)
+        print(f"Finished generating {report['episodes'].sum()} instead of {len(agents) * args.episodes} episodes")
+        return
+
+    episodes = [make_episode(model_name, i, seed_sequence)
+                for i, seed_sequence in enumerate(np.random.SeedSequence(args.seed).spawn(args.episodes))
+                for model_name in agents]
+    generated = trace_generator.run_episodes(environments, episodes)
+    print(f"Finished generating {generated} of {len(episodes)} episodes")
+
+
+if __name__ == '__main__':
+    main()
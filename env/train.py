@@ -1,14 +1,13 @@
-print("Begin training configuration")
+import argparse
+import time
 from pathlib import Path
-import xml.etree.ElementTree as ET
-import os
-import subprocess
 
-# Ensure SUMO_HOME is set
-sumo_home = os.environ.get('SUMO_HOME')
-if not sumo_home:
-    raise EnvironmentError(
-        "SUMO_HOME environment variable is not set. Please set it to your SUMO installation directory.")
+import numpy as np
+from stable_baselines3.a2c import A2C
+
+from EnvironmentProfiler import ProfilerCallback
+from SumoEnvironmentGenerator import EpisodeSeedWrapper, SumoEnvironmentGenerator
+from SumoNetworkBuilder import SumoNetworkBuilder
 
 # Constants / Parameters
 SPEED = 22.22
@@ -21,125 +20,90 @@ DEFAULT_EMERGENCY_DECEL = 9.0
 
 # File Paths
 config_directory = Path('nets', '2lane_unprotected_right')
-config_files = {
-    'netccfg_edges': config_directory.joinpath('netconfig', 'edges.edg.xml'),
-    'netccfg': config_directory.joinpath('2lane_unprotected_right.netccfg'),
-    'duarcfg': config_directory.joinpath('2lane_unprotected_right.duarcfg'),
-    'net.xml': config_directory.joinpath('2lane_unprotected_right.net.xml'),
-    'rou.xml': config_directory.joinpath('2lane_unprotected_right.rou.xml'),
-    'routes.rou.xml': config_directory.joinpath('routes.rou.xml'),
-    'config.rou.xml': config_directory.joinpath('config.rou.xml'),
-    'experimental.rou.xml': config_directory.joinpath('experimental.rou.xml'),
-}
-findAllRoutes = Path(sumo_home, 'tools', 'findAllRoutes.py')
-vehicle2flow = Path(sumo_home, 'tools', 'route', 'vehicle2flow.py')
-
-
-# Update Friction Coefficients in Edge Configuration
-def update_friction_coefficients(file_path, friction):
-    tree = ET.parse(file_path)
-    root = tree.getroot()
-    for param in root.findall(".//lane/param[@key='frictionCoefficient']"):
-        param.set('value', str(friction))
-    tree.write(file_path)
-
-
-update_friction_coefficients(config_files['netccfg_edges'], FRICTION)
-
-
-# Execute SUMO Tools using subprocess
-def run_command(command):
-    result = subprocess.run(command, shell=True, text=True, capture_output=True)
-    if result.returncode != 0:
-        raise RuntimeError(f"Command failed: {command}\n{result.stderr}")
-    print(result.stdout)
-
-
-run_command(f"netconvert --configuration-file {config_files['netccfg']}")
-run_command(f"python {findAllRoutes} -n {config_files['net.xml']} -o {config_files['routes.rou.xml']} "
-            f"-s southJunction,westJunction -t junctionEast,junctionNorth")
-run_command(f"duarouter --configuration-file {config_files['duarcfg']}")
-run_command(f"python {vehicle2flow} {config_files['config.rou.xml']} -o {config_files['rou.xml']} "
-            f"-e {DURATION} -r {REPEAT_PERIOD}")
-
-
-# Update Vehicle Configuration for Friction Adjusted Braking Distance
-def update_vehicle_type_parameters(file_path, speed, default_decel, default_emergency_decel, friction):
-    tree = ET.parse(file_path)
-    root = tree.getroot()
-    for vType in root.findall('vType'):
-        vClass = vType.attrib.get('vClass')
-        if vClass and vClass != 'passenger':
-            raise NotImplementedError("Check for non-passenger vehicle classes not implemented")
-        vType.attrib.update({
-            'maxSpeed': str(speed),
-            'decel': str(default_decel * friction),
-            'emergencyDecel': str(default_emergency_decel * friction),
-        })
-    tree.write(file_path, xml_declaration=True, encoding='UTF-8')
-
-
-update_vehicle_type_parameters(config_files['rou.xml'], SPEED, DEFAULT_DECEL, DEFAULT_EMERGENCY_DECEL, FRICTION)
-
-
-# Update Vehicle Flows for Forcing Unprotected Right Action
-def update_flows(file_path, insert_probability):
-    tree = ET.parse(file_path)
-    root = tree.getroot()
-    for flow in root.findall('flow'):
-        match flow.attrib.get('id'):
-            case 'southEast':
-                flow.set('period', f"exp({insert_probability})")
-            case 'southNorth':
-                flow.set('period', f"exp({insert_probability})")
-            case 'westEastTop':
-                flow.set('period', f"exp({2 * insert_probability})")
-            case id if 'westEastBottom' in id:
-                flow.set('end', str(float(flow.get('begin')) + 600))
-                if float(flow.get('begin')) % 1200 == 0:
-                    flow.set('period', f"exp({1 * insert_probability})")
-                else:
-                    flow.set('period', f"exp({0.0001 * insert_probability})")
-    tree.write(file_path, xml_declaration=True, encoding='UTF-8')
-
-
-update_flows(config_files['rou.xml'], INSERT_PROBABILITY)
-print("Finished training configuration")
-
-print("Begin initiating environment")
-from SumoEnvironmentGenerator import SumoEnvironmentGenerator
-from pathlib import Path
-
-net_name = '2lane_unprotected_right'
-
-environments = SumoEnvironmentGenerator(
-    net_file=str(Path().joinpath('nets', net_name, f'{net_name}.net.xml')),
-    route_file=str(Path().joinpath('nets', net_name, f'{net_name}.rou.xml')),
-    sumocfg_file=str(Path().joinpath('nets', net_name, f'{net_name}.sumocfg')),
-    duration=3600,
-    learning_data_csv_name=str(Path().joinpath('env', 'training_data', 'output.csv')),
-)
-print("Finished initiating environment")
+initial_agent = Path().joinpath('env', 'agents_paper', 'scratch_s50_f0.5.zip')
 
-print(f"Begin training with Speed {SPEED} and friction {FRICTION}")
-from stable_baselines3.a2c import A2C
 
-for i in range(2):
+def single_env_steps_per_second(environments: SumoEnvironmentGenerator, timesteps: int) -> float:
+    # the same training on one environment in this process, as the baseline of the vectorized speedup
     env = environments.get_training_env()
-    model = A2C(
-        env=env,
-        policy='MlpPolicy',
-        n_steps=100,
-        verbose=1,
-        tensorboard_log='tensorboard_paper'
+    model = A2C.load(initial_agent, env=env)
+    start = time.perf_counter()
+    model.learn(timesteps)
+    steps_per_second = model.num_timesteps / (time.perf_counter() - start)
+    env.close()
+    return steps_per_second
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--envs', type=int, default=1, help='number of parallel SUMO training environments')
+    parser.add_argument('--seed', type=int, default=None, help='base seed of the training environments')
+    parser.add_argument('--baseline-steps', type=int, default=10_000,
+                        help='timesteps of a single environment run to report the speedup against, 0 to skip')
+    parser.add_argument('--profile', action='store_true',
+                        help='log per-phase step timings and TraCI call counts to tensorboard')
+    args = parser.parse_args()
+
+    print("Begin training configuration")
+    network = SumoNetworkBuilder(config_directory, '2lane_unprotected_right').build(
+        insert_probability=INSERT_PROBABILITY,
+        duration=DURATION,
+        repeat_period=REPEAT_PERIOD,
+        friction=FRICTION,
+        speed=SPEED,
+        default_decel=DEFAULT_DECEL,
+        default_emergency_decel=DEFAULT_EMERGENCY_DECEL,
     )
-
-    model_name = 'transs50f0.5_s80_f0.5_' + str(i)
-    model = model.load(Path().joinpath('env', 'agents_paper', 'scratch_s50_f0.5.zip'), env=env,
-                           tensorboard_log='tensorboard_paper')
-
-    print(model.policy, model.n_steps, model.verbose, model.tensorboard_log)
-
-    model.learn(1_000_000, tb_log_name=model_name)
-    model.save(Path().joinpath('env', 'agents_paper', model_name + '.zip'))
-    print("Finished training")
+    print(f"Finished training configuration in {network['directory']}")
+
+    print("Begin initiating environment")
+    environments = SumoEnvironmentGenerator(
+        net_file=str(network['net.xml']),
+        route_file=str(network['rou.xml']),
+        sumocfg_file=str(network['sumocfg']),
+        duration=3600,
+        learning_data_csv_name=str(Path().joinpath('env', 'training_data', 'output.csv')),
+    )
+    print("Finished initiating environment")
+
+    baseline_sps = None
+    if args.envs > 1 and args.baseline_steps > 0:
+        baseline_sps = single_env_steps_per_second(environments, args.baseline_steps)
+        print(f"Single environment baseline at {baseline_sps:.1f} steps/s")
+
+    print(f"Begin training with Speed {SPEED} and friction {FRICTION}")
+
+    for i in range(2):
+        seed = None if args.seed is None else args.seed + i
+        if args.envs > 1:
+            env = environments.get_training_vec_env(args.envs, seed=seed, profile=args.profile)
+        else:
+            env = environments.get_training_env(profile=args.profile)
+            if seed is not None:
+                # the episode seeds of the first environment of a vectorized run with the same seed
+                env = EpisodeSeedWrapper(env, np.random.SeedSequence(seed).spawn(1)[0])
+        model = A2C(
+            env=env,
+            policy='MlpPolicy',
+            n_steps=100,
+            verbose=1,
+            tensorboard_log='tensorboard_paper'
+        )
+
+        model_name = 'transs50f0.5_s80_f0.5_' + str(i)
+        model = model.load(initial_agent, env=env, tensorboard_log='tensorboard_paper')
+
+        print(model.policy, model.n_steps, model.verbose, model.tensorboard_log)
+
+        start = time.perf_counter()
+        model.learn(1_000_000, tb_log_name=model_name, callback=ProfilerCallback() if args.profile else None)
+        steps_per_second = model.num_timesteps / (time.perf_counter() - start)
+        model.save(Path().joinpath('env', 'agents_paper', model_name + '.zip'))
+        env.close()
+        print(f"Finished training with {args.envs} environment(s) at {steps_per_second:.1f} steps/s")
+        if baseline_sps:
+            print(f"Speedup over the single environment baseline: {steps_per_second / baseline_sps:.2f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,154 @@
+import argparse
+import hashlib
+import io
+import json
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from scipy import stats
+
+TREATMENTS = ('desiredSpeed', 'friction')
+OUTCOMES = ('waitingTime', 'collisions', 'emergencyBraking', 'speed')
+# sufficient statistics of a simple linear regression of an outcome y on a treatment x
+STATISTICS = ('n', 'x', 'y', 'xx', 'xy', 'yy')
+ALL_AGENTS = 'all'
+
+
+class InterventionEffects:
+    # Total effect of every treatment on every outcome (one path of the causal graph, like the models in
+    # BayesianModel.ipynb), per agent and pooled over all agents. Instead of sampling one PyMC model per path, the
+    # likelihood is Gaussian with a conjugate Normal-Inverse-Gamma prior, so the posterior of all paths and agents
+    # follows in closed form from a few sums per group. Appending traces only adds to these sums.
+
+    def __init__(self, treatments=TREATMENTS, outcomes=OUTCOMES, prior_scale: float = 10.0, prior_shape: float = 1.0,
+                 prior_rate: float = 1.0):
+        self.treatments = list(treatments)
+        self.outcomes = list(outcomes)
+        # (intercept, slope) ~ N(0, sigma^2 * prior_scale^2 * I), sigma^2 ~ InvGamma(prior_shape, prior_rate)
+        self.prior_precision = np.eye(2) / prior_scale ** 2
+        self.prior_shape = prior_shape
+        self.prior_rate = prior_rate
+        self.statistics = pd.DataFrame(columns=list(STATISTICS), dtype=np.float64,
+                                       index=pd.MultiIndex.from_tuples([], names=['agent', 'treatment', 'outcome']))
+
+    def update(self, data: pd.DataFrame):
+        agents = data['agent'] if 'agent' in data else pd.Series('', index=data.index)
+        tables = []
+        for treatment in self.treatments:
+            for outcome in self.outcomes:
+                if treatment not in data or outcome not in data:
+                    continue
+                x = data[treatment].to_numpy(dtype=np.float64)
+                y = data[outcome].to_numpy(dtype=np.float64)
+                table = pd.DataFrame({'n': 1.0, 'x': x, 'y': y, 'xx': x * x, 'xy': x * y, 'yy': y * y})
+                finite = np.isfinite(x) & np.isfinite(y)
+                table = table[finite].groupby(agents.to_numpy()[finite]).sum()
+                table.index = pd.MultiIndex.from_product([table.index, [treatment], [outcome]],
+                                                         names=['agent', 'treatment', 'outcome'])
+                tables.append(table)
+        if tables:
+            self.statistics = self.statistics.add(pd.concat(tables), fill_value=0.0).sort_index()
+        return self
+
+    def posterior(self) -> pd.DataFrame:
+        statistics, mean, covariance, shape, rate = self.posterior_parameters()
+        n = statistics['n'].to_numpy()
+
+        # the marginal posterior of the slope is a Student t
+        degrees_of_freedom = 2 * shape
+        slope_scale = np.sqrt(rate / shape * covariance[:, 1, 1])
+        posterior = pd.DataFrame({
+            'n': n.astype(int),
+            'slope_mean': mean[:, 1],
+            'slope_sd': slope_scale * np.sqrt(degrees_of_freedom / np.maximum(degrees_of_freedom - 2, 1e-12)),
+            'slope_hdi_3%': mean[:, 1] + slope_scale * stats.t.ppf(0.03, degrees_of_freedom),
+            'slope_hdi_97%': mean[:, 1] + slope_scale * stats.t.ppf(0.97, degrees_of_freedom),
+            'intercept_mean': mean[:, 0],
+            'sigma_mean': np.sqrt(rate / np.maximum(shape - 1, 1e-12)),
+        }, index=statistics.index)
+        posterior['slope_positive_probability'] = stats.t.sf(0, degrees_of_freedom, loc=mean[:, 1], scale=slope_scale)
+        return posterior
+
+    def sample(self, draws: int = 2000, rng: np.random.Generator = None) -> dict[str, np.ndarray]:
+        # posterior draws of all groups (groups x draws), e.g. for plots that expect MCMC traces
+        rng = rng or np.random.default_rng()
+        statistics, mean, covariance, shape, rate = self.posterior_parameters()
+        n = statistics['n'].to_numpy()
+        variance = rate[:, None] / rng.gamma(shape[:, None], size=(len(n), draws))
+        coefficients = mean[:, None, :] + np.sqrt(variance)[..., None] * np.einsum(
+            'gij,gdj->gdi', np.linalg.cholesky(covariance), rng.standard_normal((len(n), draws, 2)))
+        return {'index': statistics.index, 'intercept': coefficients[..., 0], 'slope': coefficients[..., 1],
+                'sigma': np.sqrt(variance)}
+
+    def posterior_parameters(self) -> tuple[pd.DataFrame, np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        # Normal-Inverse-Gamma posterior of every group, computed for all groups at once
+        statistics = self.pooled_statistics()
+        n, x, y, xx, xy, yy = (statistics[column].to_numpy() for column in STATISTICS)
+        precision = self.prior_precision + np.stack([np.stack([n, x], -1), np.stack([x, xx], -1)], -2)
+        covariance = np.linalg.inv(precision)
+        mean = np.einsum('gij,gj->gi', covariance, np.stack([y, xy], -1))
+        shape = self.prior_shape + n / 2
+        rate = self.prior_rate + 0.5 * (yy - np.einsum('gi,gij,gj->g', mean, precision, mean))
+        return statistics, mean, covariance, shape, rate
+
+    def pooled_statistics(self) -> pd.DataFrame:
+        if self.statistics.empty:
+            return self.statistics
+        pooled = self.statistics.groupby(level=['treatment', 'outcome']).sum()
+        pooled.index = pd.MultiIndex.from_tuples([(ALL_AGENTS, *key) for key in pooled.index],
+                                                 names=self.statistics.index.names)
+        agents = self.statistics.index.get_level_values('agent').unique()
+        return self.statistics if len(agents) == 1 else pd.concat([self.statistics, pooled]).sort_index()
+
+
+def fit_traces(trace_file: Path, cache_directory: Path = Path('cache', 'intervention_effects'),
+               effects: InterventionEffects = None) -> InterventionEffects:
+    # Sums of a trace csv are cached under the hash of its content. When rows were appended since the last fit, the
+    # sums of the unchanged beginning of the file are reused and only the new rows are parsed.
+    effects = effects or InterventionEffects()
+    content = Path(trace_file).read_bytes()
+    cache_directory = Path(cache_directory)
+    cache_directory.mkdir(parents=True, exist_ok=True)
+    content_hash = hashlib.sha256(content).hexdigest()
+    index_file = cache_directory.joinpath('index.json')
+    index = json.loads(index_file.read_text()) if index_file.exists() else {}
+    previous = index.get(str(Path(trace_file).resolve()))
+
+    if cache_directory.joinpath(content_hash + '.csv').exists():
+        effects.statistics = read_statistics(cache_directory.joinpath(content_hash + '.csv'))
+    elif previous and cache_directory.joinpath(previous['hash'] + '.csv').exists() \
+            and previous['bytes'] <= len(content) and content[previous['bytes'] - 1:previous['bytes']] == b'\n' \
+            and hashlib.sha256(content[:previous['bytes']]).hexdigest() == previous['hash']:
+        header = content[:content.index(b'\n') + 1]
+        effects.statistics = read_statistics(cache_directory.joinpath(previous['hash'] + '.csv'))
+        effects.update(pd.read_csv(io.BytesIO(header + content[previous['bytes']:])))
+    else:
+        effects.update(pd.read_csv(io.BytesIO(content)))
+
+    effects.statistics.reset_index().to_csv(cache_directory.joinpath(content_hash + '.csv'), index=False)
+    index[str(Path(trace_file).resolve())] = {'hash': content_hash, 'bytes': len(content)}
+    index_file.write_text(json.dumps(index, indent=2))
+    return effects
+
+
+def read_statistics(statistics_file: Path) -> pd.DataFrame:
+    return pd.read_csv(statistics_file, keep_default_na=False).set_index(['agent', 'treatment', 'outcome'])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('traces', type=Path, nargs='?', default=Path('data', 'traces_all_agents.csv'))
+    parser.add_argument('--cache', type=Path, default=Path('cache', 'intervention_effects'))
+    parser.add_argument('--output', type=Path, default=None, help='csv of the posterior summaries')
+    args = parser.parse_args()
+
+    posterior = fit_traces(args.traces, args.cache).posterior()
+    with pd.option_context('display.max_rows', None, 'display.width', 200):
+        print(posterior.round(4))
+    if args.output:
+        posterior.to_csv(args.output)
+
+
+if __name__ == '__main__':
+    main()